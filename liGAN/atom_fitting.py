@@ -1,13 +1,27 @@
-import time
+import time, itertools, copy, queue, json, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.fft
 import torch
 import torch.nn.functional as F
 import molgrid
 
-from . import atom_grids, atom_structs
+from . import common, atom_grids, atom_structs, dkoes_fitting
 from .atom_grids import AtomGrid
 from .atom_structs import AtomStruct
 
+# serializes writing fit statistics to trace files
+trace_lock = threading.Lock()
+
+# kernel size at which FFT convolution becomes
+#   faster than direct convolution, by default
+MIN_FFT_KERNEL_SIZE = 11
+
+# number of kernel spectra to keep cached for FFT
+#   convolution, since each is as large as a grid
+MAX_KERNEL_FFTS = 4
+
 
 class AtomFitter(object):
     '''
@@ -34,13 +48,23 @@ class AtomFitter(object):
         beam_size=1,
         multi_atom=False,
         n_atoms_detect=1,
+        one_shot=False,
+        one_shot_refine=True,
         apply_conv=False,
         threshold=0.1,
         peak_value=1.5,
         min_dist=0.0,
+        detect_peaks=False,
+        peak_block_size=None,
+        peak_update_tol=0.01,
+        crop_threshold=None,
+        coarse_factor=None,
         apply_prop_conv=False,
+        fft_conv=None,
         constrain_types=False,
         constrain_frags=False,
+        prune_bound=False,
+        dedupe_resolution=None,
         estimate_types=False,
         fit_L1_loss=False,
         interm_gd_iters=10,
@@ -53,6 +77,9 @@ class AtomFitter(object):
         dkoes_make_mol=True,
         use_openbabel=False,
         output_kernel=False,
+        n_workers=1,
+        trace_file=None,
+        record_visited=False,
         device='cuda',
         verbose=0,
         debug=False,
@@ -66,20 +93,53 @@ class AtomFitter(object):
         # try placing all detected atoms at once, then try individually
         self.multi_atom = multi_atom
 
+        # place all atoms at once based on type counts, instead of
+        #   searching, and optionally reassign misplaced atoms
+        self.one_shot = one_shot
+        self.one_shot_refine = one_shot_refine
+
         # settings for detecting atoms in element channels
         self.apply_conv = apply_conv
         self.threshold = threshold
         self.peak_value = peak_value
         self.min_dist = min_dist
 
+        # only consider local maxima of grid values as atom candidates
+        self.detect_peaks = detect_peaks
+
+        # keep block-wise maxima of detection values for each struct,
+        #   if not None, and only update the blocks near atoms that
+        #   were added or moved more than peak_update_tol
+        self.peak_block_size = peak_block_size
+        self.peak_update_tol = peak_update_tol
+
+        # fit to the sub-grid of points above crop_threshold, if not None
+        self.crop_threshold = crop_threshold
+
+        # search on a grid downsampled by coarse_factor first, if not
+        #   None, then warm start the search at full resolution
+        self.coarse_factor = coarse_factor
+
         # setting for detecting properties in property channels
         self.apply_prop_conv = apply_prop_conv
 
+        # use FFT instead of direct convolution with atom kernel
+        #   or decide based on kernel size, if fft_conv is None
+        self.fft_conv = fft_conv
+
         # can constrain to find exact atom type counts or single fragment
         self.constrain_types = constrain_types
         self.constrain_frags = constrain_frags
         self.estimate_types = estimate_types
 
+        # skip gradient descent on expansions whose lower bound
+        #   on the loss can't beat the current best structures
+        self.prune_bound = prune_bound
+
+        # skip expanded structs that are duplicates of visited structs,
+        #   with coords quantized to this fraction of grid resolution
+        self.dedupe_resolution = dedupe_resolution
+
         # can perform gradient descent at each step and/or at final step
         self.fit_L1_loss = fit_L1_loss
         self.interm_gd_iters = interm_gd_iters
@@ -91,11 +151,40 @@ class AtomFitter(object):
         self.verbose = verbose
         self.debug = debug
 
+        # number of threads for fitting multiple grids at once
+        self.n_workers = n_workers
+
+        # measure peak memory of each fit, which is disabled when
+        #   fitting in threads since the statistic is process-wide
+        self.track_memory = True
+
+        # append fit statistics of each fit to JSONL file
+        self.trace_file = trace_file
+
+        # record all structs visited during search, not just final one
+        self.record_visited = record_visited
+
         self.grid_maker = molgrid.GridMaker(gaussian_radius_multiple=-1.5)
         self.c2grid = molgrid.Coords2Grid(self.grid_maker)
 
         # lazily initialize atom density kernel
         self.kernel = None
+        self.kernel_key = None
+
+        # cache recently used kernel spectra for FFT convolution
+        self.kernel_ffts = OrderedDict()
+
+    def worker_copy(self):
+        '''
+        Return a copy of the fitter with its own gridder
+        and kernel state, so that the copy can be used to
+        fit structures concurrently with this fitter.
+        '''
+        fitter = copy.copy(self)
+        fitter.grid_maker = molgrid.GridMaker(gaussian_radius_multiple=-1.5)
+        fitter.c2grid = molgrid.Coords2Grid(fitter.grid_maker)
+        fitter.kernel_ffts = OrderedDict(self.kernel_ffts)
+        return fitter
 
     def print(self, *msg, level=1):
         if self.verbose >= level:
@@ -153,6 +242,7 @@ class AtomFitter(object):
         # create the atom density kernel
         self.c2grid.center = (0, 0, 0)
         self.kernel = self.c2grid.forward(coords, types, radii)
+        self.kernel_key = (resolution, typer, deconv)
 
         if deconv: # invert the kernel
             self.kernel = torch.tensor(
@@ -173,16 +263,132 @@ class AtomFitter(object):
 
         return self.kernel
 
+    def get_kernel(self, resolution, typer):
+        '''
+        Return the atomic density kernel for the
+        provided resolution and typer, only re-
+        initializing it if the settings changed.
+        '''
+        if self.kernel is None or self.kernel_key != (resolution, typer, False):
+            self.init_kernel(resolution, typer)
+        return self.kernel
+
+    def get_fft_shape(self, grid_shape, resolution, typer):
+        '''
+        Return the fast FFT lengths for linear convolution
+        of the atomic density kernel with grids of the given
+        spatial shape, which avoid circular overlap.
+        '''
+        kernel = self.get_kernel(resolution, typer)
+        return tuple(
+            scipy.fft.next_fast_len(n + kernel.shape[-1] - 1, real=True)
+                for n in grid_shape
+        )
+
+    def get_kernel_fft(self, grid_shape, resolution, typer):
+        '''
+        Return the spectrum of the atomic density kernel,
+        normalized by the kernel norm and zero-padded for
+        linear convolution with grids of the given spatial
+        shape. Spectra are cached by resolution, typer and
+        padded FFT shape, so that grids of similar shapes
+        share a spectrum, and only the MAX_KERNEL_FFTS most
+        recently used spectra are kept.
+        '''
+        fft_shape = self.get_fft_shape(grid_shape, resolution, typer)
+        key = (resolution, typer, fft_shape)
+        if key in self.kernel_ffts:
+            self.kernel_ffts.move_to_end(key)
+        else:
+            kernel = self.get_kernel(resolution, typer)
+            kernel_norm2 = (kernel**2).sum(dim=(1,2,3), keepdim=True)
+
+            # flip kernel, since conv3d computes cross-correlation
+            self.kernel_ffts[key] = torch.fft.rfftn(
+                (kernel / kernel_norm2).flip(dims=(1,2,3)), s=fft_shape
+            )
+            while len(self.kernel_ffts) > MAX_KERNEL_FFTS:
+                self.kernel_ffts.popitem(last=False)
+
+        return self.kernel_ffts[key]
+
+    def use_fft_conv(self, resolution, typer):
+        '''
+        Return whether to convolve with the kernel by FFT,
+        which is faster than direct convolution when the
+        kernel is large relative to the grid.
+        '''
+        if self.fft_conv is not None:
+            return self.fft_conv
+        kernel = self.get_kernel(resolution, typer)
+        return kernel.shape[-1] >= MIN_FFT_KERNEL_SIZE
+
+    def fft_convolve(self, values, resolution, typer):
+        '''
+        Convolve grid channels with the normalized atomic
+        density kernel using FFTs. Each grid channel is
+        convolved with the matching kernel channel.
+        '''
+        n_x, n_y, n_z = grid_shape = values.shape[-3:]
+        kernel_fft = self.get_kernel_fft(grid_shape, resolution, typer)
+        fft_shape = self.get_fft_shape(grid_shape, resolution, typer)
+
+        values_fft = torch.fft.rfftn(values, s=fft_shape)
+        values_fft = values_fft * kernel_fft
+        conv_values = torch.fft.irfftn(values_fft, s=fft_shape)
+
+        # crop the "same" output, as with padding=kernel_size//2
+        i = self.kernel.shape[-1] // 2
+        return conv_values[..., i:i+n_x, i:i+n_y, i:i+n_z]
+
+    def crop_grid(self, grid):
+        '''
+        Crop the grid to the cubic sub-grid that contains
+        the grid points above crop_threshold, padded by the
+        radius of the atomic density kernel so that atom
+        detection near the edges is not affected.
+        '''
+        kernel = self.get_kernel(grid.resolution, grid.typer)
+        return grid.crop(self.crop_threshold, padding=kernel.shape[-1]//2)
+
+    def fit_coarse(self, grid, type_counts=None, init_struct=None):
+        '''
+        Fit an AtomStruct to the grid downsampled by coarse_
+        factor, without final gradient descent, so that it
+        can be used to warm start the search on the grid.
+        The properties of the atoms are detected again at
+        the full resolution.
+        '''
+        fitter = copy.copy(self)
+        fitter.coarse_factor = None
+        fitter.crop_threshold = None
+        fitter.final_gd_iters = 0
+        fitter.trace_file = None
+        fitter.record_visited = False
+
+        grid_coarse = grid.downsample(self.coarse_factor)
+        struct = fitter.fit_struct(grid_coarse, type_counts, init_struct)[0]
+
+        if grid.typer.n_prop_types > 0 and struct.n_atoms > 0:
+            idx_c = struct.types[:,:grid.n_elem_channels].argmax(dim=1)
+            types = torch.cat([
+                struct.types[:,:grid.n_elem_channels],
+                *self.detect_properties(
+                    grid, grid.get_index(struct.coords), idx_c
+                )
+            ], dim=1).to(struct.types.dtype)
+            struct = AtomStruct(struct.coords, types, grid.typer)
+
+        return struct
+
     def get_types_estimate(self, grid):
         '''
         Since atom density is additive and non-negative, estimate
         the atom type counts by dividing the total density in each
         grid channel by the total density in each kernel channel.
         '''
-        if self.kernel is None:
-            self.init_kernel(grid.resolution, grid.typer)
-
-        kernel_sum = self.kernel.sum(dim=(1,2,3))
+        kernel = self.get_kernel(grid.resolution, grid.typer)
+        kernel_sum = kernel.sum(dim=(1,2,3))
         grid_sum = grid.elem_values.sum(dim=(1,2,3))
         return grid_sum / kernel_sum
 
@@ -195,16 +401,18 @@ class AtomFitter(object):
         so that values above 0.5 indicate grid points
         where placing an atom would decrease L2 loss.
         '''
-        if self.kernel is None:
-            self.init_kernel(resolution, typer)
+        kernel = self.get_kernel(resolution, typer)
+
+        if self.use_fft_conv(resolution, typer):
+            return self.fft_convolve(elem_values, resolution, typer)
 
         # normalize convolved grid channels by kernel norm
-        kernel_norm2 = (self.kernel**2).sum(dim=(1,2,3), keepdim=True)
+        kernel_norm2 = (kernel**2).sum(dim=(1,2,3), keepdim=True)
 
         return F.conv3d(
             input=elem_values.unsqueeze(0),  # add batch dim
-            weight=self.kernel.unsqueeze(1), # add inputs/group dim
-            padding=self.kernel.shape[-1]//2,
+            weight=kernel.unsqueeze(1), # add inputs/group dim
+            padding=kernel.shape[-1]//2,
             groups=typer.n_elem_types,
         )[0] / kernel_norm2 # index into batch
 
@@ -216,16 +424,26 @@ class AtomFitter(object):
         '''
         return self.peak_value - (self.peak_value - grid_values).abs()
 
-    def sort_grid_points(self, grid_values):
+    def sort_grid_points(self, grid_values, k=None):
         '''
         Sort grid_values from highest to lowest,
         and also return corresponding spatial and
-        channel indices of the sorted values.
+        channel indices of the sorted values. If k
+        is not None, only return the top k values.
         '''
         n_c, n_x, n_y, n_z  = grid_values.shape
 
         # get flattened grid values and index, sorted by value
-        values, idx = torch.sort(grid_values.flatten(), descending=True)
+        #   and then by index, so that ties are broken the same
+        #   way as when sorting the top points of a PeakIndex
+        if k is None:
+            values, idx = torch.sort(
+                grid_values.flatten(), descending=True, stable=True
+            )
+        else:
+            values, idx = torch.topk(
+                grid_values.flatten(), min(k, grid_values.numel())
+            )
 
         # convert flattened grid index to channel and spatial index
         idx_z, idx = idx % n_z, idx // n_z
@@ -236,6 +454,56 @@ class AtomFitter(object):
 
         return values, idx_xyz, idx_c
 
+    def find_peaks(
+        self, grid_values, resolution, typer, type_counts=None, k=None
+    ):
+        '''
+        Return the top k grid_values that are local maxima
+        in their channel, sorted from highest to lowest, and
+        the corresponding spatial and channel indices.
+
+        Peaks are found by comparing to a 3D max-pool of the
+        grid values. The pooling window is extended to cover
+        min_dist * (2 * atomic radius) of the channel, which
+        suppresses lower values within that distance in the
+        same pass. Peaks must also be above threshold and, if
+        constrain_types, in a channel with atoms left.
+        '''
+        not_none = lambda x: x is not None
+        n_c = grid_values.shape[0]
+
+        # half-width of max-pool window for each channel, in voxels
+        if not_none(self.min_dist) and self.min_dist > 0.0:
+            half_widths = [
+                max(1, int(self.min_dist * 2 * r / resolution))
+                    for r in typer.elem_radii[:n_c].tolist()
+            ]
+        else:
+            half_widths = [1] * n_c
+
+        # pool channels with the same window size together
+        is_peak = torch.zeros_like(grid_values, dtype=torch.bool)
+        for h in set(half_widths):
+            idx_c = [c for c in range(n_c) if half_widths[c] == h]
+            values = grid_values[idx_c]
+            max_values = F.max_pool3d(
+                values.unsqueeze(0), kernel_size=2*h+1, stride=1, padding=h
+            ).squeeze(0)
+            is_peak[idx_c] = (values >= max_values)
+
+        if not_none(self.threshold) and self.threshold > -np.inf:
+            is_peak &= (grid_values > self.threshold)
+
+        if self.constrain_types and type_counts is not None:
+            has_atoms_left = type_counts[:n_c] > 0
+            is_peak &= has_atoms_left.view(n_c, 1, 1, 1)
+
+        # select the top k peaks, excluding the masked grid points
+        values = grid_values.masked_fill(~is_peak, -np.inf)
+        values, idx_xyz, idx_c = self.sort_grid_points(values, k)
+        is_peak = values > -np.inf
+        return values[is_peak], idx_xyz[is_peak], idx_c[is_peak]
+
     def apply_threshold(self, values, idx_xyz, idx_c):
         '''
         Return only the elements of the provided values
@@ -248,27 +516,23 @@ class AtomFitter(object):
         idx_c = idx_c[above_thresh]
         return values, idx_xyz, idx_c
 
-    def apply_type_constraint(self, values, idx_xyz, idx_c, type_counts):
+    def apply_type_constraint(self, coords, idx_xyz, idx_c, type_counts):
         '''
-        Return only the elements of the provided values
+        Return only the elements of the provided coords
         and corresponding spatial and channel indices
-        where type_counts of the channels is greater
-        than zero.
-        '''
-        #TODO this does not constrain the atoms types correctly
-        # when doing multi_atom fitting, because it only omits
-        # atom types that have 0 atoms left- i.e. we could still
-        # return 2 atoms of a type that only has 1 atom left.
-        # Need to exclude all atoms of type t beyond rank n_t
-        # where n_t is the number of atoms left of type t
-        has_atoms_left = type_counts[idx_c] > 0
-        values = values[has_atoms_left]
-        idx_xyz = idx_xyz[has_atoms_left]
-        idx_c = idx_c[has_atoms_left]
-        return values, idx_xyz, idx_c
+        whose rank within their channel is less than
+        type_counts of the channel, i.e. at most n_t
+        atoms of type t where n_t is the number of
+        atoms left of type t. Assumes that coords are
+        sorted by decreasing grid value.
+        '''
+        in_count = rank_in_channel(idx_c, len(type_counts)) \
+            < type_counts[idx_c]
+        return coords[in_count], idx_xyz[in_count], idx_c[in_count]
 
     def suppress_non_max(
-        self, values, coords, idx_xyz, idx_c, typer, matrix=None
+        self, values, coords, idx_xyz, idx_c, typer,
+        matrix=None, max_count=None, chunk_size=1024,
     ):
         '''
         Return the coords, spatial and channel indices
@@ -278,8 +542,13 @@ class AtomFitter(object):
         min_dist * (sum of the atom pair's radii), and
         the method assumes that values/coords/indices 
         are all sorted by value.
+
+        Small inputs use NxN matrix calculations, while
+        large inputs use a spatial hash of the points
+        that are kept, processed in chunks of chunk_size.
+        The spatial hash can stop after max_count points.
         '''
-        if len(coords) <= 1: # nothing to suppress
+        if len(coords) <= 1 or self.min_dist <= 0: # nothing to suppress
             return coords, idx_xyz, idx_c
 
         r = typer.elem_radii
@@ -305,68 +574,240 @@ class AtomFitter(object):
                 coords[~too_close], idx_xyz[~too_close], idx_c[~too_close]
             )
 
-        else: # use a for-loop
-            coords_max = coords[0].unsqueeze(0)
-            idx_xyz_max = idx_xyz[0].unsqueeze(0)
-            idx_c_max = idx_c[0].unsqueeze(0)
-
-            for i in range(1, len(idx_c)):
-                same_type = (idx_c[i] == idx_c_max)
-                bond_radius = r[idx_c[i]] + r[idx_c_max]
-                min_dist2 = (self.min_dist * bond_radius)**2
-                dist2 = ((coords[i].unsqueeze(0) - coords_max)**2).sum(dim=1)
-                if not ((dist2 < min_dist2) & same_type).any():
-                    coords_max = torch.cat([coords_max,coords[i].unsqueeze(0)])
-                    idx_xyz_max = torch.cat([idx_xyz_max, idx_xyz[i].unsqueeze(0)])
-                    idx_c_max = torch.cat([idx_c_max, idx_c[i].unsqueeze(0)])
-
-            return coords_max, idx_xyz_max, idx_c_max
+        else: # use a spatial hash
+            keep = suppress_non_max_hash(
+                coords,
+                idx_c,
+                min_dist=self.min_dist * 2 * r[idx_c],
+                cell_size=self.min_dist * 2 * float(r[idx_c].max()),
+                max_count=max_count,
+                chunk_size=chunk_size,
+            )
+            return coords[keep], idx_xyz[keep], idx_c[keep]
 
-    def detect_atoms(self, grid, type_counts=None):
+    def get_detect_values(self, grid, lo=None, hi=None):
         '''
-        Detect a set of typed atoms in an AtomGrid by convolving
-        with a kernel, applying a threshold, and then returning
-        atom coordinates and type vectors ordered by grid value.
+        Return the values used to detect atoms in the element
+        channels of an AtomGrid, by convolving with a kernel
+        and reflecting values above peak_value. If lo and hi
+        are provided, only return the values in the box of
+        grid points from lo to hi (exclusive).
         '''
-        not_none = lambda x: x is not None
-
-        # detect atoms in the element channels
         values = grid.elem_values
 
+        if lo is not None: # include the points the box depends on
+            if self.apply_conv:
+                kernel = self.get_kernel(grid.resolution, grid.typer)
+                h = kernel.shape[-1] // 2
+            else:
+                h = 0
+            lo_pad = [max(i - h, 0) for i in lo]
+            hi_pad = [min(i + h, grid.size) for i in hi]
+            values = values[
+                :,
+                lo_pad[0]:hi_pad[0],
+                lo_pad[1]:hi_pad[1],
+                lo_pad[2]:hi_pad[2],
+            ]
+
         # convolve grid with atomic density kernel
         if self.apply_conv:
             values = self.convolve(values, grid.resolution, grid.typer)
 
+        if lo is not None: # crop the box
+            values = values[
+                :,
+                lo[0]-lo_pad[0]:hi[0]-lo_pad[0],
+                lo[1]-lo_pad[1]:hi[1]-lo_pad[1],
+                lo[2]-lo_pad[2]:hi[2]-lo_pad[2],
+            ]
+
         # reflect grid values above peak value
-        if not_none(self.peak_value) and self.peak_value < np.inf:
+        if self.peak_value is not None and self.peak_value < np.inf:
             values = self.apply_peak_value(values)
 
-        # sort grid points by value
-        values, idx_xyz, idx_c = self.sort_grid_points(values)
+        return values
 
-        # apply threshold to grid points and values
-        if not_none(self.threshold) and self.threshold > -np.inf:
-            values, idx_xyz, idx_c = self.apply_threshold(
-                values, idx_xyz, idx_c
+    def get_peak_index(self, grid):
+        '''
+        Return a PeakIndex of the detection values of
+        the AtomGrid, with blocks of peak_block_size.
+        '''
+        return PeakIndex(self.get_detect_values(grid), self.peak_block_size)
+
+    def update_peak_index(self, peak_index, grid, coords_old, coords, types):
+        '''
+        Return a PeakIndex of the detection values of the
+        AtomGrid, which is the remaining density of a struct
+        with the given coords and types, by updating the
+        PeakIndex of the struct's parent with coords_old.
+
+        Only the blocks that can be affected by the density
+        of the atoms that were added, or that moved more than
+        peak_update_tol since they were last updated in the
+        index, are updated. Each atom's density in the index
+        is therefore never more than that tolerance away from
+        its current position, over any number of updates.
+        '''
+        if peak_index.coords is not None: # where atoms were last updated
+            coords_old = peak_index.coords
+        n_old = len(coords_old)
+        moved = torch.ones(len(coords), dtype=torch.bool, device=coords.device)
+        moved[:n_old] = (
+            (coords[:n_old] - coords_old).norm(dim=1) > self.peak_update_tol
+        )
+        coords_index = torch.cat([coords_old, coords[n_old:]])
+        coords_index[moved] = coords[moved]
+        b = peak_index.block_size
+        if not moved.any():
+            return PeakIndex(
+                peak_index.values, b, peak_index.block_max, coords_index
             )
 
-        # exclude grid channels with no atoms left
+        # atom density extends to 1.5 times the atomic radius
+        elem_types = types[:,:grid.n_elem_channels]
+        radii = grid.typer.elem_radii.to(coords.device)[elem_types.argmax(dim=1)]
+        reach = 1.5 * radii / grid.resolution + 1
+        if self.apply_conv:
+            kernel = self.get_kernel(grid.resolution, grid.typer)
+            reach = reach + kernel.shape[-1] // 2
+
+        # get the box around the old and new positions of the atoms
+        points = torch.cat([coords[moved], coords_old[moved[:n_old]]])
+        reach = torch.cat([reach[moved], reach[:n_old][moved[:n_old]]])
+        idx_xyz = (points - grid.origin.to(coords.device)) / grid.resolution
+        lo = (idx_xyz - reach.unsqueeze(1)).min(dim=0).values
+        hi = (idx_xyz + reach.unsqueeze(1)).max(dim=0).values
+        lo = [max(int(i) // b * b, 0) for i in lo.floor().tolist()]
+        hi = [min(int(i) + 1, grid.size) for i in hi.ceil().tolist()]
+        hi = [min(-(-i // b) * b, grid.size) for i in hi]
+        if any(i >= j for i, j in zip(lo, hi)):
+            return PeakIndex(
+                peak_index.values, b, peak_index.block_max, coords_index
+            )
+
+        return peak_index.update(
+            self.get_detect_values(grid, lo, hi), lo, hi, coords_index
+        )
+
+    def detect_atoms(self, grid, type_counts=None, peak_index=None):
+        '''
+        Detect a set of typed atoms in an AtomGrid by convolving
+        with a kernel, applying a threshold, and then returning
+        atom coordinates and type vectors ordered by grid value.
+
+        If a PeakIndex of the grid is provided, only the grid
+        points in its top blocks are sorted, adding blocks
+        until enough atoms are detected.
+        '''
+        not_none = lambda x: x is not None
+
+        # round type counts, since they may be estimated
         if self.constrain_types:
-            values, idx_xyz, idx_c = self.apply_type_constraint(
-                values, idx_xyz, idx_c, type_counts
+            type_counts = type_counts[:grid.n_elem_channels].round()
+
+        # detect atoms in the element channels
+        if peak_index is not None:
+            values = peak_index.values
+        else:
+            values = self.get_detect_values(grid)
+
+        if self.detect_peaks:
+
+            # find top peaks that are above threshold and not suppressed
+            values, idx_xyz, idx_c = self.find_peaks(
+                values, grid.resolution, grid.typer, type_counts,
+                k=self.n_atoms_detect if (
+                    not_none(self.n_atoms_detect) and self.n_atoms_detect >= 0
+                    and not self.constrain_types
+                ) else None
             )
+            coords = grid.get_coords(idx_xyz)
 
-        # convert spatial index to atomic coordinates
-        coords = grid.get_coords(idx_xyz)
-
-        # suppress atoms too close to a higher-value atom of same type
-        if (
-            not_none(self.min_dist) and self.min_dist > 0.0
-            and not_none(self.n_atoms_detect) and self.n_atoms_detect > 1
-            and len(coords) > 1
-        ):
-            coords, idx_xyz, idx_c = self.suppress_non_max(
-                values, coords, idx_xyz, idx_c, grid.typer
+        else:
+            apply_nms = (
+                not_none(self.min_dist) and self.min_dist > 0.0
+                and not_none(self.n_atoms_detect) and self.n_atoms_detect > 1
+            )
+
+            # only need the top grid points if none can be excluded
+            #   before limiting the number of detected atoms
+            if (
+                not_none(self.n_atoms_detect) and self.n_atoms_detect >= 0
+                and not (self.constrain_types or apply_nms)
+            ):
+                k = self.n_atoms_detect
+            else:
+                k = None
+
+            def select_points(values, idx_xyz, idx_c):
+
+                # apply threshold to grid points and values
+                if not_none(self.threshold) and self.threshold > -np.inf:
+                    values, idx_xyz, idx_c = self.apply_threshold(
+                        values, idx_xyz, idx_c
+                    )
+
+                # convert spatial index to atomic coordinates
+                coords = grid.get_coords(idx_xyz)
+
+                # suppress atoms too close to a higher-value atom of same type
+                if apply_nms and len(coords) > 1:
+                    coords, idx_xyz, idx_c = self.suppress_non_max(
+                        values, coords, idx_xyz, idx_c, grid.typer,
+                        max_count=None if self.constrain_types \
+                            else self.n_atoms_detect
+                    )
+
+                return coords, idx_xyz, idx_c
+
+            n_c = values.shape[0]
+            if self.constrain_types:
+                has_atoms_left = type_counts[:n_c] > 0
+            else:
+                has_atoms_left = None
+
+            if (
+                peak_index is not None
+                and not_none(self.n_atoms_detect) and self.n_atoms_detect >= 0
+            ):
+                # sort points in more of the top blocks until enough
+                #   atoms are detected, or no other blocks are left
+                n_blocks = max(self.n_atoms_detect, 1)
+                while True:
+                    values, idx_xyz, idx_c, bound = peak_index.top_points(
+                        n_blocks, has_atoms_left
+                    )
+                    coords, idx_xyz, idx_c = select_points(
+                        values, idx_xyz, idx_c
+                    )
+                    if self.constrain_types:
+                        coords, idx_xyz, idx_c = self.apply_type_constraint(
+                            coords, idx_xyz, idx_c, type_counts
+                        )
+                    if (
+                        len(coords) >= self.n_atoms_detect
+                        or bound == -np.inf
+                        or (not_none(self.threshold) and bound <= self.threshold)
+                    ):
+                        break
+                    n_blocks *= 2
+
+            else:
+                # exclude grid channels with no atoms left
+                if self.constrain_types:
+                    values = values.masked_fill(
+                        ~has_atoms_left.view(n_c, 1, 1, 1), -np.inf
+                    )
+
+                # sort grid points by value
+                values, idx_xyz, idx_c = self.sort_grid_points(values, k)
+                coords, idx_xyz, idx_c = select_points(values, idx_xyz, idx_c)
+
+        # limit the number of detected atoms of each type
+        if self.constrain_types:
+            coords, idx_xyz, idx_c = self.apply_type_constraint(
+                coords, idx_xyz, idx_c, type_counts
             )
 
         # limit total number of detected atoms
@@ -391,63 +832,138 @@ class AtomFitter(object):
 
         return coords.detach(), types.detach()
 
-    def detect_properties(self, grid, idx_xyz, idx_c):
+    def detect_all_atoms(self, grid, type_counts=None):
+        '''
+        Detect all atoms in an AtomGrid at once, by taking
+        the top n_t peaks in each element channel t, where
+        n_t is given by type_counts or else estimated from
+        the total density in the channel.
+        '''
+        if type_counts is None:
+            type_counts = self.get_types_estimate(grid)
+        n_c = grid.n_elem_channels
+        type_counts = type_counts[:n_c].round().clamp(min=0)
+
+        # find all peaks, then limit the number in each channel
+        values, idx_xyz, idx_c = self.find_peaks(
+            self.get_detect_values(grid), grid.resolution, grid.typer, type_counts
+        )
+        coords, idx_xyz, idx_c = self.apply_type_constraint(
+            grid.get_coords(idx_xyz), idx_xyz, idx_c, type_counts
+        )
 
-        # detect atom properties in property channels
-        prop_values = grid.prop_values
+        types = F.one_hot(idx_c, n_c).to(dtype=grid.dtype, device=self.device)
+        if grid.typer.n_prop_types > 0: # detect atom properties
+            types = torch.cat(
+                [types, *self.detect_properties(grid, idx_xyz, idx_c)], dim=1
+            )
 
-        # adjust spatial index so we can actually use it
-        #   to index into grid and get property vectors
-        idx = idx_xyz.long().split(1, dim=1)
+        return coords.detach(), types.detach()
 
-        # convolve property channels with atom density kernel
-        if self.apply_prop_conv:
+    def refine_atoms(self, grid, coords, types, values_diff, loss):
+        '''
+        Move atoms that are not supported by the grid density,
+        or that over-explain it, onto unexplained peaks in the
+        remaining density of the same channel, using a minimum
+        distance assignment of atoms to peaks. The atoms are
+        re-fit with gradient descent and kept only if the loss
+        decreases. Returns the coords, diff values, loss, and
+        the number of atoms that were moved.
+        '''
+        from scipy.optimize import linear_sum_assignment
+
+        if len(coords) == 0:
+            return coords, values_diff, loss, 0
+
+        n_c = grid.n_elem_channels
+        threshold = max(self.threshold or 0.0, 0.0)
+        idx_x, idx_y, idx_z = grid.get_index(coords).T
+        idx_c = types[:,:n_c].argmax(dim=1)
+        misplaced = (
+            (grid.elem_values[idx_c, idx_x, idx_y, idx_z] <= threshold) |
+            (values_diff[idx_c, idx_x, idx_y, idx_z] < -threshold)
+        )
+        if not misplaced.any():
+            return coords, values_diff, loss, 0
 
-            if self.kernel is None:
-                self.init_kernel(grid.resolution, grid.typer)
+        # find peaks in the remaining density
+        _, peak_xyz, peak_c = self.find_peaks(
+            values_diff[:n_c], grid.resolution, grid.typer
+        )
+        peak_coords = grid.get_coords(peak_xyz)
+
+        coords_new = coords.clone()
+        n_moved = 0
+        for c in idx_c[misplaced].unique().tolist():
+            atoms = torch.nonzero(misplaced & (idx_c == c))[:,0]
+            peaks = torch.nonzero(peak_c == c)[:,0]
+            if len(peaks) == 0:
+                continue
+            dist2 = (
+                (coords[atoms].unsqueeze(1) - peak_coords[peaks].unsqueeze(0))**2
+            ).sum(dim=2)
+            rows, cols = linear_sum_assignment(dist2.cpu().numpy())
+            coords_new[atoms[rows]] = peak_coords[peaks[cols]]
+            n_moved += len(rows)
+
+        if n_moved == 0:
+            return coords, values_diff, loss, 0
+
+        coords_new, values_fit, values_diff_new, loss_new = self.gd(
+            grid, coords_new, types, self.interm_gd_iters
+        )
+        if loss_new < loss:
+            return coords_new, values_diff_new, loss_new, n_moved
+        return coords, values_diff, loss, 0
 
-            kernel_norm2 = (
-                self.kernel**2
-            ).sum(dim=(1,2,3), keepdim=True).unsqueeze(0)
+    def convolve_at(self, values, idx_xyz, idx_c, resolution, typer):
+        '''
+        Compute the convolution between the provided grid
+        channels and the atomic density kernel of element
+        channel idx_c, only at the spatial indices idx_xyz.
+        This takes the dot product of the patch of values
+        around each point with the matching kernel channel,
+        normalized by the kernel norm as in convolve.
+        Returns an (n_points, n_channels) tensor.
+        '''
+        kernel = self.get_kernel(resolution, typer)
+        kernel_norm2 = (kernel**2).sum(dim=(1,2,3))
 
+        patches = get_patches(values, idx_xyz, kernel.shape[-1])
+        return torch.einsum(
+            'ncv,nv->nc', patches, kernel[idx_c].flatten(1)
+        ) / kernel_norm2[idx_c].unsqueeze(1)
 
-            # apply each element kernel to each property channel
-            #   by setting the properties as the batch dimension
-            #   instead of the inputs dimension, and no groups
-            prop_values = F.conv3d(
-                input=prop_values.unsqueeze(1),  # add inputs dim
-                weight=self.kernel.unsqueeze(1), # add inputs/group dim
-                padding=self.kernel.shape[-1]//2,
-                # no groups
-            ) / kernel_norm2 # normalize, not working?
-            # prop_values[prop_channel, elem_channel, x, y, z]
+    def detect_properties(self, grid, idx_xyz, idx_c):
+        '''
+        Detect atom properties in the property channels at
+        the provided spatial and element channel indices,
+        and yield a type vector for each property.
+        '''
+        idx_xyz = idx_xyz.long()
 
-            # need to include elem channel index now
-            idx = (idx_c,) + idx
+        # convolve property channels with atom density kernel,
+        #   but only at the detected points
+        if self.apply_prop_conv:
+            prop_vecs = self.convolve_at(
+                grid.prop_values, idx_xyz, idx_c, grid.resolution, grid.typer
+            )
+        else:
+            idx_x, idx_y, idx_z = idx_xyz.T
+            prop_vecs = grid.prop_values[:, idx_x, idx_y, idx_z].T
 
-        # split into separate grids for each property
+        # split into separate vectors for each property
         #   and extend type vector with detected properties
         prop_ranges = [len(r) for r in grid.typer.prop_ranges[1:]]
-        for prop_values in torch.split(prop_values, prop_ranges):
-
-            if len(idx_xyz) == 0: # no atoms detected
-                yield torch.zeros(0, len(prop_values), device=self.device)
-                continue
-
-            # rearrange so property channels are the last index
-            #   and then use spatial index to get property vectors
-            #   there's an extra dimension added for some reason
-            dims = torch.roll(torch.arange(prop_values.ndim), shifts=-1)
-            assert dims[-1] == 0
-            prop_vecs = prop_values.permute(*dims)[idx].sum(dim=1)
+        for prop_vecs in torch.split(prop_vecs, prop_ranges, dim=1):
 
             if prop_vecs.shape[1] > 1: # argmax -> one-hot
-                prop_vals = prop_vecs.argmax(dim=1)
-                prop_vecs = torch.zeros_like(prop_vecs)
-                prop_vecs[:,prop_vals] = 1.0
+                prop_vecs = F.one_hot(
+                    prop_vecs.argmax(dim=1), prop_vecs.shape[1]
+                ).to(prop_vecs.dtype)
             else: # boolean
                 prop_vecs = (prop_vecs > 0.5)
-            
+
             yield prop_vecs
 
     def gd(self, grid, coords, types, n_iters):
@@ -495,47 +1011,173 @@ class AtomFitter(object):
             loss.detach()
         )
 
-    def expand_struct(self, coords, types, coords_next, types_next):
+    def warm_start(self, grid, init_struct):
+        '''
+        Re-fit the atoms of init_struct to the grid with
+        gradient descent, then remove atoms that are not
+        supported by density above threshold in their
+        element channel and re-fit the rest. Then remove
+        atoms one at a time where the fit density is so
+        far above the grid density that removing them
+        decreases the loss, e.g. two atoms fit to a single
+        peak. Returns the coords, types, diff values, loss,
+        and the number of atoms that were removed.
+        '''
+        coords = init_struct.coords.to(self.device, dtype=torch.float32)
+        types = init_struct.types.to(self.device, dtype=torch.float32)
+
+        coords, values_fit, values_diff, loss = self.gd(
+            grid, coords, types, self.interm_gd_iters
+        )
+
+        # check density at nearest grid point to each atom
+        idx_x, idx_y, idx_z = grid.get_index(coords).T
+        idx_c = types[:,:grid.n_elem_channels].argmax(dim=1)
+        values = grid.elem_values[idx_c, idx_x, idx_y, idx_z]
+        threshold = self.threshold if self.threshold is not None else 0.0
+        keep = values > max(threshold, 0.0)
+
+        n_removed = int((~keep).sum())
+        if n_removed > 0:
+            coords, values_fit, values_diff, loss = self.gd(
+                grid, coords[keep], types[keep], self.interm_gd_iters
+            )
+            types = types[keep]
+
+        # convolved values below -0.5 indicate atoms whose
+        #   removal would decrease L2 loss (see convolve)
+        while len(coords) > 0:
+            idx_c = types[:,:grid.n_elem_channels].argmax(dim=1)
+            values = self.convolve_at(
+                values_diff[:grid.n_elem_channels],
+                grid.get_index(coords),
+                idx_c,
+                grid.resolution,
+                grid.typer,
+            )[torch.arange(len(idx_c)), idx_c]
+            i = values.argmin()
+            if values[i] >= -0.5:
+                break
+
+            keep = torch.arange(len(coords), device=coords.device) != i
+            coords, values_fit, values_diff, loss = self.gd(
+                grid, coords[keep], types[keep], self.interm_gd_iters
+            )
+            types = types[keep]
+            n_removed += 1
+
+        return coords, types, values_diff, loss, n_removed
+
+    def get_loss_decrease_bounds(self, grid_diff, coords, types):
         '''
-        TODO please document me!!!
+        Return an upper bound on the decrease in L2 loss from
+        adding each of the provided atoms to a struct, given
+        the remaining density grid_diff of the struct.
+
+        For an atom with density a*k in each of its channels,
+        the loss ||d - a*k||^2 / 2 is minimized by amplitude
+        a = <d,k> / ||k||^2, which decreases the loss by
+        <d,k>^2 / (2 ||k||^2). The atoms have amplitude 1,
+        so this bounds the decrease at a fixed position.
+        '''
+        if len(coords) == 0:
+            return coords.new_zeros((0,))
+
+        idx_c = types[:,:grid_diff.n_elem_channels].argmax(dim=1)
+        kernel = self.get_kernel(grid_diff.resolution, grid_diff.typer)
+        kernel_norm2 = (kernel**2).sum(dim=(1,2,3))[idx_c]
+
+        # convolve_at computes <d,k> / ||k||^2 in each channel
+        conv_values = self.convolve_at(
+            grid_diff.values, grid_diff.get_index(coords), idx_c,
+            grid_diff.resolution, grid_diff.typer,
+        ).clamp(min=0)
+        return (conv_values**2 * types).sum(dim=1) * kernel_norm2 / 2
+
+    def expand_struct(
+        self, coords, types, coords_next, types_next, bounds_next=None
+    ):
+        '''
+        Yield the coords and types of structs expanded by
+        adding the detected next atoms to the struct, first
+        all at once if multi_atom, then each individually,
+        along with an upper bound on the decrease in loss
+        from adding the atoms, if bounds_next is provided.
         '''
         if self.multi_atom and len(coords_next) > 0:
 
             # expand to all next atoms simultaneously
             coords_new = torch.cat([coords, coords_next])
             types_new = torch.cat([types, types_next])
+            bound_new = None if bounds_next is None else bounds_next.sum()
 
-            yield coords_new, types_new
+            yield coords_new, types_new, bound_new
 
         for i in range(len(coords_next)):
 
             # expand to each next atom individually
             coords_new = torch.cat([coords, coords_next[i].unsqueeze(0)])
             types_new = torch.cat([types, types_next[i].unsqueeze(0)])
+            bound_new = None if bounds_next is None else bounds_next[i]
 
-            yield coords_new, types_new
+            yield coords_new, types_new, bound_new
 
-    def fit_struct(self, grid, type_counts=None):
+    def fit_struct(self, grid, type_counts=None, init_struct=None):
         '''
         Fit an AtomStruct to an AtomGrid by performing
         a beam search over sets of atom types and coords
         with gradient descent at each step.
+
+        If init_struct is provided, e.g. a previous fit
+        to a similar grid, its atoms are re-fit to the
+        grid and used to seed the search, along with
+        the empty struct.
         '''
         t_start = time.time()
-        torch.cuda.reset_max_memory_allocated()
+        timer = common.PhaseTimer()
+        if self.track_memory:
+            common.reset_peak_memory(self.device)
+        n_gd_iters = 0
+        beam_sizes = []
 
         # get true grid and type counts on appropriate device
-        grid_true = grid.to(self.device, dtype=torch.float32)
+        grid_true = grid_full = grid.to(self.device, dtype=torch.float32)
         if type_counts is not None:
             type_counts = type_counts.to(self.device, dtype=torch.float32)
 
+        # fit to the occupied sub-grid, since coords are the same
+        if self.crop_threshold is not None:
+            grid = grid_true = self.crop_grid(grid_true)
+
+        # search on a lower resolution grid first
+        coarse_time = 0.0
+        if self.coarse_factor is not None and self.coarse_factor > 1:
+            with timer('coarse'):
+                init_struct = self.fit_coarse(grid_true, type_counts, init_struct)
+            coarse_time = timer.times['coarse']
+
         if self.estimate_types: # estimate atom type counts from grid density
             type_counts_est = self.get_types_estimate(grid_true)
-            est_type_loss = (type_counts - type_counts_est).abs().sum().item()
+            if type_counts is not None:
+                est_type_loss = (
+                    type_counts[:len(type_counts_est)] - type_counts_est
+                ).abs().sum().item()
+            else:
+                est_type_loss = np.nan
             type_counts = type_counts_est
         else:
             est_type_loss = np.nan
 
+        if self.constrain_types:
+            assert type_counts is not None, \
+                'constrain_types requires type_counts or estimate_types'
+
+        # type counts left after adding atoms of the given types
+        #   (estimated type counts only include element types)
+        get_types_diff = lambda types: (
+            type_counts - types[:,:len(type_counts)].sum(dim=0)
+        )
+
         # initialize empty struct
         coords = torch.zeros(
             (0, 3),
@@ -568,14 +1210,79 @@ class AtomFitter(object):
             fmt_obj(objective), len(coords)
         ))
         
+        # can only bound the decrease in L2 loss
+        prune_bound = self.prune_bound and not self.fit_L1_loss
+        n_pruned = 0
+
+        # keep a peak index for each struct that can be expanded
+        use_peak_index = self.peak_block_size is not None
+        peak_indices = {}
+
+        def detect_atoms(grid_diff, types_diff, struct_id, parent=None):
+            '''
+            Detect next atoms in the remaining density, and
+            bound the decrease in loss from adding them. The
+            peak index of the struct is updated from that of
+            its parent, given as (parent_id, coords, coords_
+            new, types_new), if it has one.
+            '''
+            with timer('detect'):
+                if not use_peak_index:
+                    peak_index = None
+                elif parent is None or parent[0] not in peak_indices:
+                    peak_index = self.get_peak_index(grid_diff)
+                else:
+                    parent_id, coords, coords_new, types_new = parent
+                    peak_index = self.update_peak_index(
+                        peak_indices[parent_id],
+                        grid_diff, coords, coords_new, types_new
+                    )
+                if use_peak_index:
+                    peak_indices[struct_id] = peak_index
+
+                coords_next, types_next = self.detect_atoms(
+                    grid_diff, types_diff, peak_index
+                )
+                if prune_bound:
+                    bounds_next = self.get_loss_decrease_bounds(
+                        grid_diff, coords_next, types_next
+                    )
+                else:
+                    bounds_next = None
+            return coords_next, types_next, bounds_next
+
+        # keep track of visited structs to detect duplicates
+        dedupe = self.dedupe_resolution is not None
+        if dedupe:
+            cell_size = self.dedupe_resolution * grid.resolution
+        visited_keys = set()
+        n_duplicates = 0
+
+        def is_duplicate(coords, types):
+            '''
+            Check whether an equivalent struct has already
+            been visited, and mark this struct as visited.
+            '''
+            if not dedupe:
+                return False
+            key = get_struct_key(coords, types, cell_size)
+            if key in visited_keys:
+                return True
+            visited_keys.add(key)
+            return False
+
         # detect initial atom locations and types
-        coords_next, types_next = self.detect_atoms(grid_true, type_counts)
+        coords_next, types_next, bounds_next = detect_atoms(
+            grid_true, type_counts, 0
+        )
+        is_duplicate(coords, types)
 
         # keep track of best structures so far
         struct_id = 0
-        best_structs = [
-            (objective, struct_id, coords, types, coords_next, types_next)
-        ]
+        best_structs = [(
+            objective, struct_id, coords, types,
+            coords_next, types_next, bounds_next
+        )]
         found_new_best_struct = True
 
         # keep track of visited and expanded structures
@@ -583,26 +1290,137 @@ class AtomFitter(object):
         #     if it's a current best struct, also detect atoms
         #   expand = visit structs derived from this one by
         #     adding the detected atoms to current stuct
-        visited_structs = [
-            (objective, struct_id, time.time()-t_start, coords, types)
-        ]
+        visited_structs = VisitedStructs(grid.typer, self.record_visited)
+        visit_ids = {
+            struct_id: visited_structs.append(
+                None, coords, types, time.time()-t_start
+            )
+        }
         expanded_ids = set()
         struct_count = 1
 
-        # track GPU memory usage throughout search
-        mi = torch.cuda.max_memory_allocated()
-        ms = []
+        # warm start from the atoms of init_struct
+        n_init_atoms = n_init_removed = 0
+        if init_struct is not None and init_struct.n_atoms > 0:
+            n_init_atoms = init_struct.n_atoms
+
+            with timer('gd'):
+                coords_init, types_init, values_diff, fit_loss, n_init_removed\
+                    = self.warm_start(grid_true, init_struct)
+            n_gd_iters += self.interm_gd_iters * (1 + (n_init_removed > 0))
+
+            obj_init = [fit_loss.item()]
+            if type_counts is not None:
+                types_diff = get_types_diff(types_init)
+                if self.constrain_types:
+                    obj_init.insert(0, types_diff.abs().sum().item())
+            else:
+                types_diff = None
+
+            self.print('Warm start struct {} (objective={}, n_atoms={})'.format(
+                struct_count, fmt_obj(obj_init), len(coords_init)
+            ))
+
+            coords_init_next, types_init_next, bounds_init_next = \
+                detect_atoms(
+                    grid_true.new_like(values=values_diff),
+                    types_diff,
+                    struct_count,
+                )
+
+            visit_ids[struct_count] = visited_structs.append(
+                visit_ids[0],
+                coords_init,
+                types_init,
+                time.time()-t_start,
+            )
+            is_duplicate(coords_init, types_init)
+            best_structs = sorted(best_structs + [(
+                obj_init,
+                struct_count,
+                coords_init,
+                types_init,
+                coords_init_next,
+                types_init_next,
+                bounds_init_next,
+            )])[:self.beam_size]
+            struct_count += 1
+
+        # place all atoms at once, instead of searching
+        n_refined = 0
+        if self.one_shot:
+
+            if type_counts is None:
+                type_counts_left = self.get_types_estimate(grid_true)
+            else:
+                type_counts_left = type_counts[:grid.n_elem_channels]
+
+            # detect atoms in the remaining density until the type
+            #   counts are reached, since some peaks may overlap
+            coords_new, types_new = coords, types
+            coords_new, values_fit, values_diff, fit_loss = self.gd(
+                grid_true, coords_new, types_new, 0
+            )
+            while True:
+                with timer('detect'):
+                    coords_next, types_next = self.detect_all_atoms(
+                        grid_true.new_like(values=values_diff),
+                        type_counts_left
+                    )
+                if len(coords_next) == 0:
+                    break
+
+                coords_new = torch.cat([coords_new, coords_next])
+                types_new = torch.cat([types_new, types_next])
+                type_counts_left = type_counts_left \
+                    - types_next[:,:grid.n_elem_channels].sum(dim=0)
+
+                with timer('gd'):
+                    coords_new, values_fit, values_diff, fit_loss = self.gd(
+                        grid_true, coords_new, types_new, self.interm_gd_iters
+                    )
+                n_gd_iters += self.interm_gd_iters
+
+            if self.one_shot_refine:
+                with timer('gd'):
+                    coords_new, values_diff, fit_loss, n_refined = \
+                        self.refine_atoms(
+                            grid_true, coords_new, types_new,
+                            values_diff, fit_loss
+                        )
+                n_gd_iters += self.interm_gd_iters * (n_refined > 0)
+
+            obj_new = [fit_loss.item()]
+            if self.constrain_types:
+                type_loss = get_types_diff(types_new).abs().sum()
+                obj_new.insert(0, type_loss.item())
+
+            self.print('One-shot struct {} (objective={}, n_atoms={})'.format(
+                struct_count, fmt_obj(obj_new), len(coords_new)
+            ))
+
+            visit_ids[struct_count] = visited_structs.append(
+                visit_ids[0], coords_new, types_new, time.time()-t_start
+            )
+            is_duplicate(coords_new, types_new)
+            best_structs = sorted(best_structs + [(
+                obj_new, struct_count, coords_new, types_new, None, None, None
+            )])[:self.beam_size]
+            struct_count += 1
+            found_new_best_struct = False
 
         # search until we can't find a better structure
+        #   (time spent expanding excludes gd and detect)
+        timer.start('expand')
         while found_new_best_struct:
 
-            torch.cuda.reset_max_memory_allocated()
             found_new_best_struct = False
             new_best_structs = []
 
             # try to expand each current-best structure
             for bs in best_structs:
-                obj, struct_id, coords, types, coords_next, types_next = bs
+                obj, struct_id, coords, types = bs[:4]
+                coords_next, types_next, bounds_next = bs[4:]
 
                 if struct_id in expanded_ids:
                     continue # don't expand again
@@ -612,21 +1430,41 @@ class AtomFitter(object):
                 ))
 
                 # expand structure to possible next atom(s)
-                for coords_new, types_new in self.expand_struct(
-                    coords, types, coords_next, types_next
+                for coords_new, types_new, bound_new in self.expand_struct(
+                    coords, types, coords_next, types_next, bounds_next
                 ):
+                    # skip if it can't be one of the next best, even at the
+                    #   bound, once there are enough new best structs
+                    if bound_new is not None:
+                        obj_bound = [obj[-1] - bound_new.item()]
+                        if self.constrain_types:
+                            obj_bound.insert(0, get_types_diff(
+                                types_new
+                            ).abs().sum().item())
+                        next_best_structs = sorted(
+                            best_structs + new_best_structs
+                        )[:self.beam_size]
+                        if len(next_best_structs) == self.beam_size and \
+                            not obj_bound < next_best_structs[-1][0]:
+                            n_pruned += 1
+                            continue
 
                     # compute diff and loss after gradient descent
-                    coords_new, values_fit, values_diff, fit_loss = self.gd(
-                        grid, coords_new, types_new, self.interm_gd_iters
-                    )
+                    with timer('gd'):
+                        coords_new, values_fit, values_diff, fit_loss = \
+                            self.gd(
+                                grid, coords_new, types_new,
+                                self.interm_gd_iters
+                            )
+                    n_gd_iters += self.interm_gd_iters
 
                     # compute new search objective
                     obj_new = [fit_loss.item()]
-                    if self.constrain_types:
-                        types_diff = types_true - types_new.sum(dim=0)
-                        type_loss = types_diff.abs().sum()
-                        objective_new.insert(0, type_loss.item())
+                    if type_counts is not None:
+                        types_diff = get_types_diff(types_new)
+                        if self.constrain_types:
+                            type_loss = types_diff.abs().sum()
+                            obj_new.insert(0, type_loss.item())
                     else:
                         types_diff = None
 
@@ -636,15 +1474,32 @@ class AtomFitter(object):
                         )
                     )
 
+                    # regardless, store the visited struct
+                    visit_id = visited_structs.append(
+                        visit_ids[struct_id],
+                        coords_new,
+                        types_new[len(types):],
+                        time.time()-t_start,
+                    )
+
+                    # don't detect atoms in or expand equivalent structs
+                    if is_duplicate(coords_new, types_new):
+                        n_duplicates += 1
+                        continue
+
                     # check if new structure is one of the best yet
                     if any(obj_new < s[0] for s in best_structs):
                         found_new_best_struct = True
+                        visit_ids[struct_count] = visit_id
 
                         # detect possible next atoms to expand the new struct
-                        coords_new_next, types_new_next = self.detect_atoms(
-                            grid_true.new_like(values=values_diff),
-                            types_diff,
-                        )
+                        coords_new_next, types_new_next, bounds_new_next = \
+                            detect_atoms(
+                                grid_true.new_like(values=values_diff),
+                                types_diff,
+                                struct_count,
+                                (struct_id, coords, coords_new, types_new),
+                            )
                         new_best_structs.append((
                             obj_new,
                             struct_count,
@@ -652,6 +1507,7 @@ class AtomFitter(object):
                             types_new,
                             coords_new_next,
                             types_new_next,
+                            bounds_new_next,
                         ))
                         struct_count += 1
                         
@@ -661,16 +1517,8 @@ class AtomFitter(object):
                         if n_atoms_added > 1: # skip single atom expand
                             break
 
-                    # regardless, store the visited struct
-                    visited_structs.append((
-                        obj_new,
-                        struct_id,
-                        time.time()-t_start,
-                        coords_new,
-                        types_new
-                    ))
-
                 expanded_ids.add(struct_id)
+                peak_indices.pop(struct_id, None)
 
             if found_new_best_struct:
 
@@ -678,6 +1526,12 @@ class AtomFitter(object):
                 best_structs = sorted(
                     best_structs + new_best_structs
                 )[:self.beam_size]
+                beam_sizes.append(len(best_structs))
+
+                # only keep the peak indices of structs in the beam
+                beam_ids = set(bs[1] for bs in best_structs)
+                for i in set(peak_indices) - beam_ids:
+                    del peak_indices[i]
                 best_objective = best_structs[0][0]
                 best_id = best_structs[0][1]
                 best_n_atoms = len(best_structs[0][2])
@@ -689,9 +1543,13 @@ class AtomFitter(object):
                 if best_n_atoms >= 50: # limit molecule size
                     found_new_best_struct = False
 
-            ms.append(torch.cuda.max_memory_allocated())
+                # stop as soon as the best struct satisfies the type counts
+                if self.constrain_types and (
+                    get_types_diff(best_structs[0][3]).abs() < 0.5
+                ).all():
+                    found_new_best_struct = False
 
-        torch.cuda.reset_max_memory_allocated()
+        timer.stop()
 
         # done searching for atomic structures
         best_obj, best_id, coords_best, types_best = best_structs[0][:4]
@@ -700,10 +1558,18 @@ class AtomFitter(object):
             best_id, struct_count
         ))
 
+        visit_id = visit_ids[best_id]
+
         # perform final gradient descent
-        coords_best, values_fit, values_diff, fit_loss = self.gd(
-            grid_true, coords_best, types_best, self.final_gd_iters
-        )
+        with timer('gd'):
+            coords_best, values_fit, values_diff, fit_loss = self.gd(
+                grid_true, coords_best, types_best, self.final_gd_iters
+            )
+            if grid_true is not grid_full: # compute fit on the full grid
+                _, values_fit, values_diff, _ = self.gd(
+                    grid_full, coords_best, types_best, 0
+                )
+        n_gd_iters += self.final_gd_iters
         best_id = struct_count # count this as a new struct
 
         # compute the final L2 and L1 loss
@@ -712,10 +1578,8 @@ class AtomFitter(object):
 
         best_obj = [fit_loss.item()]
         if self.constrain_types:
-            type_loss = (
-                type_counts - types_best.sum(dim=0)
-            ).abs().sum().item()
-            best_obj.insert(0, type_loss.item())
+            type_loss = get_types_diff(types_best).abs().sum().item()
+            best_obj.insert(0, type_loss)
         else:
             type_loss = np.nan
 
@@ -724,102 +1588,472 @@ class AtomFitter(object):
         ))
 
         # make sure final struct is the last visited struct
-        visited_structs.append((
-            best_obj,
-            best_id,
-            time.time()-t_start,
-            coords_best,
-            types_best
-        ))
-
-        # finalize visited structs as AtomStructs
-        iter_visited = iter(visited_structs)
-        visited_structs = []
-        for objective, struct_id, fit_time, coords, types in iter_visited:
-
-            struct = AtomStruct(
-                coords=coords.detach(),
-                types=types.detach(),
-                typer=grid.typer,
-                L2_loss=L2_loss,
-                L1_loss=L1_loss,
-                type_diff=type_loss,
-                est_type_diff=est_type_loss,
-                time=fit_time,
-            )
-            visited_structs.append(struct)
-
-        # get the finalized best struct
-        struct_best = visited_structs[-1]
+        struct_best = AtomStruct(
+            coords=coords_best.detach(),
+            types=types_best.detach(),
+            typer=grid.typer,
+            L2_loss=L2_loss,
+            L1_loss=L1_loss,
+            type_diff=type_loss,
+            est_type_diff=est_type_loss,
+            time=time.time()-t_start,
+        )
+        visited_structs.finalize(
+            visit_id,
+            struct_best,
+            L2_loss=L2_loss,
+            L1_loss=L1_loss,
+            type_diff=type_loss,
+            est_type_diff=est_type_loss,
+        )
 
         # get the fit atomic density grid
-        grid_fit = grid_true.new_like(values=values_fit.detach())
-
-        mf = torch.cuda.max_memory_allocated()
+        grid_fit = grid_full.new_like(values=values_fit.detach())
+
+        # record statistics about the fitting process
+        fit_stats = dict(
+            fit_time=time.time() - t_start,
+            detect_time=timer.times.get('detect', 0.0),
+            expand_time=timer.times.get('expand', 0.0),
+            gd_time=timer.times.get('gd', 0.0),
+            n_gd_iters=n_gd_iters,
+            n_steps=len(beam_sizes),
+            beam_sizes=beam_sizes,
+            n_visited=visited_structs.n_visited,
+            n_init_atoms=n_init_atoms,
+            n_init_removed=n_init_removed,
+            n_refined=n_refined,
+            n_pruned=n_pruned,
+            n_duplicates=n_duplicates,
+            n_atoms=struct_best.n_atoms,
+            grid_size=grid_true.size,
+            coarse_time=coarse_time,
+            L2_loss=L2_loss.item(),
+            peak_memory=(
+                common.get_peak_memory(self.device)
+                    if self.track_memory else None
+            ),
+            device=str(self.device),
+        )
+        struct_best.info['fit_stats'] = fit_stats
 
-        if self.debug:
+        if self.debug and self.track_memory:
             MB = int(1024 ** 2)
-            print('GPU', mi//MB, [m//MB for m in ms], mf//MB)
+            print('memory', fit_stats['peak_memory'] // MB)
+
+        if self.trace_file:
+            self.write_trace(fit_stats)
 
         return struct_best, grid_fit, visited_structs
 
+    def write_trace(self, fit_stats):
+        '''
+        Append fit statistics as a line of JSON to
+        the trace file. Safe to call from multiple
+        worker threads.
+        '''
+        with trace_lock, open(self.trace_file, 'a') as f:
+            f.write(json.dumps(fit_stats) + '\n')
+
+    def fit_many(
+        self, grids, type_counts=None, init_structs=None, n_workers=None
+    ):
+        '''
+        Fit AtomStructs to a list of AtomGrids using a pool
+        of n_workers threads, each with a separate copy of
+        the fitter. Returns a list of (fit_struct, fit_grid,
+        visited_structs, fit_time) in the order of grids.
+
+        The peak memory statistic is process-wide, so with
+        multiple threads it is measured once around all of
+        the fits, and the fit_stats of each fit record that
+        shared peak (the trace file records None instead).
+        '''
+        if type_counts is None:
+            type_counts = [None] * len(grids)
+        if init_structs is None:
+            init_structs = [None] * len(grids)
+        assert len(type_counts) == len(grids), 'different lengths'
+        assert len(init_structs) == len(grids), 'different lengths'
+
+        if n_workers is None:
+            n_workers = self.n_workers
+        n_workers = max(1, min(n_workers, len(grids)))
+
+        # each worker thread takes a fitter from the queue
+        #   and returns it to the queue when it's done
+        fitters = queue.Queue()
+        fitters.put(self)
+        for i in range(n_workers-1):
+            fitters.put(self.worker_copy())
+
+        def fit(grid, type_counts, init_struct):
+            fitter = fitters.get()
+            try:
+                t_start = time.time()
+                fit_struct, fit_grid, visited_structs = \
+                    fitter.fit_struct(grid, type_counts, init_struct)
+                return (
+                    fit_struct,
+                    fit_grid,
+                    visited_structs,
+                    time.time() - t_start
+                )
+            finally:
+                fitters.put(fitter)
+
+        args = list(zip(grids, type_counts, init_structs))
+        if n_workers == 1:
+            return [fit(*a) for a in args]
+
+        track_memory = self.track_memory
+        for fitter in list(fitters.queue):
+            fitter.track_memory = False
+        try:
+            if track_memory:
+                common.reset_peak_memory(self.device)
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(fit, *a) for a in args]
+                results = [f.result() for f in futures]
+        finally:
+            self.track_memory = track_memory
+
+        if track_memory:
+            peak_memory = common.get_peak_memory(self.device)
+            for fit_struct, _, _, _ in results:
+                fit_struct.info['fit_stats']['peak_memory'] = peak_memory
+        return results
+
     def fit_batch(self, batch_values, center, resolution, typer):
 
-        fit_structs, fit_grids = [], []
-        for values in batch_values:
-            grid = AtomGrid(
+        grids = [
+            AtomGrid(
                 values=values.detach(),
                 center=center,
                 resolution=resolution,
                 typer=typer
-            )
-            fit_struct, fit_grid, _ = self.fit_struct(grid)
+            ) for values in batch_values
+        ]
+        fit_structs, fit_grids = [], []
+        for fit_struct, fit_grid, _, _ in self.fit_many(grids):
             fit_structs.append(fit_struct)
             fit_grids.append(fit_grid)
 
         return fit_structs, fit_grids
 
 
-class DkoesAtomFitter(AtomFitter):
+class VisitedStructs(object):
+    '''
+    A sequence of the structs visited during atom fitting.
+
+    If record is True, each visited struct is stored as a
+    delta from the struct that was expanded to visit it,
+    i.e. its coords after gradient descent and the types
+    of the atoms that were added. AtomStructs are created
+    lazily when they are accessed. Otherwise, only counts
+    the visited structs and stores the final struct.
+    '''
+    def __init__(self, typer, record=True):
+        self.typer = typer
+        self.record = record
+        self.n_visited = 0
+
+        self.parents = []
+        self.coords = []
+        self.types_added = []
+        self.times = []
+
+        # info shared by all visited structs
+        self.info = {}
+        self.structs = {}
+
+    def append(self, parent, coords, types_added, time):
+        '''
+        Add a visited struct that was derived from the
+        struct at index parent, and return its index.
+        '''
+        self.n_visited += 1
+        if not self.record:
+            return None
+
+        self.parents.append(parent)
+        self.coords.append(coords)
+        self.types_added.append(types_added)
+        self.times.append(time)
+        return len(self.times) - 1
 
-    def __init__(self, dkoes_make_mol, use_openbabel, iters=25, tol=0.01):
+    def finalize(self, parent, struct, **info):
+        '''
+        Add the final struct, derived from the struct at
+        index parent, and set the info that is shared by
+        all of the visited structs.
+        '''
+        index = self.append(
+            parent, struct.coords, struct.types[:0], struct.info['time']
+        )
+        if not self.record:
+            self.times = [struct.info['time']]
+            index = 0
+        self.structs[index] = struct
+        self.info = info
+
+    def get_types(self, index):
+        '''
+        Return the full type matrix of the struct at index
+        by accumulating the atoms added by its ancestors.
+        '''
+        types = []
+        while index is not None:
+            types.append(self.types_added[index])
+            index = self.parents[index]
+        return torch.cat(types[::-1])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not (0 <= index < len(self)):
+            raise IndexError('visited struct index out of range')
+
+        if index not in self.structs:
+            self.structs[index] = AtomStruct(
+                coords=self.coords[index],
+                types=self.get_types(index),
+                typer=self.typer,
+                time=self.times[index],
+                **self.info
+            )
+        return self.structs[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class PeakIndex(object):
+    '''
+    The atom detection values of a grid, along with the
+    max value in each cubic block of block_size points of
+    each channel, so that the top grid points can be found
+    by only sorting the points in the top blocks.
+
+    The index is immutable. Updating a box of grid points
+    returns a new index that only recomputes the maxima of
+    the blocks in the box, and shares the rest of its
+    block maxima with this index until they are updated.
+
+    The coords of the atoms where their density was last
+    updated in the index can also be stored, or None if
+    the index was computed for a single set of coords.
+    '''
+    def __init__(self, values, block_size, block_max=None, coords=None):
+        self.values = values
+        self.block_size = block_size
+        if block_max is None:
+            block_max = F.max_pool3d(
+                values.unsqueeze(0), block_size, ceil_mode=True
+            )[0]
+        self.block_max = block_max
+        self.coords = coords
+
+    @property
+    def n_blocks(self):
+        return self.block_max.numel()
+
+    def update(self, values, lo, hi, coords=None):
+        '''
+        Return a new index with the values in the box
+        of grid points from lo to hi (exclusive) replaced
+        by the provided values. The box must be aligned to
+        blocks, except at the upper edges of the grid.
+        The new index stores the given atom coords.
+        '''
+        b = self.block_size
+        (x0, y0, z0), (x1, y1, z1) = lo, hi
+        new_values = self.values.clone()
+        new_values[:,x0:x1,y0:y1,z0:z1] = values
+        block_max = self.block_max.clone()
+        block_max[:,x0//b:-(-x1//b),y0//b:-(-y1//b),z0//b:-(-z1//b)] = \
+            F.max_pool3d(values.unsqueeze(0), b, ceil_mode=True)[0]
+        return PeakIndex(new_values, b, block_max, coords)
+
+    def top_points(self, n_blocks, channels=None):
+        '''
+        Return the values and spatial and channel indices
+        of the grid points in the top n_blocks blocks that
+        are greater than the max value of all other blocks,
+        sorted from highest to lowest, which are therefore
+        the top grid points in the whole grid. Also returns
+        that max value of the other blocks. If channels is
+        not None, only blocks in those channels are used.
+        '''
+        b = self.block_size
+        n_c, n_x, n_y, n_z = self.values.shape
+        block_max = self.block_max
+        if channels is not None:
+            block_max = block_max.masked_fill(
+                ~channels.view(n_c, 1, 1, 1), -np.inf
+            )
+
+        # get the top blocks and the max value of the others
+        n_blocks = min(n_blocks, self.n_blocks)
+        top_max, idx = torch.topk(
+            block_max.flatten(), min(n_blocks + 1, self.n_blocks)
+        )
+        if n_blocks < self.n_blocks:
+            bound = top_max[n_blocks].item()
+        else:
+            bound = -np.inf
+        idx = idx[:n_blocks][top_max[:n_blocks] > -np.inf]
+
+        # get the points in the blocks, excluding beyond the grid
+        n_bx, n_by, n_bz = block_max.shape[1:]
+        idx_c, idx = idx // (n_bx*n_by*n_bz), idx % (n_bx*n_by*n_bz)
+        idx_xyz = torch.stack(
+            (idx // (n_by*n_bz), idx // n_bz % n_by, idx % n_bz), dim=1
+        ) * b
+        r = torch.arange(b, device=idx.device)
+        offsets = torch.stack(
+            torch.meshgrid(r, r, r, indexing='ij'), dim=-1
+        ).reshape(-1, 3)
+        idx_xyz = (idx_xyz.unsqueeze(1) + offsets).reshape(-1, 3)
+        idx_c = idx_c.repeat_interleave(len(offsets))
+        in_grid = (idx_xyz < idx_xyz.new_tensor([n_x, n_y, n_z])).all(dim=1)
+        idx_xyz, idx_c = idx_xyz[in_grid], idx_c[in_grid]
+
+        # sort the points in grid order, so that ties are broken
+        #   the same way as when sorting all of the grid points
+        idx_flat = ((idx_c*n_x + idx_xyz[:,0])*n_y + idx_xyz[:,1])*n_z \
+            + idx_xyz[:,2]
+        order = torch.argsort(idx_flat)
+        idx_xyz, idx_c = idx_xyz[order], idx_c[order]
+
+        # sort the points that are above the other blocks
+        values = self.values[idx_c, idx_xyz[:,0], idx_xyz[:,1], idx_xyz[:,2]]
+        values, order = torch.sort(values, descending=True, stable=True)
+        above = values > bound
+        order = order[above]
+        return values[above], idx_xyz[order], idx_c[order], bound
+
+
+class DkoesAtomFitter(AtomFitter):
+    '''
+    A one-shot algorithm for fitting atoms to density grids
+    without beam search.
+
+    The number of atoms of each element is inferred from
+    the total density of each island of density in the
+    element channels, and initial coords are selected by
+    weighted random sampling. The coords are optimized by
+    L-BFGS, batched across grids, and re-sampled for any
+    channels with a poor fit. Then atoms are added or moved
+    where density is missing. Properties are detected from
+    the grid, the same as AtomFitter.
+
+    Random sampling uses a generator seeded with seed, so
+    the fits made by a fitter are reproducible.
+    '''
+    def __init__(
+        self, iters=10, tol=0.01, island_threshold=0.5, seed=0, **kwargs
+    ):
+        super().__init__(**kwargs)
         self.iters = iters
         self.tol = tol
-        self.verbose=False
-        self.dkoes_make_mol = dkoes_make_mol
-        self.use_openbabel = use_openbabel
+        self.island_threshold = island_threshold
+        self.rng = np.random.default_rng(seed)
 
-    def fit(self, grid, types):
+    def fit_struct(self, grid, type_counts=None, init_struct=None):
+        '''
+        Fit an AtomStruct to an AtomGrid. The type_counts
+        and init_struct are ignored, since the number of
+        atoms is always inferred from the density.
+        '''
+        return self.fit_many([grid])[0][:3]
 
-        grid = AtomGrid(
-            values=grid.values,
-            channels=grid.channels,
-            center=grid.center,
-            resolution=grid.resolution,
-        )
+    def fit_many(
+        self, grids, type_counts=None, init_structs=None, n_workers=None
+    ):
+        '''
+        Fit AtomStructs to a list of AtomGrids, optimizing
+        grids of the same shape and resolution together.
+        Returns a list of (fit_struct, fit_grid, visited_
+        structs, fit_time) in the order of grids.
+        '''
+        grids = [g.to(self.device, dtype=torch.float32) for g in grids]
 
-        struct, grid_pred = \
-            dkoes_fitting.simple_atom_fit(
-                mgrid=grid,
-                types=types,
+        # group grids that can be fit in the same batch
+        batches = {}
+        for i, grid in enumerate(grids):
+            key = (grid.shape, grid.resolution, id(grid.typer))
+            batches.setdefault(key, []).append(i)
+
+        results = [None] * len(grids)
+        for batch_idx in batches.values():
+            t_start = time.time()
+            common.reset_peak_memory(self.device)
+
+            fits = dkoes_fitting.simple_atom_fit(
+                [grids[i] for i in batch_idx],
                 iters=self.iters,
                 tol=self.tol,
-                grm=1.0
+                threshold=self.island_threshold,
+                device=self.device,
+                rng=self.rng,
             )
+            for i, (coords, idx_c, _, fit_info) in zip(batch_idx, fits):
+                grid = grids[i]
+                types = F.one_hot(idx_c, grid.n_elem_channels).to(
+                    dtype=grid.dtype, device=self.device
+                )
+                if grid.typer.n_prop_types > 0: # detect atom properties
+                    types = torch.cat([types, *self.detect_properties(
+                        grid, grid.get_index(coords), idx_c
+                    )], dim=1)
+
+                # compute fit grid, including property channels
+                coords, values_fit, values_diff, L2_loss = self.gd(
+                    grid, coords, types, n_iters=0
+                )
+                struct = AtomStruct(
+                    coords=coords,
+                    types=types,
+                    typer=grid.typer,
+                    L2_loss=L2_loss,
+                    L1_loss=values_diff.abs().sum(),
+                    type_diff=np.nan,
+                    est_type_diff=np.nan,
+                    time=time.time() - t_start,
+                    iterations=fit_info['iterations'],
+                    numfixes=fit_info['numfixes'],
+                )
+                struct.info['fit_stats'] = dict(
+                    fit_time=struct.info['time'],
+                    n_visited=1,
+                    n_atoms=struct.n_atoms,
+                    L2_loss=L2_loss.item(),
+                    n_fixes=fit_info['numfixes'],
+                    peak_memory=common.get_peak_memory(self.device),
+                    device=str(self.device),
+                )
+                fit_grid = grid.new_like(values=values_fit)
+                results[i] = (struct, fit_grid, [struct], struct.info['time'])
 
-        struct.info['visited_structs'] = [struct]
-        self.validify(struct)
+        return results
 
-        grid_pred = AtomGrid(
-            values=grid_pred.cpu().detach().numpy(),
-            channels=grid.channels,
-            center=grid.center,
-            resolution=grid.resolution,
-            visited_structs=[struct],
-            src_struct=struct,
-        )        
 
-        return remove_tensors(grid_pred)
+def get_atom_fitter(fitter_type='beam', **kwargs):
+    '''
+    Create an atom fitter of the given type, either
+    'beam' for AtomFitter or 'dkoes' for DkoesAtomFitter.
+    '''
+    if fitter_type == 'beam':
+        return AtomFitter(**kwargs)
+    elif fitter_type == 'dkoes':
+        return DkoesAtomFitter(**kwargs)
+    else:
+        raise ValueError('unknown atom fitter type ' + repr(fitter_type))
 
 
 def remove_tensors(obj, visited=None):
@@ -868,6 +2102,154 @@ def one_hot_to_index(x):
         return torch.empty((0,), device=x.device)
 
 
+def get_patches(values, idx_xyz, size):
+    '''
+    Return the cubic patches of the grid values
+    of the given odd size centered at each of the
+    spatial indices idx_xyz, zero-padding beyond
+    the grid edges, as an (n_points, n_channels,
+    size**3) tensor.
+    '''
+    h = size // 2
+    values = F.pad(values, (h, h, h, h, h, h))
+    r = torch.arange(size, device=idx_xyz.device)
+    offsets = torch.stack(
+        torch.meshgrid(r, r, r, indexing='ij'), dim=-1
+    ).reshape(-1, 3)
+    idx_x, idx_y, idx_z = (
+        idx_xyz.long().unsqueeze(1) + offsets.unsqueeze(0)
+    ).unbind(dim=2)
+    return values[:, idx_x, idx_y, idx_z].permute(1, 0, 2)
+
+
+def get_struct_key(coords, types, cell_size):
+    '''
+    Return a hashable key for the set of atoms with the
+    given coords and types, that is the same for structs
+    with the same types and coords in the same cells of
+    cell_size, regardless of the order of the atoms.
+    '''
+    cells = torch.round(coords / cell_size).long()
+    atoms = torch.cat([cells, (types > 0.5).long()], dim=1)
+    return tuple(sorted(map(tuple, atoms.tolist())))
+
+
+def rank_in_channel(idx_c, n_c):
+    '''
+    Return the rank of each element of the channel
+    index idx_c among the elements in the same channel,
+    preserving the original order within channels.
+    '''
+    idx_c_sorted, order = torch.sort(idx_c, stable=True)
+    start = torch.searchsorted(
+        idx_c_sorted, torch.arange(n_c, device=idx_c.device)
+    )
+    rank = torch.empty_like(idx_c)
+    rank[order] = torch.arange(len(idx_c), device=idx_c.device) \
+        - start[idx_c_sorted]
+    return rank
+
+
+def suppress_non_max_hash(
+    coords, labels, min_dist, cell_size, max_count=None, chunk_size=1024
+):
+    '''
+    Greedily select points in the given order such that no
+    selected point is within min_dist of an earlier selected
+    point with the same label, and return a boolean mask of
+    the selected points. min_dist is given per point.
+
+    Selected points are stored in a spatial hash with cells
+    of cell_size, which must be at least the max min_dist,
+    so that only neighboring cells need to be searched. The
+    points are processed in vectorized chunks, and selection
+    can stop once max_count points have been selected.
+    '''
+    n_points = len(coords)
+    device = coords.device
+    selected = torch.zeros(n_points, dtype=torch.bool, device=device)
+    min_dist2 = min_dist**2
+
+    # non-negative integer cell index, including neighbor cells
+    cells = torch.floor(coords / cell_size).long()
+    cells = cells - cells.min(dim=0).values + 1
+    dims = cells.max(dim=0).values + 2
+
+    def hash_cells(labels, cells):
+        key = labels * dims[0] + cells[...,0]
+        key = key * dims[1] + cells[...,1]
+        return key * dims[2] + cells[...,2]
+
+    keys = hash_cells(labels, cells)
+    offsets = torch.tensor(
+        list(itertools.product([-1, 0, 1], repeat=3)), device=device
+    )
+    n_offsets = len(offsets)
+
+    # selected point indices, sorted by hash key
+    hash_keys = torch.zeros(0, dtype=torch.long, device=device)
+    hash_idx = torch.zeros(0, dtype=torch.long, device=device)
+
+    n_selected = 0
+    for i in range(0, n_points, chunk_size):
+        idx = torch.arange(i, min(i + chunk_size, n_points), device=device)
+        too_close = torch.zeros(len(idx), dtype=torch.bool, device=device)
+
+        if len(hash_idx) > 0: # compare to selected points in nearby cells
+
+            nbr_keys = hash_cells(
+                labels[idx].unsqueeze(1), cells[idx].unsqueeze(1) + offsets
+            ).flatten()
+            lo = torch.searchsorted(hash_keys, nbr_keys)
+            counts = torch.searchsorted(hash_keys, nbr_keys, right=True) - lo
+
+            # expand each neighbor cell into pairs with its points
+            query = torch.repeat_interleave(
+                torch.arange(len(nbr_keys), device=device), counts
+            )
+            starts = torch.cumsum(counts, dim=0) - counts
+            pos = torch.arange(len(query), device=device) \
+                - starts[query] + lo[query]
+            pair_i = idx[query // n_offsets]
+            pair_j = hash_idx[pos]
+
+            dist2 = ((coords[pair_i] - coords[pair_j])**2).sum(dim=1)
+            too_close[(pair_i - i)[dist2 < min_dist2[pair_i]]] = True
+
+        # greedily resolve conflicts with earlier points in the chunk,
+        #   which is the unique fixed point of the following update
+        same_label = (labels[idx].unsqueeze(1) == labels[idx].unsqueeze(0))
+        dist2 = ((coords[idx].unsqueeze(1) - coords[idx].unsqueeze(0))**2).sum(dim=2)
+        conflict = torch.tril(
+            same_label & (dist2 < min_dist2[idx].unsqueeze(1)), diagonal=-1
+        )
+        chunk_selected = ~too_close
+        while True:
+            new_selected = ~too_close & ~(
+                conflict & chunk_selected.unsqueeze(0)
+            ).any(dim=1)
+            if (new_selected == chunk_selected).all():
+                break
+            chunk_selected = new_selected
+
+        new_idx = idx[chunk_selected]
+        if max_count is not None:
+            new_idx = new_idx[:max_count - n_selected]
+        selected[new_idx] = True
+        n_selected += len(new_idx)
+
+        if max_count is not None and n_selected >= max_count:
+            break
+
+        # add the new selected points to the hash
+        hash_keys = torch.cat([hash_keys, keys[new_idx]])
+        hash_idx = torch.cat([hash_idx, new_idx])
+        hash_keys, sort_idx = torch.sort(hash_keys)
+        hash_idx = hash_idx[sort_idx]
+
+    return selected
+
+
 def conv_grid(grid, kernel):
     # convolution theorem: g * grid = F-1(F(g)F(grid))
     F_h = np.fft.fftn(kernel)
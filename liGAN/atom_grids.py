@@ -146,6 +146,77 @@ class AtomGrid(object):
             self.resolution
         )
 
+    def get_index(self, coords):
+        '''
+        Return the (x,y,z) spatial index of the
+        grid point nearest to each of the provided
+        3D coordinates, clamped to the grid bounds.
+        '''
+        return coords_to_spatial_index(
+            coords,
+            self.center,
+            self.size,
+            self.resolution
+        )
+
+    def crop(self, threshold, padding=0):
+        '''
+        Return the smallest cubic sub-grid that contains
+        every grid point where any channel is above the
+        threshold, extended by padding grid points on
+        each side. The sub-grid has the same resolution
+        and grid point coordinates as this grid.
+        '''
+        above = (self.values > threshold).any(dim=0)
+        if not above.any(): # nothing to crop to
+            return self
+
+        # bounding box of grid points above threshold
+        lo, hi = [], []
+        for dims in [(1, 2), (0, 2), (0, 1)]:
+            idx = torch.nonzero(above.any(dim=dims[1]).any(dim=dims[0]))
+            lo.append(int(idx[0]))
+            hi.append(int(idx[-1]))
+
+        # center the padded box in a cube that fits within the grid
+        size = min(max(h - l + 1 for l, h in zip(lo, hi)) + 2*padding, self.size)
+        start = [
+            min(max((l + h + 1 - size) // 2, 0), self.size - size)
+                for l, h in zip(lo, hi)
+        ]
+        if size == self.size:
+            return self
+
+        x, y, z = start
+        values = self.values[:, x:x+size, y:y+size, z:z+size]
+        center = self.get_coords(
+            torch.as_tensor(start, device=self.device) + (size - 1) / 2
+        )
+        return AtomGrid(
+            values=values,
+            center=center,
+            resolution=self.resolution,
+            typer=self.typer,
+            **self.info
+        )
+
+    def downsample(self, factor):
+        '''
+        Return a grid with factor times lower resolution
+        by taking every factor-th grid point along each
+        axis, starting from the origin, so that values
+        are sampled the same way that atom density is.
+        '''
+        values = self.values[:, ::factor, ::factor, ::factor]
+        resolution = self.resolution * factor
+        size = values.shape[1]
+        return AtomGrid(
+            values=values,
+            center=self.origin + size_to_dimension(size, resolution) / 2,
+            resolution=resolution,
+            typer=self.typer,
+            **self.info
+        )
 
 def center_to_origin(center, size, resolution):
     '''
@@ -174,6 +245,19 @@ def spatial_index_to_coords(idx_xyz, center, size, resolution):
     return origin + resolution * idx_xyz.float()
 
 
+def coords_to_spatial_index(coords, center, size, resolution):
+    '''
+    Compute the (x,y,z) spatial indices of the
+    grid points nearest to each of the provided
+    3D coordinates, in a grid with center, size,
+    and resolution. Indices outside the grid are
+    clamped to the grid bounds.
+    '''
+    origin = center_to_origin(center, size, resolution)
+    idx_xyz = torch.round((coords - origin) / resolution).long()
+    return idx_xyz.clamp(0, size-1)
+
+
 def size_to_dimension(size, resolution):
     '''
     Compute the side length of a cubic grid with
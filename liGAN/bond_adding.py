@@ -1,12 +1,15 @@
-import sys, os, pickle
+import sys, os, pickle, itertools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from openbabel import openbabel as ob
 from openbabel import pybel
 from rdkit import Chem, Geometry
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial import cKDTree
+import torch
 
 from . import molecules as mols
-from .atom_types import Atom
+from .atom_types import Atom, AtomTyper
+from .atom_structs import AtomStruct
 from .molecules import ob_mol_to_rd_mol, Molecule, copy_ob_mol
 
 
@@ -28,6 +31,7 @@ class BondAdder(object):
         max_bond_len=4.0,
         max_bond_stretch=0.45,
         min_bond_angle=45,
+        n_workers=1,
         debug=False,
     ):
         self.min_bond_len = min_bond_len
@@ -36,8 +40,53 @@ class BondAdder(object):
         self.max_bond_stretch = max_bond_stretch
         self.min_bond_angle = min_bond_angle
 
+        # number of processes for adding bonds to multiple structs,
+        #   which are started on the first batch and kept until close
+        self.n_workers = n_workers
+        self.pool = None
+        self.pool_workers = 0
+
         self.debug = debug
 
+    def __getstate__(self):
+        # the adder is sent to the workers, but its pool can't be
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['pool_workers'] = 0
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_pool(self, n_workers):
+        '''
+        Return a pool of n_workers processes, reusing
+        the current pool if it has the same size. The
+        workers are spawned rather than forked, so they
+        never inherit CUDA state from the caller.
+        '''
+        if self.pool is not None and self.pool_workers != n_workers:
+            self.close()
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            self.pool_workers = n_workers
+        return self.pool
+
+    def close(self):
+        '''
+        Shut down the worker processes, if any.
+        '''
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+            self.pool_workers = 0
+
     def disable_perception(self, ob_mol):
         '''
         Set flags that prevent openbabel perception
@@ -140,21 +189,14 @@ class BondAdder(object):
         Add bonds between every pair of atoms
         that are within a certain distance.
         '''
-        # just do n^2 comparisons, worry about efficiency later
         coords = np.array([(a.GetX(), a.GetY(), a.GetZ()) for a in atoms])
-        dists = squareform(pdist(coords))
 
-        # for every pairs of atoms in ob_mol,
-        for i, atom_a in enumerate(atoms):
-            for j, atom_b in enumerate(atoms):
-                if i >= j: # avoid redundant checks
-                    continue
-
-                # if they are within min and max bond length,
-                if self.min_bond_len < dists[i,j] < self.max_bond_len:
-
-                    # add a single bond between the atoms
-                    ob_mol.AddBond(atom_a.GetIdx(), atom_b.GetIdx(), 1)
+        # for every pair of atoms within min and max bond length,
+        for i, j in get_pairs_within_distance(
+            coords, self.min_bond_len, self.max_bond_len
+        ):
+            # add a single bond between the atoms
+            ob_mol.AddBond(atoms[i].GetIdx(), atoms[j].GetIdx(), 1)
 
     def remove_bad_valences(self, ob_mol, atoms, struct):
         '''
@@ -163,55 +205,10 @@ class BondAdder(object):
         Also remove bonds between halogens/hydrogens.
         '''
         # get max valence of the atoms
-        max_vals = get_max_valences(atoms)
-
-        # remove any bonds between halogens or hydrogens
-        for bond in ob.OBMolBondIter(ob_mol):
-            atom_a = bond.GetBeginAtom()
-            atom_b = bond.GetEndAtom()
-            if (
-                max_vals.get(atom_a.GetIdx(), 1) == 1 and
-                max_vals.get(atom_b.GetIdx(), 1) == 1
-            ):
-                ob_mol.DeleteBond(bond)
+        table = BondTable.from_ob_mol(ob_mol)
+        max_vals = table.get_max_valences(atoms)
 
-        # remove bonds causing larger-than-permitted valences
-        #   prioritize atoms with lowest max valence, since they
-        #   place the hardest constraint on reachability (e.g O)
-
-        atom_info = sort_atoms_by_valence(atoms, max_vals)
-        for max_val, rem_val, atom in atom_info:
-
-            if atom.GetExplicitValence() <= max_val:
-                continue
-            # else, the atom could have an invalid valence
-            #   so check whether we can modify a bond
-
-            bond_info = sort_bonds_by_stretch(ob.OBAtomBondIter(atom))
-            for bond_stretch, bond_len, bond in bond_info:
-
-                # do the atoms involved in this bond have bad valences?
-                #   since we are modifying the valences in the loop, this
-                #   could have changed since calling sort_atoms_by_valence
-
-                a1, a2 = bond.GetBeginAtom(), bond.GetEndAtom()
-                max_val_diff = max( # by how much are the valences over?
-                    a1.GetExplicitValence() - max_vals.get(a1.GetIdx(), 1),
-                    a2.GetExplicitValence() - max_vals.get(a2.GetIdx(), 1)
-                )
-                if max_val_diff > 0:
-
-                    bond_order = bond.GetBondOrder()
-                    if bond_order > max_val_diff: # decrease bond order
-                        bond.SetBondOrder(bond_order - max_val_diff)
-
-                    elif reachable(a1, a2): # don't fragment the molecule
-                        ob_mol.DeleteBond(bond)
-
-                    # if the current atom now has a permitted valence,
-                    # break and let other atoms choose next bonds to remove
-                    if atom.GetExplicitValence() <= max_vals[atom.GetIdx()]:
-                        break
+        table.remove_bad_valences([a.GetIdx()-1 for a in atoms], max_vals)
 
         # deleting bonds resets this flag
         ob_mol.SetHybridizationPerceived(True)
@@ -223,23 +220,8 @@ class BondAdder(object):
         the most stretch bonds.
         '''
         # eliminate geometrically poor bonds
-        bond_info = sort_bonds_by_stretch(ob.OBMolBondIter(ob_mol))
-        for bond_stretch, bond_len, bond in bond_info:
-
-            # can we remove this bond without disconnecting the molecule?
-            atom1 = bond.GetBeginAtom()
-            atom2 = bond.GetEndAtom()
-
-            # as long as we aren't disconnecting, let's remove things
-            #   that are excessively far away (0.45 from ConnectTheDots)
-            # get bonds to be less than max allowed
-            # also remove tight angles, as done in openbabel
-            if (bond_stretch > self.max_bond_stretch
-                or forms_small_angle(atom1, atom2, self.min_bond_angle)
-                or forms_small_angle(atom2, atom1, self.min_bond_angle)
-            ):
-                if reachable(atom1, atom2): # don't fragment the molecule
-                    ob_mol.DeleteBond(bond)
+        table = BondTable.from_ob_mol(ob_mol, self.min_bond_angle)
+        table.remove_bad_geometry(self.max_bond_stretch)
 
         # deleting bonds resets this flag
         ob_mol.SetHybridizationPerceived(True)
@@ -251,7 +233,8 @@ class BondAdder(object):
         amount according to openbabel, and then fill
         remaining empty valences with higher bond orders.
         '''
-        max_vals = get_max_valences(atoms)
+        table = BondTable.from_ob_mol(ob_mol)
+        max_vals = table.get_max_valences(atoms)
 
         for ob_atom, atom_type in zip(atoms, struct.atom_types):
           
@@ -259,7 +242,7 @@ class BondAdder(object):
                 # all Hs should already be present
                 continue
 
-            max_val = max_vals.get(ob_atom.GetIdx(), 1)
+            atom = ob_atom.GetIdx() - 1
 
             if Atom.h_count in struct.typer:
                 # this should have already been set
@@ -269,7 +252,7 @@ class BondAdder(object):
                     n = ob_atom.GetImplicitHCount()
                     ob_atom.SetImplicitHCount(n + atom_type.h_count - h_count)
 
-            elif ob_atom.GetExplicitValence() < max_val:
+            elif table.valences[atom] < max_vals[atom]:
                 # this uses explicit valence and formal charge,
                 #   and only ever INCREASES hydrogens, since it
                 #   never sets implicit H to a negative value
@@ -281,42 +264,10 @@ class BondAdder(object):
                 ob_atom.SetImplicitHCount(n)
 
         # these have possibly changed
-        max_vals = get_max_valences(atoms)
+        max_vals = table.get_max_valences(atoms)
 
         # now increment bond orders to fill remaining valences
-        atom_info = sort_atoms_by_valence(atoms, max_vals)
-        for max_val, rem_val, atom in reversed(atom_info):
-
-            if atom.GetExplicitValence() >= max_val:
-                continue
-            # else, the atom could have an empty valence
-            #   so check whether we can augment a bond,
-            #   prioritizing bonds that are too short
-
-            bond_info = sort_bonds_by_stretch(ob.OBAtomBondIter(atom))
-            for bond_stretch, bond_len, bond in reversed(bond_info):
-
-                if bond.GetBondOrder() >= 3:
-                    continue # don't go above triple
-
-                # do the atoms involved in this bond have empty valences?
-                #   since we are modifying the valences in the loop, this
-                #   could have changed since calling sort_atoms_by_valence
-
-                a1, a2 = bond.GetBeginAtom(), bond.GetEndAtom()
-                min_val_diff = min( # by how much are the valences under?
-                    max_vals.get(a1.GetIdx(), 1) - a1.GetExplicitValence(),
-                    max_vals.get(a2.GetIdx(), 1) - a2.GetExplicitValence()
-                )
-                if min_val_diff > 0: # increase bond order
-
-                    bond_order = bond.GetBondOrder() # don't go above triple
-                    bond.SetBondOrder(min(bond_order + min_val_diff, 3))
-
-                    # if the current atom now has its preferred valence,
-                    #   break and let other atoms choose next bonds to augment
-                    if atom.GetExplicitValence() == max_vals[atom.GetIdx()]:
-                        break
+        table.fill_rem_valences([a.GetIdx()-1 for a in atoms], max_vals)
 
     def make_h_explicit(self, ob_mol, atoms):
         '''
@@ -335,17 +286,21 @@ class BondAdder(object):
         # AddHydrogens() resets some flags
         self.disable_perception(ob_mol)
 
-    def add_bonds(self, ob_mol, atoms, struct):
+    def add_bonds(self, ob_mol, atoms, struct, visited=True):
 
-        # track each step of bond adding
+        # track each step of bond adding, but only
+        #   copy the molecule at each step if visited
         visited_mols = []
+        n_steps = 0
 
         def visit_mol(mol, msg):
-            mol = copy_ob_mol(mol)
-            visited_mols.append(mol)
+            nonlocal n_steps
+            n_steps += 1
+            if visited:
+                visited_mols.append(copy_ob_mol(mol))
             if self.debug:
                 bmap = {1:'-', 2:'=', 3:'≡'}
-                print(len(visited_mols), msg)
+                print(n_steps, msg)
                 assert (
                     mol.HasHybridizationPerceived() and 
                     mol.HasAromaticPerceived()
@@ -533,13 +488,13 @@ class BondAdder(object):
         ob_mol, atoms = struct.to_ob_mol()
 
         # add bonds and hydrogens, maintaining atomic properties
-        ob_mol, visited_mols = self.add_bonds(ob_mol, atoms, struct)
+        ob_mol, visited_mols = self.add_bonds(ob_mol, atoms, struct, visited)
 
         # convert ob_mol to rd_mol with minimal processing
         add_mol = Molecule.from_ob_mol(ob_mol)
 
         # convert output mol back to struct, to see if types match
-        add_struct = struct.typer.make_struct(ob_mol)
+        add_struct = struct.typer.make_struct(ob_mol, device=struct.device)
 
         if visited:
             visited_mols = [
@@ -550,17 +505,359 @@ class BondAdder(object):
         else:
             return add_mol, add_struct
 
-    def make_batch(self, structs):
+    def make_batch(self, structs, n_workers=None):
+        '''
+        Create Molecules with added bonds from a list of
+        AtomStructs using a pool of n_workers processes,
+        which is kept for later batches until close().
+        Returns lists of the Molecules and the AtomStructs
+        of their atom types in the order of structs.
+        '''
+        if n_workers is None:
+            n_workers = self.n_workers
 
         add_mols, add_structs = [], []
-        for struct in structs:
-            add_mol, add_struct = self.make_mol(struct, visited=False)
+        if min(n_workers, len(structs)) <= 1:
+            for struct in structs:
+                add_mol, add_struct = self.make_mol(struct, visited=False)
+                add_mols.append(add_mol)
+                add_structs.append(add_struct)
+            return add_mols, add_structs
+
+        # OBMols and AtomTypers can't be pickled, so send
+        #   coord and type arrays to the worker processes
+        pool = self.get_pool(n_workers)
+        futures = [
+            pool.submit(
+                make_mol_from_arrays,
+                self,
+                struct.coords.cpu().numpy(),
+                struct.types.cpu().numpy(),
+                struct.typer.prop_funcs,
+                struct.typer.prop_ranges,
+                struct.typer.explicit_h,
+            ) for struct in structs
+        ]
+        for struct, future in zip(structs, futures):
+            add_mol, add_coords, add_types = future.result()
             add_mols.append(add_mol)
-            add_structs.append(add_struct)
+            add_structs.append(AtomStruct(
+                coords=add_coords,
+                types=add_types,
+                typer=struct.typer,
+                dtype=struct.dtype,
+                device=struct.device,
+            ))
 
         return add_mols, add_structs
 
 
+class RDKitBondAdder(BondAdder):
+    '''
+    An algorithm for constructing a valid molecule
+    from a structure of atomic coordinates and types
+    using RDKit and numpy arrays, without OBMols.
+
+    It adds and removes bonds in the same way as the
+    BondAdder, using the atom properties defined by
+    the atom types as constraints. Then it assigns
+    bond orders based on hybridization perceived from
+    the bond angles and lengths, and fills remaining
+    valences with hydrogens.
+
+    The molecule is only created at the end, so no
+    conversions between toolkits are needed.
+    '''
+    def perceive_hybridization(self, table, aromatic):
+        '''
+        Return an array of the hybridization of each
+        atom (1 for sp, 2 for sp2 or 3 for sp3) based
+        on its mean bond angle, or the length of its
+        bond if it only has one, as in openbabel.
+        Aromatic atoms are always sp2.
+        '''
+        # vertex atom and end atoms of each bond angle
+        angles = []
+        for vertex in range(table.n_atoms):
+            nbrs = [
+                j if i == vertex else i
+                    for i, j in table.pairs[table.atom_bonds[vertex]]
+            ]
+            for end1, end2 in itertools.combinations(nbrs, 2):
+                angles.append((vertex, end1, end2))
+
+        mean_angles = np.zeros(table.n_atoms)
+        if angles:
+            vertex, end1, end2 = np.array(angles).T
+            v1 = table.coords[end1] - table.coords[vertex]
+            v2 = table.coords[end2] - table.coords[vertex]
+            mag = np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)
+            cos = (v1 * v2).sum(axis=1) / np.where(mag > 0, mag, 1)
+            degrees = np.degrees(np.arccos(np.clip(cos, -1, 1)))
+            n_angles = np.bincount(vertex, minlength=table.n_atoms)
+            mean_angles = np.bincount(
+                vertex, weights=degrees, minlength=table.n_atoms
+            ) / np.maximum(n_angles, 1)
+
+        hybs = np.full(table.n_atoms, 3)
+        hybs[mean_angles > 115] = 2
+        hybs[mean_angles > 155] = 1
+
+        # terminal atoms use how much shorter their bond is
+        #   than a single bond, since they have no angles
+        for atom in np.flatnonzero(table.degrees == 1):
+            stretch = table.stretches[table.atom_bonds[atom][0]]
+            if stretch < -0.25:
+                hybs[atom] = 1
+            elif stretch < -0.05:
+                hybs[atom] = 2
+
+        hybs[aromatic] = 2
+        return hybs
+
+    def assign_bond_orders(self, table, hybs, aromatic, max_vals, h_counts):
+        '''
+        Increment the orders of bonds between atoms
+        that have unsaturated valences according to
+        their hybridization, or any remaining valence
+        for elements that can be hypervalent (e.g. P, S).
+
+        Bonds between aromatic atoms are assigned first,
+        then bonds of atoms with the fewest unsaturated
+        neighbors, prioritizing atoms with the lowest max
+        valence and then the shortest bonds.
+        '''
+        rem_vals = np.maximum(max_vals - h_counts - table.valences, 0)
+        unsat = np.where(table.atomic_nums > 10, rem_vals, 3 - hybs)
+        unsat = np.minimum(unsat, rem_vals)
+
+        for aromatic_only in (True, False):
+            while True:
+                bonds = np.array(table.bonds(), dtype=int)
+                a1, a2 = table.pairs[bonds].T
+                is_cand = (
+                    (unsat[a1] > 0) & (unsat[a2] > 0) & (table.orders[bonds] < 3)
+                )
+                if aromatic_only:
+                    is_cand &= aromatic[a1] & aromatic[a2]
+                if not is_cand.any():
+                    break
+
+                # bond of the atom with the fewest candidate bonds,
+                #   then lowest max valence, that is shortest
+                #   relative to a single bond
+                bonds, a1, a2 = bonds[is_cand], a1[is_cand], a2[is_cand]
+                n_cands = np.bincount(
+                    np.concatenate([a1, a2]), minlength=table.n_atoms
+                )
+                bond = bonds[np.lexsort((
+                    table.stretches[bonds],
+                    np.minimum(max_vals[a1], max_vals[a2]),
+                    np.minimum(n_cands[a1], n_cands[a2]),
+                ))[0]]
+
+                i, j = table.pairs[bond]
+                n = min(unsat[i], unsat[j], 3 - table.orders[bond])
+                table.set_bond_order(bond, table.orders[bond] + n)
+                unsat[[i, j]] -= n
+
+    def make_rd_mol(self, table, formal_charges, h_counts):
+        '''
+        Create an RWMol from the atoms and bonds in
+        the table, with the formal charges and the
+        numbers of hydrogens given for each atom.
+        '''
+        rd_mol = Chem.RWMol()
+        rd_conf = Chem.Conformer(table.n_atoms)
+
+        for i in range(table.n_atoms):
+            rd_atom = Chem.Atom(int(table.atomic_nums[i]))
+            rd_atom.SetFormalCharge(int(formal_charges[i]))
+            rd_atom.SetNumExplicitHs(int(h_counts[i]))
+            rd_atom.SetNoImplicit(True) # don't use rdkit valence model
+            rd_mol.AddAtom(rd_atom)
+            rd_conf.SetAtomPosition(i, table.coords[i].tolist())
+
+        rd_mol.AddConformer(rd_conf)
+
+        bond_types = {
+            1: Chem.BondType.SINGLE,
+            2: Chem.BondType.DOUBLE,
+            3: Chem.BondType.TRIPLE,
+        }
+        for bond in table.bonds():
+            i, j = table.pairs[bond]
+            rd_mol.AddBond(int(i), int(j), bond_types[table.orders[bond]])
+
+        Chem.GetSSSR(rd_mol) # initialize ring info
+        rd_mol.UpdatePropertyCache(strict=False) # compute valence
+        return rd_mol
+
+    def make_struct(self, rd_mol, struct):
+        '''
+        Convert an RDKit mol to an AtomStruct by
+        assigning each atom a type vector based
+        on its atomic properties in RDKit.
+        '''
+        typer = struct.typer
+        types = np.zeros((rd_mol.GetNumAtoms(), typer.n_types))
+        for i, rd_atom in enumerate(rd_mol.GetAtoms()):
+            if not typer.explicit_h and rd_atom.GetAtomicNum() == 1:
+                continue
+            prop_values = tuple(
+                rd_atom_props[f.__name__](rd_atom) for f in typer.prop_funcs
+            )
+            types[i] = typer.get_type_vec_from_prop_values(prop_values)
+
+        return AtomStruct(
+            coords=rd_mol.GetConformer().GetPositions(),
+            types=types,
+            typer=typer,
+            dtype=torch.float32,
+            device=struct.device,
+            src_mol=rd_mol,
+        )
+
+    def make_mol(self, struct, visited=True):
+        '''
+        Create a Molecule from an AtomStruct with added
+        bonds, trying to maintain the same atom types.
+        '''
+        typer = struct.typer
+        atom_types = struct.atom_types
+        n_atoms = len(atom_types)
+        atoms = list(range(n_atoms))
+        coords = struct.coords.cpu().numpy().astype(float)
+
+        formal_charges = np.zeros(n_atoms, dtype=int)
+        if Atom.formal_charge in typer:
+            formal_charges[:] = [t.formal_charge for t in atom_types]
+
+        aromatic = np.zeros(n_atoms, dtype=bool)
+        if Atom.aromatic in typer:
+            aromatic[:] = [t.aromatic for t in atom_types]
+
+        # get minimum H counts required by atom types
+        min_h_counts = np.zeros(n_atoms, dtype=int)
+        if typer.explicit_h:
+            pass # all Hs should already be explicit
+        elif Atom.h_count in typer:
+            min_h_counts[:] = [t.h_count for t in atom_types]
+        elif Atom.h_donor in typer:
+            min_h_counts[:] = [t.h_donor for t in atom_types]
+
+        # track each step of bond adding, but only
+        #   create a molecule at each step if visited
+        visited_mols = []
+
+        def visit_mol(table, h_counts):
+            if visited:
+                visited_mols.append(Molecule(
+                    self.make_rd_mol(table, formal_charges, h_counts)
+                ))
+
+        # add all bonds between atom pairs within a distance range
+        table = BondTable(
+            coords=coords,
+            atomic_nums=[t.atomic_num for t in atom_types],
+            pairs=get_pairs_within_distance(
+                coords, self.min_bond_len, self.max_bond_len
+            ),
+            min_bond_angle=self.min_bond_angle,
+        )
+        visit_mol(table, min_h_counts)
+
+        # remove bonds to atoms that are above their allowed valence
+        #   with priority towards removing highly stretched bonds
+        max_vals = table.calc_max_valences(atoms, formal_charges, min_h_counts)
+        table.remove_bad_valences(atoms, max_vals)
+        visit_mol(table, min_h_counts)
+
+        # remove bonds with excessively distorted lengths/angles
+        table.remove_bad_geometry(self.max_bond_stretch)
+        visit_mol(table, min_h_counts)
+
+        # increase bond orders based on perceived hybridization
+        hybs = self.perceive_hybridization(table, aromatic)
+        max_vals = table.calc_max_valences(
+            atoms, formal_charges, np.zeros(n_atoms, dtype=int)
+        )
+        self.assign_bond_orders(table, hybs, aromatic, max_vals, min_h_counts)
+        visit_mol(table, min_h_counts)
+
+        # fill remaining valences with hydrogens, using
+        #   the num expected by the atom types if available
+        if typer.explicit_h or Atom.h_count in typer:
+            h_counts = min_h_counts
+        else:
+            h_counts = np.maximum(min_h_counts, max_vals - table.valences)
+            h_counts[table.atomic_nums == 1] = 0
+
+        rd_mol = self.make_rd_mol(table, formal_charges, h_counts)
+        rd_mol = Chem.RWMol(Chem.AddHs(rd_mol, addCoords=True))
+        try: # this perceives aromaticity
+            Chem.SanitizeMol(rd_mol)
+        except Chem.MolSanitizeException:
+            pass
+
+        add_mol = Molecule(rd_mol)
+        add_struct = self.make_struct(add_mol, struct)
+
+        if visited:
+            visited_mols.append(add_mol)
+            return add_mol, add_struct, visited_mols
+        else:
+            return add_mol, add_struct
+
+
+def get_bond_adder(adder_type='ob', **kwargs):
+    '''
+    Create a bond adder of the given type, either
+    'ob' for BondAdder or 'rdkit' for RDKitBondAdder.
+    '''
+    if adder_type == 'ob':
+        return BondAdder(**kwargs)
+    elif adder_type == 'rdkit':
+        return RDKitBondAdder(**kwargs)
+    else:
+        raise ValueError('unknown bond adder type ' + repr(adder_type))
+
+
+def make_mol_from_arrays(
+    bond_adder, coords, types, prop_funcs, prop_ranges, explicit_h
+):
+    '''
+    Create a Molecule with added bonds from arrays of
+    atom coords and types in a worker process. Returns
+    the Molecule and the coords and types of its atoms.
+    '''
+    typer = AtomTyper(
+        prop_funcs, prop_ranges, Atom.cov_radius, explicit_h, device='cpu'
+    )
+    struct = AtomStruct(coords, types, typer, device='cpu')
+    add_mol, add_struct = bond_adder.make_mol(struct, visited=False)
+
+    # the source OBMol can't be pickled
+    add_mol.info.pop('ob_mol', None)
+    return add_mol, add_struct.coords.numpy(), add_struct.types.numpy()
+
+
+def get_pairs_within_distance(coords, min_dist, max_dist):
+    '''
+    Return an array of the index pairs (i, j) with i < j
+    of the coords that are strictly between min_dist and
+    max_dist apart, in lexicographic order. Uses a k-d tree
+    so that only nearby pairs of coords are compared.
+    '''
+    if len(coords) < 2:
+        return np.zeros((0, 2), dtype=int)
+
+    pairs = cKDTree(coords).query_pairs(max_dist, output_type='ndarray')
+    dists = np.linalg.norm(coords[pairs[:,0]] - coords[pairs[:,1]], axis=1)
+    pairs = pairs[(min_dist < dists) & (dists < max_dist)]
+    return pairs[np.lexsort((pairs[:,1], pairs[:,0]))]
+
+
 def calc_valence(rd_atom):
     '''
     Can call GetExplicitValence before sanitize,
@@ -627,46 +924,417 @@ def reachable(atom_a, atom_b):
     )
 
 
-def forms_small_angle(atom_a, atom_b, cutoff=45):
+def find_bridges(n_atoms, bonds):
     '''
-    Return whether bond between atom_a and atom_b
-    is part of a small angle with a neighbor of a
-    only.
+    Return a boolean array indicating which bonds, given
+    as an (n_bonds, 2) array of 0-based atom indices, are
+    bridges, i.e. not part of any ring, so that removing
+    them would fragment the molecule. Uses an iterative
+    version of Tarjan's algorithm, in linear time.
     '''
-    for nbr in ob.OBAtomAtomIter(atom_a):
-        if nbr != atom_b:
-            degrees = atom_b.GetAngle(atom_a, nbr)
-            if degrees < cutoff:
-                return True
-    return False
-
-
-def sort_bonds_by_stretch(bonds, absolute=True):
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    n_bonds = len(bonds)
+
+    # adjacency list of neighbor atoms and bond indices
+    ends = np.concatenate([bonds[:,0], bonds[:,1]])
+    order = np.argsort(ends, kind='stable')
+    nbrs = np.concatenate([bonds[:,1], bonds[:,0]])[order].tolist()
+    bond_idx = np.tile(np.arange(n_bonds), 2)[order].tolist()
+    starts = np.searchsorted(ends[order], np.arange(n_atoms+1)).tolist()
+
+    disc = [-1] * n_atoms # discovery time of each atom
+    low = [0] * n_atoms # lowest discovery time reachable from subtree
+    is_bridge = np.zeros(n_bonds, dtype=bool)
+    clock = 0
+
+    for root in range(n_atoms):
+        if disc[root] >= 0:
+            continue
+        disc[root] = low[root] = clock
+        clock += 1
+
+        # stack of (atom, bond to parent, next adjacency index)
+        stack = [(root, -1, starts[root])]
+        while stack:
+            v, parent_bond, i = stack[-1]
+            if i < starts[v+1]:
+                stack[-1] = (v, parent_bond, i+1)
+                w, b = nbrs[i], bond_idx[i]
+                if b == parent_bond:
+                    continue
+                if disc[w] < 0: # tree edge
+                    disc[w] = low[w] = clock
+                    clock += 1
+                    stack.append((w, b, starts[w]))
+                else: # back edge
+                    low[v] = min(low[v], disc[w])
+            else:
+                stack.pop()
+                if stack:
+                    u = stack[-1][0]
+                    low[u] = min(low[u], low[v])
+                    if low[v] > disc[u]:
+                        is_bridge[parent_bond] = True
+
+    return is_bridge
+
+
+class BondTable(object):
     '''
-    Return bonds sorted by their distance
-    from the optimal covalent bond length,
-    and their actual bond length, with the
-    most stretched and longest bonds first.
+    Arrays of the atom and bond properties of a molecule
+    that are used to remove bonds and fill valences, i.e.
+    the bond lengths, ideal lengths, stretches and small
+    angle flags, and the atom degrees and valences.
+
+    They are computed once with numpy and then updated
+    as bonds are modified via the table, which are also
+    applied to the OBMol that the table was read from,
+    if any, so that it makes few calls to openbabel.
+    Bonds are referred to by their row in the table,
+    and atoms by their 0-based index in the molecule.
     '''
-    bond_info = []
-    for bond in bonds:
-
-        # compute how far away from optimal we are
-        atomic_num1 = bond.GetBeginAtom().GetAtomicNum()
-        atomic_num2 = bond.GetEndAtom().GetAtomicNum()
-        ideal_bond_len = (
-            ob.GetCovalentRad(atomic_num1) +
-            ob.GetCovalentRad(atomic_num2)
+    def __init__(
+        self,
+        coords,
+        atomic_nums,
+        pairs,
+        orders=None,
+        min_bond_angle=45,
+        ob_mol=None,
+        ob_bonds=None,
+    ):
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        self.atomic_nums = np.asarray(atomic_nums, dtype=int)
+        self.n_atoms = n_atoms = len(self.atomic_nums)
+        self.min_bond_angle = min_bond_angle
+
+        self.pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+        if orders is None:
+            orders = np.ones(len(self.pairs), dtype=int)
+        self.orders = np.array(orders, dtype=int)
+        self.active = np.ones(len(self.pairs), dtype=bool)
+
+        self.ob_mol = ob_mol
+        self.ob_bonds = ob_bonds
+
+        # bond rows of each atom, in the order they were added
+        self.atom_bonds = [[] for i in range(n_atoms)]
+        for k, (i, j) in enumerate(self.pairs.tolist()):
+            self.atom_bonds[i].append(k)
+            self.atom_bonds[j].append(k)
+
+        # compute how far away from optimal the bonds are
+        cov_radii = {
+            n: ob.GetCovalentRad(int(n)) for n in np.unique(self.atomic_nums)
+        }
+        radii = np.array(
+            [cov_radii[n] for n in self.atomic_nums], dtype=float
+        )
+        self.lengths = np.linalg.norm(
+            self.coords[self.pairs[:,0]] - self.coords[self.pairs[:,1]],
+            axis=1
         )
-        bond_len = bond.GetLength()
-        stretch = bond_len - ideal_bond_len
+        self.ideal_lengths = radii[self.pairs].sum(axis=1)
+        self.stretches = self.lengths - self.ideal_lengths
+
+        self.degrees = np.bincount(self.pairs.flatten(), minlength=n_atoms)
+        self.valences = np.bincount(
+            self.pairs.flatten(),
+            weights=np.repeat(self.orders, 2),
+            minlength=n_atoms
+        ).astype(int)
+
+        # these are only computed when needed
+        self.small_angles = None
+        self.bridges = None
+
+    @classmethod
+    def from_ob_mol(cls, ob_mol, min_bond_angle=45):
+        ob_atoms = list(ob.OBMolAtomIter(ob_mol))
+        ob_bonds = list(ob.OBMolBondIter(ob_mol))
+        return cls(
+            coords=[(a.GetX(), a.GetY(), a.GetZ()) for a in ob_atoms],
+            atomic_nums=[a.GetAtomicNum() for a in ob_atoms],
+            pairs=[
+                (b.GetBeginAtomIdx()-1, b.GetEndAtomIdx()-1) for b in ob_bonds
+            ],
+            orders=[b.GetBondOrder() for b in ob_bonds],
+            min_bond_angle=min_bond_angle,
+            ob_mol=ob_mol,
+            ob_bonds=ob_bonds,
+        )
+
+    def bonds(self):
+        '''
+        Return the rows of the bonds that
+        have not been deleted, in order.
+        '''
+        return np.flatnonzero(self.active).tolist()
+
+    def get_max_valences(self, atoms):
+        '''
+        Return an array of the max allowed valence
+        of each atom given a list of OBAtoms, as in
+        get_max_valences(), where atoms that are not
+        in atoms have max valence 1.
+        '''
+        return self.calc_max_valences(
+            [a.GetIdx()-1 for a in atoms],
+            [a.GetFormalCharge() for a in atoms],
+            [a.GetImplicitHCount() for a in atoms],
+        )
+
+    def calc_max_valences(self, idx, formal_charges, h_counts):
+        '''
+        Return an array of the max allowed valence
+        of each atom given the indices, formal charges
+        and implicit hydrogen counts of some atoms,
+        where the other atoms have max valence 1.
+        '''
+        idx = np.asarray(idx, dtype=int)
+
+        # count the oxygen neighbors of each atom
+        pairs = self.pairs[self.active]
+        is_o = self.atomic_nums[pairs] == 8
+        n_o_nbrs = np.bincount(
+            pairs.flatten(),
+            weights=is_o[:,::-1].flatten(),
+            minlength=self.n_atoms
+        )
+        max_vals = np.ones(self.n_atoms, dtype=int)
+        max_vals[idx] = calc_max_valences(
+            self.atomic_nums[idx],
+            np.asarray(formal_charges, dtype=int),
+            n_o_nbrs[idx],
+            np.asarray(h_counts, dtype=int),
+        )
+        return max_vals
+
+    def sort_bonds_by_stretch(self, bonds, absolute=True):
+        '''
+        Return bond rows sorted by their distance
+        from the optimal covalent bond length,
+        and their actual bond length, with the
+        most stretched and longest bonds first.
+        '''
+        stretches = self.stretches
         if absolute:
-            stretch = np.abs(stretch)
-        bond_info.append((stretch, bond_len, bond))
+            stretches = np.abs(stretches)
+        return sorted(
+            bonds, reverse=True, key=lambda k: (stretches[k], self.lengths[k])
+        )
 
-    # sort bonds from most to least stretched
-    bond_info.sort(reverse=True, key=lambda t: (t[0], t[1]))
-    return bond_info
+    def sort_atoms_by_valence(self, atoms, max_vals):
+        '''
+        Return atom indices sorted by their maximum
+        allowed valence and remaining valence,
+        with the most valence-constrained and
+        hyper-valent atoms sorted first.
+        '''
+        rem_vals = max_vals - self.valences
+        return sorted(atoms, key=lambda i: (max_vals[i], rem_vals[i]))
+
+    def find_small_angles(self, bonds):
+        '''
+        Return whether each of the bonds is part
+        of an angle smaller than min_bond_angle
+        with a neighbor of either of its atoms.
+        '''
+        # vertex atom, bond row and end atoms of each angle
+        angles = []
+        for k in bonds:
+            a, b = self.pairs[k]
+            for vertex, end in ((a, b), (b, a)):
+                for l in self.atom_bonds[vertex]:
+                    if l != k:
+                        i, j = self.pairs[l]
+                        angles.append((vertex, k, end, j if i == vertex else i))
+
+        if not angles:
+            return np.zeros(len(bonds), dtype=bool)
+
+        vertex, k, end1, end2 = np.array(angles).T
+        v1 = self.coords[end1] - self.coords[vertex]
+        v2 = self.coords[end2] - self.coords[vertex]
+        mag = np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)
+        cos = (v1 * v2).sum(axis=1) / np.where(mag > 0, mag, 1)
+        degrees = np.degrees(np.arccos(np.clip(cos, -1, 1)))
+        degrees[mag == 0] = 0 # as in openbabel
+
+        is_small = np.zeros(len(self.pairs), dtype=bool)
+        is_small[k[degrees < self.min_bond_angle]] = True
+        return is_small[bonds]
+
+    def forms_small_angle(self, bond):
+        '''
+        Return whether the bond is part of a
+        small angle with a neighbor of either
+        of its atoms.
+        '''
+        if self.small_angles is None:
+            self.small_angles = np.zeros(len(self.pairs), dtype=bool)
+            bonds = self.bonds()
+            self.small_angles[bonds] = self.find_small_angles(bonds)
+        return self.small_angles[bond]
+
+    def is_bridge(self, bond):
+        '''
+        Return whether the bond is a bridge, which
+        can't be removed without fragmenting the
+        molecule. They are found for all bonds at
+        once and only found again after a bond is
+        deleted, unlike with reachable().
+        '''
+        if self.bridges is None:
+            self.bridges = np.zeros(len(self.pairs), dtype=bool)
+            bonds = self.bonds()
+            self.bridges[bonds] = find_bridges(
+                self.n_atoms, self.pairs[bonds]
+            )
+        return self.bridges[bond]
+
+    def set_bond_order(self, bond, bond_order):
+        '''
+        Set the order of the bond in
+        the table and the molecule.
+        '''
+        if self.ob_mol is not None:
+            self.ob_bonds[bond].SetBondOrder(int(bond_order))
+        self.valences[self.pairs[bond]] += bond_order - self.orders[bond]
+        self.orders[bond] = bond_order
+
+    def delete_bond(self, bond):
+        '''
+        Delete the bond from the table and
+        the molecule, which requires recomputing
+        the small angles of the bonds that
+        shared an atom with it.
+        '''
+        if self.ob_mol is not None:
+            self.ob_mol.DeleteBond(self.ob_bonds[bond])
+            self.ob_bonds[bond] = None
+        self.active[bond] = False
+
+        a, b = self.pairs[bond]
+        self.degrees[[a, b]] -= 1
+        self.valences[[a, b]] -= self.orders[bond]
+        self.atom_bonds[a].remove(bond)
+        self.atom_bonds[b].remove(bond)
+
+        if self.small_angles is not None:
+            self.small_angles[bond] = False
+            nbr_bonds = self.atom_bonds[a] + self.atom_bonds[b]
+            self.small_angles[nbr_bonds] = self.find_small_angles(nbr_bonds)
+
+        self.bridges = None
+
+    def remove_bad_valences(self, atoms, max_vals):
+        '''
+        Remove hypervalent bonds of the atoms without
+        fragmenting the molecule, prioritizing stretched
+        bonds. Also remove bonds between halogens/hydrogens.
+        '''
+        # remove any bonds between halogens or hydrogens
+        for bond in self.bonds():
+            a1, a2 = self.pairs[bond]
+            if max_vals[a1] == 1 and max_vals[a2] == 1:
+                self.delete_bond(bond)
+
+        # remove bonds causing larger-than-permitted valences
+        #   prioritize atoms with lowest max valence, since they
+        #   place the hardest constraint on reachability (e.g O)
+        valences = self.valences
+
+        for atom in self.sort_atoms_by_valence(atoms, max_vals):
+
+            if valences[atom] <= max_vals[atom]:
+                continue
+            # else, the atom could have an invalid valence
+            #   so check whether we can modify a bond
+
+            bonds = self.sort_bonds_by_stretch(self.atom_bonds[atom])
+            for bond in bonds:
+
+                # do the atoms involved in this bond have bad valences?
+                #   since we are modifying the valences in the loop, this
+                #   could have changed since calling sort_atoms_by_valence
+
+                a1, a2 = self.pairs[bond]
+                max_val_diff = max( # by how much are the valences over?
+                    valences[a1] - max_vals[a1], valences[a2] - max_vals[a2]
+                )
+                if max_val_diff > 0:
+
+                    bond_order = self.orders[bond]
+                    if bond_order > max_val_diff: # decrease bond order
+                        self.set_bond_order(bond, bond_order - max_val_diff)
+
+                    elif not self.is_bridge(bond): # don't fragment the molecule
+                        self.delete_bond(bond)
+
+                    # if the current atom now has a permitted valence,
+                    # break and let other atoms choose next bonds to remove
+                    if valences[atom] <= max_vals[atom]:
+                        break
+
+    def remove_bad_geometry(self, max_bond_stretch):
+        '''
+        Remove bonds with excessive stretch or angle strain
+        without fragmenting the molecule, and prioritizing
+        the most stretch bonds.
+        '''
+        stretches = np.abs(self.stretches)
+        for bond in self.sort_bonds_by_stretch(self.bonds()):
+
+            # as long as we aren't disconnecting, let's remove things
+            #   that are excessively far away (0.45 from ConnectTheDots)
+            # get bonds to be less than max allowed
+            # also remove tight angles, as done in openbabel
+            if (stretches[bond] > max_bond_stretch
+                or self.forms_small_angle(bond)
+            ):
+                if not self.is_bridge(bond): # don't fragment the molecule
+                    self.delete_bond(bond)
+
+    def fill_rem_valences(self, atoms, max_vals):
+        '''
+        Increment bond orders to fill the remaining
+        valences of the atoms, prioritizing the least
+        valence-constrained atoms and shortest bonds.
+        '''
+        valences = self.valences
+
+        for atom in reversed(self.sort_atoms_by_valence(atoms, max_vals)):
+
+            if valences[atom] >= max_vals[atom]:
+                continue
+            # else, the atom could have an empty valence
+            #   so check whether we can augment a bond,
+            #   prioritizing bonds that are too short
+
+            bonds = self.sort_bonds_by_stretch(self.atom_bonds[atom])
+            for bond in reversed(bonds):
+
+                if self.orders[bond] >= 3:
+                    continue # don't go above triple
+
+                # do the atoms involved in this bond have empty valences?
+                #   since we are modifying the valences in the loop, this
+                #   could have changed since calling sort_atoms_by_valence
+
+                a1, a2 = self.pairs[bond]
+                min_val_diff = min( # by how much are the valences under?
+                    max_vals[a1] - valences[a1], max_vals[a2] - valences[a2]
+                )
+                if min_val_diff > 0: # increase bond order
+
+                    bond_order = self.orders[bond] # don't go above triple
+                    self.set_bond_order(bond, min(bond_order + min_val_diff, 3))
+
+                    # if the current atom now has its preferred valence,
+                    #   break and let other atoms choose next bonds to augment
+                    if valences[atom] == max_vals[atom]:
+                        break
 
 
 def count_nbrs_of_elem(atom, atomic_num):
@@ -680,54 +1348,80 @@ def count_nbrs_of_elem(atom, atomic_num):
 def get_max_valences(atoms):
 
     # determine max allowed valences
-    pt = Chem.GetPeriodicTable()
-    max_vals = {}
-    for i, ob_atom in enumerate(atoms):
+    max_vals = calc_max_valences(
+        np.array([a.GetAtomicNum() for a in atoms], dtype=int),
+        np.array([a.GetFormalCharge() for a in atoms], dtype=int),
+        np.array([count_nbrs_of_elem(a, 8) for a in atoms], dtype=int),
+        np.array([a.GetImplicitHCount() for a in atoms], dtype=int),
+    )
+    return {a.GetIdx(): int(v) for a, v in zip(atoms, max_vals)}
+
 
-        # set max valance to the smallest allowed by either openbabel
-        # or rdkit, since we want the molecule to be valid for both
-        # (rdkit is usually lower, mtr22- specifically for N, 3 vs 4)
+def calc_max_valences(atomic_nums, formal_charges, n_o_nbrs, h_counts):
+    '''
+    Return an array of the max allowed valences
+    of atoms given arrays of their elements,
+    formal charges, number of oxygen neighbors
+    and implicit hydrogen counts.
+    '''
+    # set max valance to the smallest allowed by either openbabel
+    # or rdkit, since we want the molecule to be valid for both
+    # (rdkit is usually lower, mtr22- specifically for N, 3 vs 4)
 
-        # mtr22- since we are assessing validity with rdkit,
-        # we should try to use the rdkit valence model here
-        # which allows multiple valences for certain elements
-        # refer to rdkit.Chem.Atom.calcExplicitValence
+    # mtr22- since we are assessing validity with rdkit,
+    # we should try to use the rdkit valence model here
+    # which allows multiple valences for certain elements
+    # refer to rdkit.Chem.Atom.calcExplicitValence
 
-        atomic_num = ob_atom.GetAtomicNum()
+    # get default valence of isoelectronic element
+    pt = Chem.GetPeriodicTable()
+    iso_atomic_nums = atomic_nums - formal_charges
+    default_vals = {
+        n: pt.GetDefaultValence(int(n)) for n in np.unique(iso_atomic_nums)
+    }
+    max_vals = np.array(
+        [default_vals[n] for n in iso_atomic_nums], dtype=int
+    )
 
-        # get default valence of isoelectronic element
-        iso_atomic_num = atomic_num - ob_atom.GetFormalCharge()
-        max_val = pt.GetDefaultValence(iso_atomic_num)
+    # check for common functional groups
+    max_vals[(atomic_nums == 15) & (n_o_nbrs >= 4)] = 5 # phosphate
+    max_vals[(atomic_nums == 16) & (n_o_nbrs >= 2)] = 6 # sulfone
 
-        # check for common functional groups
-        if atomic_num == 15: # phosphate
-            if count_nbrs_of_elem(ob_atom, 8) >= 4:
-                max_val = 5
+    return max_vals - h_counts
 
-        elif atomic_num == 16: # sulfone
-            if count_nbrs_of_elem(ob_atom, 8) >= 2:
-                max_val = 6
 
-        max_val -= ob_atom.GetImplicitHCount()
+def rd_h_acceptor(rd_atom):
+    '''
+    Return whether an RDKit atom is an H bond acceptor,
+    approximating the openbabel model, i.e. oxygens that
+    are not aromatic, and nitrogens with a lone pair not
+    in conjugation and no positive charge.
+    '''
+    atomic_num = rd_atom.GetAtomicNum()
+    if atomic_num == 8:
+        return not rd_atom.GetIsAromatic()
+    elif atomic_num == 7:
+        return rd_atom.GetFormalCharge() <= 0 and (
+            rd_atom.GetHybridization() == Chem.HybridizationType.SP3
+            or rd_atom.GetDegree() < 3
+        )
+    return False
 
-        max_vals[ob_atom.GetIdx()] = max_val
 
-    return max_vals
+def rd_h_donor(rd_atom):
+    return (
+        rd_atom.GetAtomicNum() in {7, 8} and
+        rd_atom.GetTotalNumHs(includeNeighbors=True) > 0
+    )
 
 
-def sort_atoms_by_valence(atoms, max_vals):
-    '''
-    Return atoms sorted by their maximum
-    allowed valence and remaining valence,
-    with the most valence-constrained and
-    hyper-valent atoms sorted first.
-    '''
-    atom_info = []
-    for atom in atoms:
-        max_val = max_vals[atom.GetIdx()]
-        rem_val = max_val - atom.GetExplicitValence()
-        atom_info.append((max_val, rem_val, atom))
-
-    # sort atoms from least to most remaining valence
-    atom_info.sort(key=lambda t: (t[0], t[1]))
-    return atom_info
+# the atom typing properties of RDKit atoms,
+#   with the same names as the Atom functions
+rd_atom_props = dict(
+    atomic_num=lambda a: a.GetAtomicNum(),
+    aromatic=lambda a: a.GetIsAromatic(),
+    h_acceptor=rd_h_acceptor,
+    h_donor=rd_h_donor,
+    formal_charge=lambda a: a.GetFormalCharge(),
+    h_count=lambda a: a.GetTotalNumHs(includeNeighbors=True),
+)
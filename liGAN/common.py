@@ -1,4 +1,4 @@
-import time, random
+import sys, time, random, resource, contextlib
 import rdkit # import before molgrid to avoid RuntimeWarning
 import numpy as np
 import torch, molgrid
@@ -54,3 +54,71 @@ def catch_exception(func=None, exc_type=Exception, default=np.nan):
             except exc_type:            
                 return default
         return wrapper
+
+
+def reset_peak_memory(device):
+    '''
+    Reset the peak memory statistic of the device,
+    if the device keeps track of it (only CUDA).
+    '''
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def get_peak_memory(device):
+    '''
+    Return the peak memory used on the device in
+    bytes. For CUDA devices, this is the max memory
+    allocated by torch since the last reset, while
+    for other devices it's the max resident set size
+    of the process.
+    '''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    else:
+        # linux reports ru_maxrss in KB, but macOS uses bytes
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class PhaseTimer(object):
+    '''
+    Accumulates the wall time spent in named phases
+    of an algorithm. Phases can be nested, in which
+    case the time spent in the inner phase does not
+    count towards the time of the outer phase.
+
+        timer = PhaseTimer()
+        with timer('outer'):
+            with timer('inner'):
+                ...
+
+    Phases can also be started and stopped explicitly.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+        self.t_last = None
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        self.start(phase)
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    def start(self, phase):
+        t = time.time()
+        if self.stack: # pause the enclosing phase
+            self.add(self.stack[-1], t - self.t_last)
+        self.stack.append(phase)
+        self.t_last = t
+
+    def stop(self):
+        t = time.time()
+        self.add(self.stack.pop(), t - self.t_last)
+        self.t_last = t
+
+    def add(self, phase, t):
+        self.times[phase] = self.times.get(phase, 0.0) + t
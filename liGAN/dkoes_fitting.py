@@ -1,275 +1,233 @@
-import time, os
+import time
 import molgrid
-from rdkit.Chem import AllChem as Chem
-from openbabel import openbabel as ob
-from openbabel import pybel
 import torch
-import torch.nn.functional as F
 import numpy as np
-import seaborn as sns
-from rdkit import Geometry
-from skimage.segmentation import flood_fill
-from collections import namedtuple
-import pickle
+from scipy import ndimage
 
-from .atom_structs import AtomStruct
+# density threshold for islands of atom density
+ISLAND_THRESHOLD = 0.5
 
 
-def grid_to_xyz(gcoords, mgrid):
-    return mgrid.center+(np.array(gcoords)-((mgrid.size-1)/2))*mgrid.resolution
+def get_per_atom_volume(radius):
+    return radius**3*((2*np.pi)**1.5)
 
 
-def select_atom_starts(mgrid, G, radius):
-    '''Given a single channel grid and the atomic radius for that type,
-    select initial positions using a weight random selection that treats 
-    each disconnected volume of density separately'''
-    per_atom_volume = radius**3*((2*np.pi)**1.5) 
+def select_atom_starts(grid, values, radius, threshold=ISLAND_THRESHOLD, rng=None):
+    '''Given a single channel of grid values and the atomic radius for that
+    type, select initial positions using a weighted random selection that
+    treats each disconnected volume of density separately.  Samples are
+    drawn from the numpy Generator rng, or a new unseeded one.'''
+    if rng is None:
+        rng = np.random.default_rng()
+    per_atom_volume = get_per_atom_volume(radius)
+    values = values.detach().cpu().numpy()
 
-    mask = G.cpu().numpy().copy()
+    #label each island of density greater than threshold in a single pass
+    labels, n_islands = ndimage.label(values >= threshold)
+    if n_islands == 0:
+        return grid.center.new_zeros((0, 3))
 
-    #look for islands of density greater than 0.5 (todo: parameterize this threshold?)
-    #label each island in mask
-    THRESHOLD = 0.5
-    values = G.cpu().numpy()
-    mask[values >= THRESHOLD] = 1.0
-    mask[values < THRESHOLD] = 0
+    totals = ndimage.sum_labels(values, labels, np.arange(1, n_islands+1))
 
-    maxpos = np.unravel_index(mask.argmax(),mask.shape)
-    masks = []
-    which = -1
-    while mask[maxpos] > 0:
-        flood_fill(mask, maxpos, which, in_place=True) #identify and mark the connected region
-        maxpos = np.unravel_index(mask.argmax(),mask.shape)
-        which -= 1
-
-    for selector in range(-1,which,-1):
-         masks.append(mask == selector)
-
-    retcoords = []
-
-    #print("#masks",len(masks))
-    for M in masks:
-        maskedG = G.cpu().numpy()
-        maskedG[~M] = 0
-        flatG = maskedG.flatten()
-        total = float(flatG.sum())
+    #group the flat indices of island points by island label
+    labels = labels.flatten()
+    in_islands = np.flatnonzero(labels)
+    in_islands = in_islands[np.argsort(labels[in_islands], kind='stable')]
+    bounds = np.searchsorted(labels[in_islands], np.arange(1, n_islands+2))
+    weights = np.minimum(values.flatten(), 1.0)
 
+    idx = []
+    for i, total in enumerate(totals):
         if total < .1*per_atom_volume:
             continue #should be very conservative given a 0.5 THRESHOLD
         cnt = int(np.ceil(total/per_atom_volume))  #pretty sure this can only underestimate
         #counting this way is especially problematic for large molecules that go to the box edge
+        island = in_islands[bounds[i]:bounds[i+1]]
+        p = weights[island]
+        cnt = min(cnt, np.count_nonzero(p))
         if cnt == 0:
             continue
+        idx.append(rng.choice(island, cnt, False, p/p.sum()))
 
-        flatG[flatG > 1.0] = 1.0
-        rand = np.random.choice(range(len(flatG)), cnt, False, flatG/flatG.sum())
-        gcoords = np.array(np.unravel_index(rand,G.shape)).T
-        ccoords = grid_to_xyz(gcoords, mgrid)
+    if not idx:
+        return grid.center.new_zeros((0, 3))
 
-        retcoords += list(ccoords)
+    idx_xyz = np.array(np.unravel_index(np.concatenate(idx), values.shape)).T
+    return grid.get_coords(torch.as_tensor(idx_xyz, device=grid.device))
 
-    #print("coords",len(retcoords))
-    return retcoords
 
-
-def simple_atom_fit(mgrid, types,iters=10,tol=0.01,device='cuda',grm=-1.5):
-    '''Fit atoms to AtomGrid.  types are ignored as the number of 
-    atoms of each type is always inferred from the density.
-    Returns the AtomGrid of the placed atoms and the AtomStruct'''
+def simple_atom_fit(grids, iters=10, tol=0.01, grm=-1.5, threshold=ISLAND_THRESHOLD, device='cuda', rng=None):
+    '''Fit atoms to the element channels of a batch of AtomGrids, which
+    must have the same size, resolution and typer.  The number of atoms
+    of each element is inferred from the density, and the coordinates of
+    all grids are optimized together with L-BFGS.  Random starts and
+    jitter are drawn from the numpy Generator rng, or a new unseeded one.
+    Returns a list of (coords, elem index, fit values, info) per grid.'''
+    if rng is None:
+        rng = np.random.default_rng()
 
     t_start = time.time()
-    #for every channel, select some coordinates and setup the type/radius vectors
-    initcoords = []
-    typevecs = []
-    radii = []
-    typeindices = []
-    numatoms = 0
-    tcnts = {}
-    values = torch.tensor(mgrid.values,device=device)
-
-    for (t,G) in enumerate(values):
-        ch = mgrid.channels[t]
-        coords = select_atom_starts(mgrid, G, ch.atomic_radius)
-        if coords:
-            tvec = np.zeros(len(mgrid.channels))
-            tvec[t] = 1.0
-            tcnt = len(coords)
-            numatoms += tcnt
-
-            r = mgrid.channels[t].atomic_radius
-            initcoords += coords
-            typevecs += [tvec]*tcnt
-            typeindices += [t]*tcnt
-            radii += [r]*tcnt
-            tcnts[t] = tcnt
-
-    typevecs = np.array(typevecs)
-    initcoords = np.array(initcoords)
-    typeindices = np.array(typeindices)
-    #print('typeindices',typeindices)
-    #setup gridder
-    center = tuple([float(c) for c in mgrid.center])
-    gridder = molgrid.Coords2Grid(molgrid.GridMaker(dimension=mgrid.dimension,resolution=mgrid.resolution,
-                                                    gaussian_radius_multiple=grm),center=center)
-
-    #having setup input coordinates, optimize with BFGS
-    coords = torch.tensor(initcoords,dtype=torch.float32,requires_grad=True,device=device)
-    types = torch.tensor(typevecs,dtype=torch.float32,device=device)
-    radii = torch.tensor(radii,dtype=torch.float32,device=device)
-    best_loss = np.inf
-    best_coords = None
-    best_typeindices = typeindices #save in case number of atoms changes
-    goodcoords = False
-    bestagrid =  torch.zeros(values.shape,dtype=torch.float32,device=device)
-
-    if len(initcoords) == 0: #no atoms
-        mol = AtomStruct(np.zeros((0,3)),np.zeros(0), mgrid.channels,
-            L2_loss=values.square().sum()/values.numel(),
-            time=time.time()-t_start,
-            iterations=0,
-            numfixes=0,
-            type_diff=0,
-            est_type_diff=0,
-            visited_structs=[]
-        )
-        return mol, bestagrid
-
-    for inum in range(iters):
-        optimizer = torch.optim.LBFGS([coords],max_iter=20000,tolerance_grad=1e-9,line_search_fn='strong_wolfe')
+    typer = grids[0].typer
+    n_grids = len(grids)
+    n_elem = grids[0].n_elem_channels
+
+    values = torch.stack([g.elem_values for g in grids]).to(device, torch.float32)
+    centers = torch.stack([g.center for g in grids]).to(device, torch.float32)
+    elem_radii = typer.elem_radii[:n_elem].to(device).tolist()
+
+    #setup gridder, fitting atoms in coordinates relative to each grid's center
+    grid_maker = molgrid.GridMaker(
+        dimension=grids[0].dimension,
+        resolution=grids[0].resolution,
+        gaussian_radius_multiple=grm
+    )
+    grid_maker.set_radii_type_indexed(False)
+    gridder = molgrid.Coords2Grid(grid_maker, center=(0., 0., 0.))
+
+    def get_starts(b, t):
+        return select_atom_starts(grids[b], values[b,t], elem_radii[t], threshold, rng) - centers[b]
+
+    #for every grid and channel, select some coordinates
+    coords = [[get_starts(b, t) for t in range(n_elem)] for b in range(n_grids)]
+
+    def pack(coords):
+        '''Pad per-grid, per-type coordinates into batched coords,
+        types and radii, using zero type vectors for padding'''
+        n_atoms = [sum(len(c) for c in cs) for cs in coords]
+        n_max = max(max(n_atoms), 1)
+        batch_coords = torch.zeros((n_grids, n_max, 3), device=device)
+        batch_types = torch.zeros((n_grids, n_max, n_elem), device=device)
+        batch_radii = torch.ones((n_grids, n_max), device=device)
+        for b, cs in enumerate(coords):
+            offset = 0
+            for t, c in enumerate(cs):
+                batch_coords[b,offset:offset+len(c)] = c
+                batch_types[b,offset:offset+len(c),t] = 1.0
+                batch_radii[b,offset:offset+len(c)] = elem_radii[t]
+                offset += len(c)
+        n_atoms = torch.tensor(n_atoms, device=device, dtype=torch.float32)
+        return batch_coords, batch_types, batch_radii, n_atoms
+
+    def unpack(batch_coords, coords):
+        '''Split batched coords back into per-grid, per-type coordinates
+        with the same numbers of atoms as coords'''
+        ret = []
+        for b, cs in enumerate(coords):
+            offsets = np.cumsum([0] + [len(c) for c in cs])
+            ret.append([batch_coords[b,i:j] for i, j in zip(offsets[:-1], offsets[1:])])
+        return ret
+
+    def optimize(coords):
+        '''Minimize the summed per-grid losses with L-BFGS, and return
+        the optimized coords, fit values and per-grid losses'''
+        batch_coords, types, radii, n_atoms = pack(coords)
+        batch_coords.requires_grad_(True)
+        optimizer = torch.optim.LBFGS([batch_coords],max_iter=1000,tolerance_grad=1e-9,line_search_fn='strong_wolfe')
         def closure():
             optimizer.zero_grad()
-            agrid = gridder.forward(coords,types,radii)
-            loss = torch.square(agrid-values).sum()/numatoms
+            agrid = gridder.forward(batch_coords,types,radii)
+            loss = (torch.square(agrid-values).sum(dim=(1,2,3,4))/n_atoms.clamp(min=1)).sum()
             loss.backward()
             return loss
+        if n_atoms.sum() > 0:
+            optimizer.step(closure)
+        with torch.no_grad():
+            agrid = gridder.forward(batch_coords,types,radii)
+            losses = torch.square(agrid-values).sum(dim=(1,2,3,4))/n_atoms.clamp(min=1)
+        return unpack(batch_coords.detach(), coords), agrid, losses
+
+    def max_errors(agrid):
+        return torch.square(agrid-values).flatten(2).max(dim=2)[0]
 
-        optimizer.step(closure)
-        final_loss = optimizer.state_dict()['state'][0]['prev_loss']  #todo - check for convergence?
+    best_loss = torch.full((n_grids,), np.inf, device=device)
+    best_coords = [None]*n_grids
+    best_agrid = torch.zeros_like(values)
 
-        if final_loss < best_loss:
-            best_loss = final_loss
-            best_coords = coords.detach().cpu()
+    def update_best(coords, agrid, losses):
+        improved = losses < best_loss
+        for b in torch.nonzero(improved)[:,0].tolist():
+            best_coords[b] = coords[b]
+        best_loss[improved] = losses[improved]
+        best_agrid[improved] = agrid[improved]
+        return improved
+
+    for inum in range(iters):
+        coords, agrid, losses = optimize(coords)
+        update_best(coords, agrid, losses)
 
         if inum == iters-1: #stick with these coordinates
-            break;
+            break
+
         #otherwise, try different starting coordinates for only those
         #atom types that have errors
-        goodcoords = True
-        with torch.no_grad():
-            offset = 0
-            agrid = gridder.forward(coords,types,radii)     
-            t = 0
-            while offset < len(typeindices):
-                t = typeindices[offset]
-                #eval max error - mse will downplay a single atom of many being off
-                maxerr = float(torch.square(agrid[t]-values[t]).max())
-                if maxerr > tol:
-                    goodcoords = False
-                    ch = mgrid.channels[t]
-                    newcoords = select_atom_starts(mgrid, values[t], ch.atomic_radius)
-                    for (i,coord) in enumerate(newcoords):
-                        coords[i+offset] = torch.tensor(coord,dtype=torch.float)
-                offset += tcnts[t]
-        if goodcoords:
+        bad = (max_errors(agrid) > tol) & torch.tensor(
+            [[len(c) > 0 for c in cs] for cs in coords], device=device
+        )
+        if not bad.any():
             break
-    bestagrid = agrid.clone()
-    numfixes = 0
-    if not goodcoords:
-        #try to fix up an atom at a time
-        offset = 0
-        #reset corods to best found so far
-        with torch.no_grad():
-            coords[:] = best_coords
-            agrid = gridder.forward(coords,types,radii)
-        t = 0
-        while offset < len(typeindices):
-            t = typeindices[offset]
-            maxerr = float(torch.square(agrid[t]-values[t]).max())
-            #print('maxerr',maxerr)
-            per_atom_volume = float(radii[offset])**3*((2*np.pi)**1.5) 
-            while maxerr > tol:
-                #identify the atom of this type closest to the place with too much density
-                #and move it to the location with too little density
-                tcoords = coords[offset:offset+tcnts[t]].detach().cpu().numpy() #coordinates for this type
-
-                diff = agrid[t]-values[t]
-                possum = float(diff[diff>0].sum())
-                negsum = float(diff[diff <0].sum())
-                maxdiff = float(diff.max())
-                mindiff = float(diff.min())
-                missing_density = -(negsum+possum)
-                #print('Type %d numcoords %d maxdiff %.5f mindiff %.5f missing %.5f'%(t,len(tcoords),maxdiff,mindiff,missing_density))
-                if missing_density > .25*per_atom_volume: #add atom  MAGIC NUMBER ALERT
-                    #needs to be enough total missing density to be close to a whole atom,
-                    #but the missing density also needs to be somewhat concentrated
-                    #print("Missing density - not enough atoms?")
-                    numfixes += 1
-                    minpos = int((agrid[t]-values[t]).argmin())
-                    minpos = grid_to_xyz(np.unravel_index(minpos,agrid[t].shape),mgrid)
-                    #add atom: change coords, types, radii, typeindices and tcnts, numatoms
-                    numatoms += 1
-                    typeindices = np.insert(typeindices, offset, t)
-                    tcnts[t] += 1
-                    with torch.no_grad():
-                        newcoord = torch.tensor([minpos],device=coords.device,dtype=coords.dtype,requires_grad=True)
-                        coords = torch.cat((coords[:offset],newcoord,coords[offset:]))
-                        radii = torch.cat((radii[:offset],radii[offset:offset+1],radii[offset:]))
-                        types = torch.cat((types[:offset],types[offset:offset+1],types[offset:]))
-
-                        coords.requires_grad_(True)
-                        radii.requires_grad_(True)
-                        types.requires_grad_(True)
-
-                elif missing_density < -.75*per_atom_volume:
-                    print("Too many atoms?")
-                    break
-                    #todo, remove atom
-                else:   #move an atom
-                    numfixes += 1
-                    maxpos = int((agrid[t]-values[t]).argmax())
-                    minpos = int((agrid[t]-values[t]).argmin())
-                    maxpos = grid_to_xyz(np.unravel_index(maxpos,agrid[t].shape),mgrid)
-                    minpos = grid_to_xyz(np.unravel_index(minpos,agrid[t].shape),mgrid)
-
-                    dists = np.square(tcoords - maxpos).sum(axis=1)
-                    closesti = np.argmin(dists)
-                    with torch.no_grad():
-                        coords[offset+closesti] = torch.tensor(minpos)
-
-                #reoptimize
-                optimizer = torch.optim.LBFGS([coords],max_iter=20000,tolerance_grad=1e-9,line_search_fn='strong_wolfe')
-                #TODO: only optimize this grid
-                optimizer.step(closure)
-                final_loss = optimizer.state_dict()['state'][0]['prev_loss']  #todo - check for convergence?
-                agrid = gridder.forward(coords,types,radii) #recompute grid
-
-                #if maxerr hasn't improved, give up
-                newerr = float(torch.square(agrid[t]-values[t]).max())
-                #print(t,'newerr',newerr,'maxerr',maxerr,'maxdiff',maxdiff,'mindiff',mindiff,'missing',missing_density)
-                if newerr >= maxerr:
-                    #don't give up if there's still a lot left to fit
-                    #and the missing density isn't all (very) shallow
-                    if missing_density < per_atom_volume or mindiff > -0.1: #magic number! 
-                        break
-                else:
-                    maxerr = newerr
-                    best_loss = final_loss
-                    best_coords = coords.detach().cpu()
-                    best_typeindices = typeindices.copy()
-                    bestagrid = agrid.clone()
-
-                #otherwise update coordinates and repeat
-
-            offset += tcnts[t]
-
-    #create struct from coordinates
-    mol = AtomStruct(best_coords.numpy(), best_typeindices, mgrid.channels,
-            L2_loss=float(best_loss),
-            time=time.time()-t_start,
+        for b, t in torch.nonzero(bad).tolist():
+            coords[b][t] = get_starts(b, t)
+
+    #try to fix up grids by adding atoms where density is missing,
+    #or moving atoms from where there is too much density
+    per_atom_volumes = get_per_atom_volume(typer.elem_radii[:n_elem].to(device))
+    numfixes = [0]*n_grids
+    coords = [list(cs) for cs in best_coords]
+    agrid = best_agrid.clone()
+    active = torch.ones(n_grids, dtype=torch.bool, device=device)
+
+    def get_pos(b, i):
+        idx_xyz = np.unravel_index(i, values.shape[2:])
+        idx_xyz = torch.as_tensor(idx_xyz, device=grids[b].device).unsqueeze(0)
+        return grids[b].get_coords(idx_xyz).to(device) - centers[b]
+
+    for fnum in range(iters):
+        diff = (agrid - values).flatten(2)
+        missing = -diff.sum(dim=2)
+        fix = (max_errors(agrid) > tol) & active[:,None]
+        fix &= (missing > -.75*per_atom_volumes) #too many atoms, todo remove atom
+        if not fix.any():
+            break
+        for b, t in torch.nonzero(fix).tolist():
+            minpos = get_pos(b, int(diff[b,t].argmin()))
+            if missing[b,t] > .25*per_atom_volumes[t]: #add atom  MAGIC NUMBER ALERT
+                #needs to be enough total missing density to be close to a whole atom
+                if len(coords[b][t]) > 0 and ((coords[b][t] - minpos)**2).sum(dim=1).min() < 1e-4:
+                    #an atom stuck between two atoms' density can sit right on the minimum,
+                    #so jitter the new atom or they can't be separated by the optimizer
+                    minpos = minpos + torch.as_tensor(rng.normal(0, .1, (1, 3)), dtype=minpos.dtype, device=device)
+                coords[b][t] = torch.cat([coords[b][t], minpos])
+            elif len(coords[b][t]) > 0: #move the atom closest to the place
+                #with too much density to the place with too little density
+                maxpos = get_pos(b, int(diff[b,t].argmax()))
+                closest = ((coords[b][t] - maxpos)**2).sum(dim=1).argmin()
+                coords[b][t] = coords[b][t].clone()
+                coords[b][t][closest] = minpos[0]
+            else:
+                continue
+            numfixes[b] += 1
+        new_coords, agrid, losses = optimize(coords)
+        improved = update_best(new_coords, agrid, losses)
+
+        #don't give up on a grid that hasn't improved if there's still a lot
+        #left to fit and the missing density isn't all (very) shallow
+        diff = (agrid - values).flatten(2)
+        unfit = (-diff.sum(dim=2) >= per_atom_volumes) & (diff.min(dim=2)[0] <= -0.1) #magic number!
+        active &= improved | unfit.any(dim=1)
+        coords = [list(best_coords[b] if improved[b] else new_coords[b]) for b in range(n_grids)]
+
+    #create coordinates and element indices from best coordinates
+    fits = []
+    for b in range(n_grids):
+        cs = best_coords[b]
+        fit_coords = torch.cat(cs) + centers[b]
+        idx_c = torch.cat([
+            torch.full((len(c),), t, dtype=torch.long, device=device) for t, c in enumerate(cs)
+        ])
+        fits.append((fit_coords, idx_c, best_agrid[b], dict(
+            L2_loss=float(best_loss[b]),
             iterations=inum,
-            numfixes=numfixes,
-            type_diff=0,
-            est_type_diff=0,
-            visited_structs=[])
-    # print('losses',final_loss,best_loss,len(best_coords))
-    return mol,bestagrid
+            numfixes=numfixes[b],
+            time=time.time()-t_start,
+        )))
+    return fits
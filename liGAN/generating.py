@@ -1,5 +1,6 @@
 import sys, os, re, time, gzip, itertools
 from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
 import pandas as pd
@@ -69,11 +70,14 @@ class MoleculeGenerator(object):
             self.prior_model = None
 
         print('Initializing atom fitter')
-        self.atom_fitter = liGAN.atom_fitting.AtomFitter(
+        self.atom_fitter = liGAN.atom_fitting.get_atom_fitter(
             device=device, **atom_fitting_kws
         )
+        if output_kws.get('output_visited', False):
+            self.atom_fitter.record_visited = True
+
         print('Initializing bond adder')
-        self.bond_adder = liGAN.bond_adding.BondAdder(
+        self.bond_adder = liGAN.bond_adding.get_bond_adder(
             debug=debug, **bond_adding_kws
         )
 
@@ -266,311 +270,467 @@ class MoleculeGenerator(object):
         fit_atoms=True,
         add_bonds=True,
         uff_minimize=True,
+        n_uff_workers=1,
+        uff_grid=False,
         gnina_minimize=True,
         fit_to_real=False,
         add_to_real=False,
         minimize_real=True,
+        warm_start=False,
         verbose=True,
     ):
         '''
         Generate atomic density grids from generative
         model for each example in data, fit atomic
         structures, and add bonds to make molecules.
+
+        If warm_start, atom fitting for each sample of
+        an example is seeded with the atoms that were
+        fit to the previous sample's generated grid.
+        This requires fitting the samples one at a time,
+        so it does not combine with fitting each batch
+        concurrently when the atom fitter has multiple
+        workers, and takes precedence over it.
+
+        UFF minimization of the molecules in each batch
+        runs in a pool of n_uff_workers processes, and is
+        started for every sample in the batch before any
+        result is collected. Then the batch is minimized
+        with gnina and written out. If uff_grid, the
+        receptor potential is precomputed on a grid for
+        each example and shared across its samples,
+        instead of adding each sample's pocket to the
+        force field.
         '''
         batch_size = self.data.batch_size
-
-        print('Starting to generate grids')
-        for example_idx, sample_idx in itertools.product(
-            range(n_examples), range(n_samples)
-        ):
-            # keep track of position in current batch
-            full_idx = example_idx*n_samples + sample_idx
-            batch_idx = full_idx % batch_size
-            print(example_idx, sample_idx, full_idx, batch_idx)
-
-            need_real_input_mol = (sample_idx == 0)
-            need_real_cond_mol = \
-                (sample_idx == 0 and self.data.diff_cond_structs)
-            need_next_batch = (batch_idx == 0)
-
-            if need_next_batch: # forward next batch
-
-                #if gnina_minimize: # copy to gpu
-                #    self.gen_model.to('cuda')
-                (
-                    input_grids, cond_grids,
-                    input_structs, cond_structs,
-                    latents, lig_gen_grids, transforms
-                ) = self.forward(
-                    prior=prior,
-                    stage2=stage2,
-                    var_factor=var_factor,
-                    post_factor=post_factor,
-                    z_score=z_score,
-                    truncate=truncate,
-                    interpolate=interpolate,
-                    spherical=spherical,
-                )
-                input_rec_grids, input_lig_grids = input_grids
-                cond_rec_grids, cond_lig_grids = cond_grids
-                input_rec_structs, input_lig_structs = input_structs
-                cond_rec_structs, cond_lig_structs = cond_structs
-                input_transforms, cond_transforms = transforms
-                #if gnina_minimize: # copy to cpu
-                #    self.gen_model.to('cpu')
-
-            input_rec_struct = input_rec_structs[batch_idx]
-            input_lig_struct = input_lig_structs[batch_idx]
-            cond_rec_struct = cond_rec_structs[batch_idx]
-            cond_lig_struct = cond_lig_structs[batch_idx]
-
-            # in order to align gen structs with real structs,
-            #   we need to apply the inverse of the transform
-            #   that was used to create the density grid that
-            #   is the reconstruction target (assume conditional)
-            input_transform = input_transforms[batch_idx]
-            cond_transform = cond_transforms[batch_idx]
-            input_center = torch.as_tensor(tuple(
-                input_transform.get_rotation_center()
-            ))
-            cond_center = torch.as_tensor(tuple(
-                cond_transform.get_rotation_center()
-            ))
-
-            # only process real rec/lig once, since they're
-            #   the same for all samples of a given ligand
-            if need_real_input_mol:
-                print('Getting real input molecule from data root')
-                splitext = lambda x: x.rsplit('.', 1 + x.endswith('.gz'))
-
-                input_rec_src_file = input_rec_struct.info['src_file']
-                input_rec_mol = read_rec_from_pdb_file(input_rec_src_file)
-                input_rec_name = \
-                    splitext(os.path.basename(input_rec_src_file))[0]
-
-                input_lig_src_file = input_lig_struct.info['src_file']
-                input_lig_mol = read_lig_from_sdf_file(input_lig_src_file)
-                input_lig_name = \
-                    splitext(os.path.basename(input_lig_src_file))[0]
-
-                if uff_minimize:
-                    # real molecules don't need UFF minimization,
-                    #   but we need their UFF metrics for reference
-                    input_pkt_mol = \
-                        input_rec_mol.get_pocket(lig_mol=input_lig_mol)
-                    input_lig_mol.info['pkt_mol'] = input_pkt_mol
-                    input_uff_mol = \
-                        input_lig_mol.uff_minimize(rec_mol=input_pkt_mol)
-                    input_lig_mol.info['uff_mol'] = input_uff_mol
-
-                    if minimize_real:
-                        print('Minimizing real molecule with gnina', flush=True)
-                        # NOTE that we are not using the UFF mol here
-                        input_lig_mol.info['gni_mol'] = \
-                            input_lig_mol.gnina_minimize(rec_mol=input_rec_mol)
-
-                if add_to_real: # evaluate bond adding in isolation
-                    print('Adding bonds to real atoms')
-                    lig_add_mol, lig_add_struct, _ = \
-                        self.bond_adder.make_mol(input_lig_struct)
-                    lig_add_mol.info['type_struct'] = lig_add_struct
-                    lig_struct.info['add_mol'] = lig_add_mol
-
-                    if uff_minimize:
-                        print('Minimizing molecule from real atoms with UFF',
-                            end='') # show number of tries inline
-                        lig_add_pkt_mol = \
-                            input_rec_mol.get_pocket(lig_mol=lig_add_mol)
-                        lig_add_mol.info['pkt_mol'] = lig_add_pkt_mol
-                        lig_add_uff_mol = \
-                            lig_add_mol.uff_minimize(rec_mol=lig_add_pkt_mol)
-                        lig_add_mol.info['uff_mol'] = lig_add_uff_mol
-
-                        if gnina_minimize:
-                            print('Minimizing molecule from real atoms with gnina', flush=True)
-                            lig_add_mol.info['gni_mol'] = \
-                                lig_add_uff_mol.gnina_minimize(rec_mol=input_rec_mol)
-
-            else: # check that the molecules are the same
-                assert input_rec_struct.info['src_file'] == input_rec_src_file
-                assert input_lig_struct.info['src_file'] == input_lig_src_file
-
-            # if the conditional molecule is different,
-            #   we need to process it separately from input
-            if need_real_cond_mol:
-
-                cond_rec_src_file = cond_rec_struct.info['src_file']
-                cond_rec_mol = read_rec_from_pdb_file(cond_rec_src_file)
-                cond_rec_name = splitext(os.path.basename(cond_rec_src_file))[0]
-
-                cond_lig_src_file = cond_lig_struct.info['src_file']
-                cond_lig_mol = read_lig_from_sdf_file(cond_lig_src_file)
-                cond_lig_name = splitext(os.path.basename(cond_lig_src_file))[0]
-
-                if uff_minimize:
-                    # real molecules don't need UFF minimization,
-                    #   but we need their UFF metrics for reference
-                    cond_pkt_mol = cond_rec_mol.get_pocket(lig_mol=cond_lig_mol)
-                    cond_lig_mol.info['pkt_mol'] = cond_pkt_mol
-                    cond_uff_mol = \
-                        cond_lig_mol.uff_minimize(rec_mol=cond_pkt_mol)
-                    cond_lig_mol.info['uff_mol'] = cond_uff_mol
-
-                    if minimize_real:
-                        print('Minimizing real molecule with gnina', flush=True)
-                        # NOTE that we are not using the UFF mol here
-                        cond_lig_mol.info['gni_mol'] = \
-                            cond_lig_mol.gnina_minimize(rec_mol=cond_rec_mol)
-
-            elif self.data.diff_cond_structs:
-                assert cond_rec_struct.info['src_file'] == cond_rec_src_file
-                assert cond_lig_struct.info['src_file'] == cond_lig_src_file
-            else:
-                cond_rec_name = input_rec_name
-                cond_lig_name = input_lig_name
-
-            # unique identifier for this data example
-            example_info = (
-                example_idx,
-                input_rec_name,
-                input_lig_name,
-                cond_rec_name,
-                cond_lig_name,
+        n_total = n_examples*n_samples
+
+        # warm start needs the previous sample's fit
+        fit_batches = (self.atom_fitter.n_workers > 1)
+        if fit_batches and warm_start:
+            print(
+                'Warning: warm_start fits samples one at a time, '
+                'so atom fitter workers are not used'
             )
+            fit_batches = False
+
+        with mols.UFFMinimizer(n_uff_workers) as uff_minimizer:
+            print('Starting to generate grids')
+            for example_idx, sample_idx in itertools.product(
+                range(n_examples), range(n_samples)
+            ):
+                # keep track of position in current batch
+                full_idx = example_idx*n_samples + sample_idx
+                batch_idx = full_idx % batch_size
+                print(example_idx, sample_idx, full_idx, batch_idx)
+
+                need_real_input_mol = (sample_idx == 0)
+                need_real_cond_mol = \
+                    (sample_idx == 0 and self.data.diff_cond_structs)
+                need_next_batch = (batch_idx == 0)
+                is_last_in_batch = (
+                    batch_idx + 1 == batch_size or full_idx + 1 == n_total
+                )
 
-            # done processing real mols/structs, so attach them
-            input_rec_struct.info['src_mol'] = input_rec_mol
-            input_lig_struct.info['src_mol'] = input_lig_mol
-            if self.data.diff_cond_structs:
-                cond_rec_struct.info['src_mol'] = cond_rec_mol
-                cond_lig_struct.info['src_mol'] = cond_lig_mol
-
-            # now process atomic density grids
-            grid_types = [
-                ('rec', input_rec_grids),
-                ('lig', input_lig_grids),  
-            ]
-            if self.data.diff_cond_structs or self.data.diff_cond_transform:
-                grid_types += [
-                    ('cond_rec', cond_rec_grids),
-                    ('cond_lig', cond_lig_grids)
-                ]
-            if self.gen_model:
-                grid_types += [
-                    ('lig_gen', lig_gen_grids)
-                ]
-
-            for grid_type, grids in grid_types:
-                torch.cuda.reset_max_memory_allocated()
+                if need_next_batch: # forward next batch
+
+                    #if gnina_minimize: # copy to gpu
+                    #    self.gen_model.to('cuda')
+                    (
+                        input_grids, cond_grids,
+                        input_structs, cond_structs,
+                        latents, lig_gen_grids, transforms
+                    ) = self.forward(
+                        prior=prior,
+                        stage2=stage2,
+                        var_factor=var_factor,
+                        post_factor=post_factor,
+                        z_score=z_score,
+                        truncate=truncate,
+                        interpolate=interpolate,
+                        spherical=spherical,
+                    )
+                    input_rec_grids, input_lig_grids = input_grids
+                    cond_rec_grids, cond_lig_grids = cond_grids
+                    input_rec_structs, input_lig_structs = input_structs
+                    cond_rec_structs, cond_lig_structs = cond_structs
+                    input_transforms, cond_transforms = transforms
+                    #if gnina_minimize: # copy to cpu
+                    #    self.gen_model.to('cpu')
+
+                    # fit atoms to the generated grids in this batch at
+                    #   once, if the atom fitter has multiple workers and
+                    #   samples aren't warm started from previous fits
+                    lig_gen_fits = None
+                    if self.gen_model and fit_atoms and fit_batches:
+                        n_fits = min(batch_size, n_total - full_idx)
+                        print(f'Fitting atoms to {n_fits} generated grids')
+                        lig_gen_fits = self.atom_fitter.fit_many(
+                            grids=[
+                                liGAN.atom_grids.AtomGrid(
+                                    values=lig_gen_grids[i],
+                                    typer=self.data.lig_typer,
+                                    center=torch.as_tensor(tuple(
+                                        cond_transforms[i].get_rotation_center()
+                                    )),
+                                    resolution=self.data.resolution
+                                ) for i in range(n_fits)
+                            ],
+                            type_counts=[
+                                cond_lig_structs[i].type_counts
+                                    for i in range(n_fits)
+                            ]
+                        )
 
-                is_cond_grid = grid_type.startswith('cond')
-                is_lig_grid = ('lig' in grid_type)
-                is_gen_grid = grid_type.endswith('gen')
-                real_or_gen = 'generated' if is_gen_grid else 'real'
+                    # minimization results and output are collected
+                    #   when the whole batch has been processed
+                    uff_jobs = [] # (future, mol to store result in, key)
+                    gnina_jobs = [] # (rec_mol, mol, key of input, key)
+                    out_grids = [] # args to out_writer.write
+
+                input_rec_struct = input_rec_structs[batch_idx]
+                input_lig_struct = input_lig_structs[batch_idx]
+                cond_rec_struct = cond_rec_structs[batch_idx]
+                cond_lig_struct = cond_lig_structs[batch_idx]
+
+                # in order to align gen structs with real structs,
+                #   we need to apply the inverse of the transform
+                #   that was used to create the density grid that
+                #   is the reconstruction target (assume conditional)
+                input_transform = input_transforms[batch_idx]
+                cond_transform = cond_transforms[batch_idx]
+                input_center = torch.as_tensor(tuple(
+                    input_transform.get_rotation_center()
+                ))
+                cond_center = torch.as_tensor(tuple(
+                    cond_transform.get_rotation_center()
+                ))
+
+                # only process real rec/lig once, since they're
+                #   the same for all samples of a given ligand
+                if need_real_input_mol:
+                    lig_gen_fit_struct = None # don't warm start across examples
+
+                    print('Getting real input molecule from data root')
+                    splitext = lambda x: x.rsplit('.', 1 + x.endswith('.gz'))
+
+                    input_rec_src_file = input_rec_struct.info['src_file']
+                    input_rec_ctx = get_rec_context(input_rec_src_file)
+                    input_rec_mol = input_rec_ctx.rec_mol
+                    input_rec_name = \
+                        splitext(os.path.basename(input_rec_src_file))[0]
+
+                    input_lig_src_file = input_lig_struct.info['src_file']
+                    input_lig_mol = read_lig_from_sdf_file(input_lig_src_file)
+                    input_lig_name = \
+                        splitext(os.path.basename(input_lig_src_file))[0]
+
+                    input_uff_grid = None
+                    if uff_minimize and uff_grid:
+                        print('Computing UFF grid for real input receptor')
+                        input_uff_grid = \
+                            mols.UFFGrid(input_rec_mol, input_lig_mol.center)
 
-                if is_gen_grid:
-                    grid_needs_fit = fit_atoms and is_lig_grid
-                    center = cond_center
-                elif is_cond_grid:
-                    grid_need_fit = False
-                    center = cond_center
-                else:
-                    grid_needs_fit = fit_to_real and is_lig_grid
-                    center = input_center
+                    if uff_minimize:
+                        # real molecules don't need UFF minimization,
+                        #   but we need their UFF metrics for reference
+                        input_pkt_mol = \
+                            input_rec_ctx.get_pocket(lig_mol=input_lig_mol)
+                        input_lig_mol.info['pkt_mol'] = input_pkt_mol
+                        uff_jobs.append((uff_minimizer.submit(
+                            input_lig_mol, input_uff_grid or input_pkt_mol
+                        ), input_lig_mol, 'uff_mol'))
+
+                        if minimize_real:
+                            # NOTE that we are not using the UFF mol here
+                            gnina_jobs.append(
+                                (input_rec_mol, input_lig_mol, None, 'gni_mol')
+                            )
+
+                    if add_to_real: # evaluate bond adding in isolation
+                        print('Adding bonds to real atoms')
+                        lig_add_mol, lig_add_struct, _ = \
+                            self.bond_adder.make_mol(input_lig_struct)
+                        lig_add_mol.info['type_struct'] = lig_add_struct
+                        lig_struct.info['add_mol'] = lig_add_mol
+
+                        if uff_minimize:
+                            print('Minimizing molecule from real atoms with UFF',
+                                end='') # show number of tries inline
+                            lig_add_pkt_mol = \
+                                input_rec_ctx.get_pocket(lig_mol=lig_add_mol)
+                            lig_add_mol.info['pkt_mol'] = lig_add_pkt_mol
+                            uff_jobs.append((uff_minimizer.submit(
+                                lig_add_mol, input_uff_grid or lig_add_pkt_mol
+                            ), lig_add_mol, 'uff_mol'))
+
+                            if gnina_minimize:
+                                gnina_jobs.append(
+                                    (input_rec_mol, lig_add_mol, 'uff_mol', 'gni_mol')
+                                )
+
+                else: # check that the molecules are the same
+                    assert input_rec_struct.info['src_file'] == input_rec_src_file
+                    assert input_lig_struct.info['src_file'] == input_lig_src_file
+
+                # if the conditional molecule is different,
+                #   we need to process it separately from input
+                if need_real_cond_mol:
+
+                    cond_rec_src_file = cond_rec_struct.info['src_file']
+                    cond_rec_ctx = get_rec_context(cond_rec_src_file)
+                    cond_rec_mol = cond_rec_ctx.rec_mol
+                    cond_rec_name = splitext(os.path.basename(cond_rec_src_file))[0]
+
+                    cond_lig_src_file = cond_lig_struct.info['src_file']
+                    cond_lig_mol = read_lig_from_sdf_file(cond_lig_src_file)
+                    cond_lig_name = splitext(os.path.basename(cond_lig_src_file))[0]
+
+                    cond_uff_grid = None
+                    if uff_minimize and uff_grid:
+                        print('Computing UFF grid for real conditional receptor')
+                        cond_uff_grid = \
+                            mols.UFFGrid(cond_rec_mol, cond_lig_mol.center)
 
-                if is_lig_grid:
-                    atom_typer = self.data.lig_typer
+                    if uff_minimize:
+                        # real molecules don't need UFF minimization,
+                        #   but we need their UFF metrics for reference
+                        cond_pkt_mol = cond_rec_ctx.get_pocket(lig_mol=cond_lig_mol)
+                        cond_lig_mol.info['pkt_mol'] = cond_pkt_mol
+                        uff_jobs.append((uff_minimizer.submit(
+                            cond_lig_mol, cond_uff_grid or cond_pkt_mol
+                        ), cond_lig_mol, 'uff_mol'))
+
+                        if minimize_real:
+                            # NOTE that we are not using the UFF mol here
+                            gnina_jobs.append(
+                                (cond_rec_mol, cond_lig_mol, None, 'gni_mol')
+                            )
+
+                elif self.data.diff_cond_structs:
+                    assert cond_rec_struct.info['src_file'] == cond_rec_src_file
+                    assert cond_lig_struct.info['src_file'] == cond_lig_src_file
                 else:
-                    atom_typer = self.data.rec_typer
-
-                grid = liGAN.atom_grids.AtomGrid(
-                    values=grids[batch_idx],
-                    typer=atom_typer,
-                    center=center,
-                    resolution=self.data.resolution
+                    cond_rec_name = input_rec_name
+                    cond_lig_name = input_lig_name
+
+                # unique identifier for this data example
+                example_info = (
+                    example_idx,
+                    input_rec_name,
+                    input_lig_name,
+                    cond_rec_name,
+                    cond_lig_name,
                 )
 
-                if grid_type == 'rec':
-                    grid.info['src_struct'] = input_rec_struct
-                elif grid_type == 'lig':
-                    grid.info['src_struct'] = input_lig_struct
-                elif grid_type == 'cond_rec':
-                    grid.info['src_struct'] = cond_rec_struct
-                elif grid_type == 'cond_lig':
-                    grid.info['src_struct'] = cond_lig_struct
-                elif grid_type == 'lig_gen':
-                    grid.info['src_latent'] = latents[batch_idx]
-
-                # display progress
-                index_str = f'[example_idx={example_idx} sample_idx={sample_idx} grid_type={grid_type}]'
-                value_str = 'norm={:.4f} gpu={:.4f}'.format(
-                    grid.values.norm(),
-                    torch.cuda.max_memory_allocated() / MB,
-                )
-                print(index_str + ' ' + value_str, flush=True)
-
-                if is_lig_grid and self.out_writer.output_conv:
-                    grid.info['conv_grid'] = grid.new_like(
-                        values=torch.cat([
-                            atom_fitter.convolve(
-                                grid.elem_values, grid.resolution, grid.typer
-                            ),
-                            grid.prop_values
-                        ], dim=0)
+                # done processing real mols/structs, so attach them
+                input_rec_struct.info['src_mol'] = input_rec_mol
+                input_lig_struct.info['src_mol'] = input_lig_mol
+                if self.data.diff_cond_structs:
+                    cond_rec_struct.info['src_mol'] = cond_rec_mol
+                    cond_lig_struct.info['src_mol'] = cond_lig_mol
+
+                # now process atomic density grids
+                grid_types = [
+                    ('rec', input_rec_grids),
+                    ('lig', input_lig_grids),  
+                ]
+                if self.data.diff_cond_structs or self.data.diff_cond_transform:
+                    grid_types += [
+                        ('cond_rec', cond_rec_grids),
+                        ('cond_lig', cond_lig_grids)
+                    ]
+                if self.gen_model:
+                    grid_types += [
+                        ('lig_gen', lig_gen_grids)
+                    ]
+
+                for grid_type, grids in grid_types:
+                    liGAN.common.reset_peak_memory(self.device)
+
+                    is_cond_grid = grid_type.startswith('cond')
+                    is_lig_grid = ('lig' in grid_type)
+                    is_gen_grid = grid_type.endswith('gen')
+                    real_or_gen = 'generated' if is_gen_grid else 'real'
+
+                    if is_gen_grid:
+                        grid_needs_fit = fit_atoms and is_lig_grid
+                        center = cond_center
+                    elif is_cond_grid:
+                        grid_need_fit = False
+                        center = cond_center
+                    else:
+                        grid_needs_fit = fit_to_real and is_lig_grid
+                        center = input_center
+
+                    if is_lig_grid:
+                        atom_typer = self.data.lig_typer
+                    else:
+                        atom_typer = self.data.rec_typer
+
+                    grid = liGAN.atom_grids.AtomGrid(
+                        values=grids[batch_idx],
+                        typer=atom_typer,
+                        center=center,
+                        resolution=self.data.resolution
                     )
 
-                self.out_writer.write(example_info, sample_idx, grid_type, grid)
-
-                if grid_needs_fit: # perform atom fitting
-
-                    print(f'Fitting atoms to {real_or_gen} grid')
-                    fit_struct, fit_grid, visited_structs = self.atom_fitter.fit_struct(grid, cond_lig_struct.type_counts)
-                    fit_struct.info['visited_structs'] = visited_structs
-                    fit_grid.info['src_struct'] = fit_struct
-
-                    if fit_struct.n_atoms > 0: # inverse transform
-                        cond_transform.backward(fit_struct.coords, fit_struct.coords)
-
-                    if add_bonds: # do bond adding
-                        print(f'Adding bonds to atoms from {real_or_gen} grid')
-                        fit_add_mol, fit_add_struct, visited_mols = \
-                            self.bond_adder.make_mol(fit_struct)
-                        fit_add_mol.info['type_struct'] = fit_add_struct
-                        fit_struct.info['add_mol'] = fit_add_mol
-
-                        if uff_minimize: # do UFF minimization
-                            print(f'Minimizing molecule from {real_or_gen} grid with UFF', end='')
-                            fit_pkt_mol = input_rec_mol.get_pocket(fit_add_mol)
-                            fit_add_mol.info['pkt_mol'] = fit_pkt_mol
-                            fit_uff_mol = \
-                                fit_add_mol.uff_minimize(rec_mol=fit_pkt_mol)
-                            fit_add_mol.info['uff_mol'] = fit_uff_mol
-
-                            if gnina_minimize: # do gnina minimization
-                                print(f'Minimizing molecule from {real_or_gen} grid with gnina', flush=True)
-                                fit_add_mol.info['gni_mol'] = fit_uff_mol.gnina_minimize(rec_mol=input_rec_mol)
-
-                        # minimize and score wrt conditional receptor too
-                        if self.data.diff_cond_structs and uff_minimize:
-                            print(f'Minimizing molecule from {real_or_gen} grid with UFF wrt conditional receptor', end='')
-                            fit_pkt_mol = cond_rec_mol.get_pocket(fit_add_mol)
-                            fit_add_mol.info['cond_pkt_mol'] = fit_pkt_mol
-                            fit_uff_mol = \
-                                fit_add_mol.uff_minimize(rec_mol=fit_pkt_mol)
-                            fit_add_mol.info['cond_uff_mol'] = fit_uff_mol
-
-                            if gnina_minimize: # do gnina minimization
-                                print(f'Minimizing molecule from {real_or_gen} grid with gnina wrt conditional receptor', flush=True)
-                                fit_add_mol.info['cond_gni_mol'] = \
-                                    fit_uff_mol.gnina_minimize(rec_mol=cond_rec_mol)
-
-                    grid_type += '_fit'
-                    self.out_writer.write(
-                        example_info, sample_idx, grid_type, fit_grid
+                    if grid_type == 'rec':
+                        grid.info['src_struct'] = input_rec_struct
+                    elif grid_type == 'lig':
+                        grid.info['src_struct'] = input_lig_struct
+                    elif grid_type == 'cond_rec':
+                        grid.info['src_struct'] = cond_rec_struct
+                    elif grid_type == 'cond_lig':
+                        grid.info['src_struct'] = cond_lig_struct
+                    elif grid_type == 'lig_gen':
+                        grid.info['src_latent'] = latents[batch_idx]
+
+                    # display progress
+                    index_str = f'[example_idx={example_idx} sample_idx={sample_idx} grid_type={grid_type}]'
+                    value_str = 'norm={:.4f} mem={:.4f}'.format(
+                        grid.values.norm(),
+                        liGAN.common.get_peak_memory(self.device) / MB,
                     )
+                    print(index_str + ' ' + value_str, flush=True)
+
+                    if is_lig_grid and self.out_writer.output_conv:
+                        grid.info['conv_grid'] = grid.new_like(
+                            values=torch.cat([
+                                atom_fitter.convolve(
+                                    grid.elem_values, grid.resolution, grid.typer
+                                ),
+                                grid.prop_values
+                            ], dim=0)
+                        )
+
+                    out_grids.append((example_info, sample_idx, grid_type, grid))
+
+                    if grid_needs_fit: # perform atom fitting
+
+                        if is_gen_grid and lig_gen_fits is not None:
+                            fit_struct, fit_grid, visited_structs, _ = \
+                                lig_gen_fits[batch_idx]
+                        else:
+                            init_struct = None
+                            if (
+                                warm_start and is_gen_grid
+                                and lig_gen_fit_struct is not None
+                            ): # move previous fit atoms into this grid's frame
+                                init_coords = lig_gen_fit_struct.coords.clone()
+                                cond_transform.forward(init_coords, init_coords)
+                                init_struct = AtomStruct(
+                                    init_coords,
+                                    lig_gen_fit_struct.types,
+                                    lig_gen_fit_struct.typer,
+                                )
+
+                            print(f'Fitting atoms to {real_or_gen} grid')
+                            fit_struct, fit_grid, visited_structs = self.atom_fitter.fit_struct(grid, cond_lig_struct.type_counts, init_struct)
+                        fit_struct.info['visited_structs'] = visited_structs
+                        fit_grid.info['src_struct'] = fit_struct
+
+                        if fit_struct.n_atoms > 0: # inverse transform
+                            cond_transform.backward(fit_struct.coords, fit_struct.coords)
+
+                        if is_gen_grid:
+                            lig_gen_fit_struct = fit_struct
+
+                        if add_bonds: # do bond adding
+                            print(f'Adding bonds to atoms from {real_or_gen} grid')
+                            if self.out_writer.output_visited:
+                                fit_add_mol, fit_add_struct, visited_mols = \
+                                    self.bond_adder.make_mol(fit_struct)
+                                fit_add_mol.info['visited_mols'] = visited_mols
+                            else:
+                                fit_add_mol, fit_add_struct = \
+                                    self.bond_adder.make_mol(
+                                        fit_struct, visited=False
+                                    )
+                            fit_add_mol.info['type_struct'] = fit_add_struct
+                            fit_struct.info['add_mol'] = fit_add_mol
+
+                            if uff_minimize: # start UFF minimization in each pocket
+                                print(f'Minimizing molecule from {real_or_gen} grid with UFF', end='')
+                                fit_pkt_mol = input_rec_ctx.get_pocket(fit_add_mol)
+                                fit_add_mol.info['pkt_mol'] = fit_pkt_mol
+                                uff_jobs.append((uff_minimizer.submit(
+                                    fit_add_mol, input_uff_grid or fit_pkt_mol
+                                ), fit_add_mol, 'uff_mol'))
+
+                                if gnina_minimize:
+                                    gnina_jobs.append(
+                                        (input_rec_mol, fit_add_mol, 'uff_mol', 'gni_mol')
+                                    )
+
+                                if self.data.diff_cond_structs:
+                                    print(f'Minimizing molecule from {real_or_gen} grid with UFF wrt conditional receptor', end='')
+                                    fit_cond_pkt_mol = \
+                                        cond_rec_ctx.get_pocket(fit_add_mol)
+                                    fit_add_mol.info['cond_pkt_mol'] = \
+                                        fit_cond_pkt_mol
+                                    uff_jobs.append((uff_minimizer.submit(
+                                        fit_add_mol,
+                                        cond_uff_grid or fit_cond_pkt_mol
+                                    ), fit_add_mol, 'cond_uff_mol'))
+
+                                    if gnina_minimize:
+                                        gnina_jobs.append((
+                                            cond_rec_mol, fit_add_mol,
+                                            'cond_uff_mol', 'cond_gni_mol'
+                                        ))
+
+                        grid_type += '_fit'
+                        out_grids.append(
+                            (example_info, sample_idx, grid_type, fit_grid)
+                        )
+
+                if is_last_in_batch: # finish minimizing and write output
+                    self.finish_batch(uff_jobs, gnina_jobs, out_grids)
 
         return self.out_writer.metrics
 
+    def finish_batch(self, uff_jobs, gnina_jobs, out_grids):
+        '''
+        Collect the UFF minimized mols of a batch in
+        the order they were submitted, then minimize
+        them with gnina in a single run per receptor
+        and write out the grids of the batch, computing
+        their metrics.
+
+        The result of each (future, mol, key) in uff_jobs
+        is stored in mol.info[key]. For each (rec_mol, mol,
+        input_key, key) in gnina_jobs, mol.info[input_key],
+        or mol itself if input_key is None, is minimized
+        wrt rec_mol and stored in mol.info[key]. Each item
+        of out_grids is the args of an out_writer.write.
+        '''
+        for uff_future, uff_owner, uff_key in uff_jobs:
+            uff_owner.info[uff_key] = uff_future.result()
+
+        # group gnina jobs by receptor, in order of first use
+        rec_gnina_jobs = dict()
+        for rec_mol, gni_owner, gni_input_key, gni_key in gnina_jobs:
+            gni_input = gni_owner.info[gni_input_key] \
+                if gni_input_key else gni_owner
+            rec_gnina_jobs.setdefault(id(rec_mol), (rec_mol, []))[1].append(
+                (gni_input, gni_owner, gni_key)
+            )
+
+        for rec_mol, rec_jobs in rec_gnina_jobs.values():
+            print(
+                f'Minimizing {len(rec_jobs)} molecule(s) with gnina',
+                flush=True
+            )
+            gni_mols = mols.gnina_minimize_rd_mols(
+                [gni_input for gni_input, _, _ in rec_jobs], rec_mol=rec_mol
+            )
+            for (_, gni_owner, gni_key), gni_mol in zip(rec_jobs, gni_mols):
+                gni_owner.info[gni_key] = gni_mol
+
+        for out_args in out_grids:
+            self.out_writer.write(*out_args)
+
 
 class AEGenerator(MoleculeGenerator):
     gen_model_type = liGAN.models.AE
@@ -1348,10 +1508,35 @@ class OutputWriter(object):
 
                 # fit time and number of visited structures
                 m.loc[idx, struct_type+'_time'] = struct.info['time']
-                m.loc[idx, struct_type+'_n_visited'] = len(
-                    struct.info['visited_structs']
+                fit_stats = struct.info.get('fit_stats', {})
+                m.loc[idx, struct_type+'_n_visited'] = fit_stats.get(
+                    'n_visited', len(struct.info['visited_structs'])
+                )
+
+                # time spent in each phase and resources used
+                for key in [
+                    'detect_time',
+                    'expand_time',
+                    'gd_time',
+                    'n_gd_iters',
+                    'n_steps',
+                    'n_duplicates',
+                ]:
+                    m.loc[idx, struct_type+'_'+key] = fit_stats.get(
+                        key, np.nan
+                    )
+                m.loc[idx, struct_type+'_max_beam_size'] = max(
+                    fit_stats.get('beam_sizes', []), default=np.nan
                 )
 
+                # peak memory is only measured for each fit on CUDA, since
+                #   on CPU it's the max RSS of the whole process so far,
+                #   and it's None if the atom fitter didn't track it
+                peak_memory = fit_stats.get('peak_memory')
+                if peak_memory is None or struct.device.type != 'cuda':
+                    peak_memory = np.nan
+                m.loc[idx, struct_type+'_peak_memory'] = peak_memory / MB
+
                 # accuracy of estimated type counts, whether or not
                 # they were actually used to constrain atom fitting
                 est_type = struct_type[:-4] + '_est'
@@ -1502,6 +1687,17 @@ def read_rec_from_pdb_file(pdb_file):
     return rec_mol
 
 
+@lru_cache(maxsize=16)
+def get_rec_context(pdb_file):
+    '''
+    Read a receptor from a PDB file and index it
+    for pocket extraction, caching the most recently
+    used receptors so that they are shared across
+    all samples and examples that use them.
+    '''
+    return mols.ReceptorContext(read_rec_from_pdb_file(pdb_file))
+
+
 def read_lig_from_sdf_file(sdf_file, use_ob=True):
     '''
     Try to find the real molecule in data_root using the
@@ -1,9 +1,13 @@
-import sys, os, gzip, traceback, time, tempfile, shlex
+import sys, os, gzip, traceback, time, tempfile, shlex, itertools
+import multiprocessing
 from subprocess import Popen, PIPE
+from concurrent.futures import Future, ProcessPoolExecutor
 from functools import lru_cache
 from collections import Counter
 import numpy as np
 import scipy as sp
+import scipy.optimize
+from scipy.spatial import cKDTree
 
 from openbabel import openbabel as ob
 from openbabel import pybel
@@ -17,6 +21,7 @@ from SA_Score import sascorer
 from NP_Score import npscorer
 
 from .common import catch_exception
+from .atom_grids import dimension_to_size
 
 try:
     GNINA_CMD = os.environ["GNINA_CMD"]
@@ -205,13 +210,10 @@ def make_rd_mol(coords, types, bonds, typer):
 
     rd_mol.AddConformer(rd_conf)
 
-    if bonds is not None and np.any(bonds):
-        n_bonds = 0
-        for i in range(n_atoms):
-            for j in range(i+1, n_atoms):
-                if bonds[i,j]:
-                    rd_mol.AddBond(i, j, Chem.BondType.SINGLE)
-                    n_bonds += 1
+    if bonds is not None:
+        bonds = np.asarray(bonds)
+        for i, j in np.argwhere(np.triu(bonds[:n_atoms,:n_atoms], k=1)):
+            rd_mol.AddBond(int(i), int(j), Chem.BondType.SINGLE)
 
     return rd_mol
 
@@ -298,12 +300,9 @@ def make_ob_mol(coords, types, bonds, typer):
     n_atoms = len(atoms)
 
     if bonds is not None:
-        for i, atom_i in enumerate(atoms):
-            for j, atom_j in enumerate(atoms):
-                if bonds[i,j]:
-                    ob_mol.AddBond(
-                        atom_i.GetIdx(), atom_j.GetIdx(), 1, 0
-                    )
+        bonds = np.asarray(bonds)
+        for i, j in np.argwhere(bonds[:n_atoms,:n_atoms]):
+            ob_mol.AddBond(atoms[i].GetIdx(), atoms[j].GetIdx(), 1, 0)
 
     ob_mol.EndModify()
     return ob_mol, atoms
@@ -618,31 +617,63 @@ def get_rd_mol_pocket(rec_mol, lig_mol, max_dist=8):
     the residues from rec_mol that are
     within max_dist of lig_mol.
     '''
-    # get distances b/tw rec and lig atoms
-    lig_coords = lig_mol.coords
-    rec_coords = rec_mol.coords
-    dist = sp.spatial.distance.cdist(lig_coords, rec_coords)
+    return ReceptorContext(rec_mol).get_pocket(lig_mol, max_dist)
 
-    # indexes of atoms in rec_mol that are
-    #   within max_dist of an atom in lig_mol
-    pocket_atom_idxs = set(np.nonzero((dist < max_dist))[1])
 
-    # determine pocket residues
-    pocket_res_ids = set()
-    for i in pocket_atom_idxs:
-        atom = rec_mol.GetAtomWithIdx(int(i))
-        res_id = get_rd_atom_res_id(atom)
-        pocket_res_ids.add(res_id)
+class ReceptorContext(object):
+    '''
+    A receptor molecule with a spatial index over
+    its atom coordinates and an index of the residue
+    that each atom belongs to, so that the pockets
+    around many ligands can be extracted without
+    re-parsing the receptor or recomputing all
+    receptor-ligand distances.
+    '''
+    def __init__(self, rec_mol):
+        self.rec_mol = rec_mol
+        self.tree = cKDTree(rec_mol.coords)
+
+        # map each atom to the index of its residue
+        res_idxs = dict()
+        self.atom_res_idxs = np.array([
+            res_idxs.setdefault(get_rd_atom_res_id(a), len(res_idxs))
+                for a in rec_mol.GetAtoms()
+        ], dtype=int)
+        self.n_residues = len(res_idxs)
+
+    def get_pocket_atoms(self, lig_mol, max_dist=8):
+        '''
+        Return a boolean mask of the atoms in
+        the residues that have any atom within
+        max_dist of an atom in lig_mol.
+        '''
+        # indexes of receptor atoms near any ligand atom
+        near_idxs = self.tree.query_ball_point(lig_mol.coords, max_dist)
+        near_idxs = np.fromiter(
+            itertools.chain.from_iterable(near_idxs), dtype=int
+        )
+        pocket_res = np.zeros(self.n_residues, dtype=bool)
+        pocket_res[self.atom_res_idxs[near_idxs]] = True
+        return pocket_res[self.atom_res_idxs]
+
+    def get_pocket(self, lig_mol, max_dist=8):
+        '''
+        Return a molecule containing only
+        the residues from the receptor that
+        are within max_dist of lig_mol.
+        '''
+        is_pocket = self.get_pocket_atoms(lig_mol, max_dist)
 
-    # copy mol and delete atoms
-    pkt_mol = Molecule(rec_mol, src_mol=rec_mol)
-    for atom in list(pkt_mol.GetAtoms()):
-        res_id = get_rd_atom_res_id(atom)
-        if res_id not in pocket_res_ids:
-            pkt_mol.RemoveAtom(atom.GetIdx())
+        # copy mol and delete atoms in one batch,
+        #   so the atoms are only reindexed once
+        pkt_mol = Molecule(self.rec_mol, src_mol=self.rec_mol)
+        pkt_mol.BeginBatchEdit()
+        for i in np.flatnonzero(~is_pocket):
+            pkt_mol.RemoveAtom(int(i))
+        pkt_mol.CommitBatchEdit()
 
-    pkt_mol.sanitize()
-    return pkt_mol
+        pkt_mol.sanitize()
+        return pkt_mol
 
 
 def get_rd_atom_res_id(rd_atom):
@@ -658,11 +689,206 @@ def get_rd_atom_res_id(rd_atom):
     )
 
 
+def get_uff_vdw_params(rd_mol, atom_idxs=None):
+    '''
+    Return arrays of the UFF van der Waals
+    distance and well depth of each atom in
+    a sanitized rd_mol, or of the atoms at
+    atom_idxs, with zeros for atoms that UFF
+    does not have parameters for.
+    '''
+    if atom_idxs is None:
+        atom_idxs = range(rd_mol.GetNumAtoms())
+
+    vdw_params = []
+    for i in atom_idxs:
+        params = AllChem.GetUFFVdWParams(rd_mol, int(i), int(i))
+        vdw_params.append(params or (0, 0))
+
+    vdw_params = np.array(vdw_params, dtype=float).reshape(-1, 2)
+    return vdw_params[:,0], vdw_params[:,1]
+
+
+class UFFGrid(object):
+    '''
+    The UFF van der Waals potential of a fixed
+    receptor, precomputed on a cubic grid so that
+    ligands can be minimized in the receptor without
+    adding any of its atoms to the force field.
+
+    UFF combines the vdW distances (x) and well
+    depths (D) of two atoms by geometric means, so
+    the potential of ligand atom j from receptor
+    atoms i factors into two grids, R and A, that
+    are independent of the ligand atom types:
+
+        E_j = sqrt(D_j) (x_j^6 R - 2 x_j^3 A)
+        R = sum_i sqrt(D_i) x_i^6 / r_ij^12
+        A = sum_i sqrt(D_i) x_i^3 / r_ij^6
+
+    Receptor atoms farther than cutoff from the grid
+    are ignored, and distances are clamped to at least
+    min_dist so that the grid values are finite. If no
+    receptor atoms are left, the potential is zero.
+
+    R and A are very steep near receptor atoms, so the
+    grids store R^(-1/12) and A^(-1/6), which vary about
+    linearly with distance, for accurate interpolation.
+    '''
+    powers = np.array([-12, -6])
+
+    def __init__(
+        self,
+        rec_mol,
+        center,
+        dimension=23.5,
+        resolution=0.5,
+        cutoff=8.0,
+        min_dist=1.0,
+    ):
+        self.center = np.array(center, dtype=float)
+        self.resolution = float(resolution)
+        self.size = dimension_to_size(dimension, resolution)
+        self.origin = self.center - self.resolution * (self.size - 1) / 2
+
+        # get receptor atoms within cutoff of the grid
+        rec_coords = rec_mol.coords
+        grid_max = self.origin + self.resolution * (self.size - 1)
+        grid_dist = np.linalg.norm(
+            rec_coords - np.clip(rec_coords, self.origin, grid_max), axis=1
+        )
+        atom_idxs = np.flatnonzero(grid_dist < cutoff)
+        rec_coords = rec_coords[atom_idxs]
+        rec_x, rec_D = get_uff_vdw_params(rec_mol, atom_idxs)
+        rep_coefs = np.sqrt(rec_D) * rec_x**6
+        att_coefs = np.sqrt(rec_D) * rec_x**3
+
+        # the transformed values would be infinite
+        self.empty = not (rec_D > 0).any()
+        if self.empty:
+            self.values = None
+            return
+
+        # sum over receptor atoms, one slice of the grid at a time
+        axis = self.resolution * np.arange(self.size)
+        yz = np.stack(np.meshgrid(axis, axis, indexing='ij'), axis=-1)
+        yz = yz.reshape(-1, 2) + self.origin[1:]
+
+        self.values = np.zeros((2, self.size, self.size, self.size))
+        for i, x in enumerate(axis + self.origin[0]):
+            points = np.column_stack([np.full(len(yz), x), yz])
+            inv_r6 = np.maximum(
+                sp.spatial.distance.cdist(points, rec_coords, 'sqeuclidean'),
+                min_dist**2
+            )**-3
+            self.values[0,i] = (inv_r6**2 @ rep_coefs).reshape(self.size, -1)
+            self.values[1,i] = (inv_r6 @ att_coefs).reshape(self.size, -1)
+
+        self.values = self.values**(1 / self.powers[:,None,None,None])
+
+    def interpolate(self, coords):
+        '''
+        Return the grid values at coords by trilinear
+        interpolation, and their gradients wrt coords.
+        Coords outside the grid are clamped to it, and
+        non-finite coords get NaN values and gradients.
+        '''
+        idx = (coords - self.origin) / self.resolution
+        finite = np.isfinite(idx).all(axis=1)
+        idx[~finite] = 0
+        outside = (idx < 0) | (idx > self.size - 1)
+        idx = np.clip(idx, 0, self.size - 1)
+        idx0 = np.minimum(np.floor(idx).astype(int), self.size - 2)
+        t = idx - idx0
+
+        values = np.zeros((len(coords), 2))
+        grads = np.zeros((len(coords), 2, 3))
+        for corner in itertools.product([0, 1], repeat=3):
+            i, j, k = (idx0 + corner).T
+            corner_values = self.values[:,i,j,k].T
+            weights = np.where(corner, t, 1 - t)
+            values += weights.prod(axis=1)[:,None] * corner_values
+            for d in range(3): # derivative of weight wrt t[:,d]
+                d_weight = np.where(corner[d], 1, -1) * np.prod(
+                    np.delete(weights, d, axis=1), axis=1
+                )
+                grads[:,:,d] += d_weight[:,None] * corner_values
+
+        grads[np.broadcast_to(outside[:,None,:], grads.shape)] = 0
+        values[~finite] = np.nan
+        grads[~finite] = np.nan
+        return values, grads / self.resolution
+
+    def get_energy(self, coords, vdw_x, vdw_D):
+        '''
+        Return the receptor potential energy of atoms
+        with the given coords and UFF vdW parameters,
+        and its gradient wrt the coords.
+        '''
+        if self.empty:
+            return 0.0, np.zeros_like(coords)
+
+        # undo the transform of the interpolated values
+        values, grads = self.interpolate(coords)
+        grads *= (self.powers * values**(self.powers - 1))[:,:,None]
+        values = values**self.powers
+
+        coefs = np.sqrt(vdw_D)[:,None] * np.stack(
+            [vdw_x**6, -2 * vdw_x**3], axis=1
+        )
+        energy = (coefs * values).sum()
+        grad = (coefs[:,:,None] * grads).sum(axis=1)
+        return energy, grad
+
+
+class UFFGridForceField(object):
+    '''
+    The UFF force field of a ligand plus the receptor
+    potential from a UFFGrid, with the methods of the
+    RDKit force field that uff_minimize_rd_mol uses.
+    It is minimized with L-BFGS over all of the atom
+    coordinates, since RDKit force fields can not be
+    extended with custom terms.
+    '''
+    def __init__(self, uff, rec_grid, rd_mol):
+        self.uff = uff
+        self.rec_grid = rec_grid
+        self.conf = rd_mol.GetConformer()
+        self.vdw_x, self.vdw_D = get_uff_vdw_params(rd_mol)
+
+    def calc_energy_and_grad(self, pos):
+        rec_energy, rec_grad = self.rec_grid.get_energy(
+            pos.reshape(-1, 3), self.vdw_x, self.vdw_D
+        )
+        pos = pos.tolist()
+        energy = self.uff.CalcEnergy(pos) + rec_energy
+        grad = np.array(self.uff.CalcGrad(pos)) + rec_grad.ravel()
+        return energy, grad
+
+    def CalcEnergy(self):
+        return self.calc_energy_and_grad(self.conf.GetPositions().ravel())[0]
+
+    def Minimize(self, maxIts=200):
+        result = sp.optimize.minimize(
+            self.calc_energy_and_grad,
+            self.conf.GetPositions().ravel(),
+            jac=True,
+            method='L-BFGS-B', # same tolerances as RDKit
+            options=dict(maxiter=maxIts, ftol=1e-6, gtol=1e-4),
+        )
+        for i, xyz in enumerate(result.x.reshape(-1, 3)):
+            self.conf.SetAtomPosition(i, xyz.tolist())
+        return int(not result.success) # 0 if converged, like RDKit
+
+
 def uff_minimize_rd_mol(lig_mol, rec_mol=None, n_iters=200, n_tries=2):
     '''
     Attempt to minimize rd_mol with UFF.
     If rec_mol is provided, minimize in
     the context of the fixed receptor.
+    If rec_mol is a UFFGrid, the receptor
+    potential is interpolated from it
+    instead of using receptor atoms.
 
     Returns (min_mol, E_init, E_final, error).
     '''
@@ -674,6 +900,10 @@ def uff_minimize_rd_mol(lig_mol, rec_mol=None, n_iters=200, n_tries=2):
     E_final = np.nan
     error = None
 
+    rec_grid = None
+    if isinstance(rec_mol, UFFGrid):
+        rec_grid, rec_mol = rec_mol, None
+
     # regenerate hydrogen coords with rdkit
     lig_mol = Chem.AddHs(
         Chem.RemoveHs(lig_mol, updateExplicitCount=True, sanitize=False),
@@ -703,6 +933,9 @@ def uff_minimize_rd_mol(lig_mol, rec_mol=None, n_iters=200, n_tries=2):
         )
         uff.Initialize()
 
+        if rec_grid is not None: # add receptor potential from grid
+            uff = UFFGridForceField(uff, rec_grid, uff_mol)
+
         # get the initial energy
         E_init = uff.CalcEnergy()
 
@@ -752,66 +985,203 @@ def uff_minimize_rd_mol(lig_mol, rec_mol=None, n_iters=200, n_tries=2):
     return lig_mol, E_init, E_final, error
 
 
+def uff_minimize_in_worker(lig_mol, rec_mol=None, **kwargs):
+    '''
+    Minimize lig_mol with UFF in a worker process
+    and return the minimized Molecule. The mols
+    can be given in RDKit's binary format. This
+    is at module level so that it can be pickled.
+    '''
+    if isinstance(lig_mol, bytes):
+        lig_mol = Chem.Mol(lig_mol)
+    if isinstance(rec_mol, bytes):
+        rec_mol = Chem.Mol(rec_mol)
+    return Molecule(lig_mol).uff_minimize(rec_mol=rec_mol, **kwargs)
+
+
+class UFFMinimizer(object):
+    '''
+    A service for minimizing ligand poses with UFF
+    in a pool of n_workers processes, since it is
+    CPU-bound and independent across molecules.
+
+    Molecules are sent to the workers in RDKit's
+    binary format with double precision coords,
+    and the minimized Molecules are returned as
+    Futures.
+    If n_workers is 1, minimization runs in the
+    calling process when it is submitted.
+
+    Workers are spawned rather than forked, so they
+    never inherit CUDA state from the caller. Use it
+    as a context manager, or call close(), to shut
+    down the workers.
+    '''
+    def __init__(self, n_workers=1, n_iters=200, n_tries=2):
+        self.n_workers = n_workers
+        self.n_iters = n_iters
+        self.n_tries = n_tries
+        if n_workers > 1:
+            self.pool = ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        else:
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, lig_mol, rec_mol=None):
+        '''
+        Start minimizing lig_mol with UFF, in the
+        context of the fixed rec_mol (or UFFGrid)
+        if provided, and return a Future of the
+        minimized mol.
+        The minimization results (E_init, E_min,
+        min_rmsd, min_error and min_time) are
+        stored in the info of the minimized mol.
+        '''
+        kwargs = dict(n_iters=self.n_iters, n_tries=self.n_tries)
+
+        if self.pool is None:
+            future = Future()
+            try:
+                future.set_result(
+                    uff_minimize_in_worker(lig_mol, rec_mol, **kwargs)
+                )
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        # don't send the mol info, which can contain
+        #   unpicklable or large objects (e.g. ob_mol)
+        if isinstance(rec_mol, Chem.Mol):
+            rec_mol = rec_mol.ToBinary(
+                Chem.PropertyPickleOptions.CoordsAsDouble
+            )
+        return self.pool.submit(
+            uff_minimize_in_worker,
+            lig_mol.ToBinary(Chem.PropertyPickleOptions.CoordsAsDouble),
+            rec_mol,
+            **kwargs
+        )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
 def gnina_minimize_rd_mol(lig_mol, rec_mol):
     '''
     Minimize lig_mol wrt rec_mol using gnina.
-    gnina is run as a subprocess, which needs
-    the mols to be present on disk. Check for
-    src_file or out_file, else use temp_file.
+    The minimization results are stored in
+    the info attribute of the returned mol.
+    '''
+    return gnina_minimize_rd_mols([lig_mol], rec_mol)[0]
+
+
+def gnina_minimize_rd_mols(lig_mols, rec_mol):
     '''
-    if lig_mol.n_atoms == 0:
-        return Molecule(Chem.RWMol(lig_mol), error='No atoms')
+    Minimize each of lig_mols wrt rec_mol using
+    a single gnina run, to avoid the overhead of
+    starting gnina and loading its models for each
+    mol. gnina is run as a subprocess, which needs
+    the mols to be present on disk, so the ligands
+    are written to one temp file, titled by index,
+    and the output poses are mapped back by title.
+
+    Returns a list of minimized mols, with an error
+    in the info of each (None if successful).
+    '''
+    out_mols = [None] * len(lig_mols)
+    for i, lig_mol in enumerate(lig_mols):
+        if lig_mol.n_atoms == 0:
+            out_mols[i] = Molecule(Chem.RWMol(lig_mol), error='No atoms')
+
+    lig_idxs = [i for i, m in enumerate(out_mols) if m is None]
+    if not lig_idxs:
+        return out_mols
 
     def get_temp_file():
         with tempfile.NamedTemporaryFile() as f:
             return f.name + '.sdf.gz'
 
-    def get_mol_as_file(mol):
-
-        if 'src_file' in mol.info:
-            return mol.info['src_file']
-        elif 'out_file' in mol.info:
-            return mol.info['out_file']
-        else:
-            tmp_file = get_temp_file()
-            mol.to_sdf(tmp_file, kekulize=False)
-            return tmp_file
-
-    rec_file = get_mol_as_file(rec_mol)
-    lig_file = get_mol_as_file(lig_mol)
+    if 'src_file' in rec_mol.info:
+        rec_file = rec_mol.info['src_file']
+    elif 'out_file' in rec_mol.info:
+        rec_file = rec_mol.info['out_file']
+    else:
+        rec_file = get_temp_file()
+        rec_mol.to_sdf(rec_file, kekulize=False)
+
+    # don't change the names of the original mols
+    lig_file = get_temp_file()
+    titled_mols = []
+    for i in lig_idxs:
+        titled_mol = Chem.Mol(lig_mols[i])
+        titled_mol.SetProp('_Name', f'lig_{i}')
+        titled_mols.append(titled_mol)
+    write_rd_mols_to_sdf_file(lig_file, titled_mols, kekulize=False)
     out_file = get_temp_file()
-    assert os.path.isfile(lig_file), 'lig file does not exist'
 
     cmd = f'{GNINA_CMD} --minimize -r {rec_file} -l {lig_file} ' \
         f'--autobox_ligand {lig_file} -o {out_file}'
 
-    error = None
-    last_stdout = ''
+    # gnina prints an affinity line for each mol that it
+    #   minimizes, so warnings are attributed to the mol
+    #   that follows the last one with an affinity line
+    errors = {i: None for i in lig_idxs}
+    n_minimized = 0
     proc = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE)
-    for c in iter(lambda: proc.stdout.read(1), b''): 
-        sys.stdout.buffer.write(c)
-        last_stdout += c.decode()
-        if c == b'*' or c == b'\n': # progress bar or new line
-            sys.stdout.flush()
-            if last_stdout.startswith('WARNING'):
-                error = last_stdout
-            last_stdout = ''
+    for line in iter(proc.stdout.readline, b''):
+        sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+        line = line.decode()
+        if line.startswith('Affinity'):
+            n_minimized += 1
+        elif line.startswith('WARNING') and n_minimized < len(lig_idxs):
+            errors[lig_idxs[n_minimized]] = line.rstrip()
+    proc.wait()
 
     stderr = proc.stderr.read().decode()
     for stderr_line in stderr.split('\n'):
         if stderr_line.startswith('CUDNN Error'):
-            error = stderr_line            
+            errors = {i: stderr_line for i in lig_idxs}
 
     print('GNINA STDERR', file=sys.stderr)
     print(stderr, file=sys.stderr)
     print('END GNINA STDERR', file=sys.stderr)
 
-    try: # get top-ranked pose according to gnina
-        out_mol = Molecule.from_sdf(out_file, idx=0, sanitize=False)
-    except IndexError:
-        out_mol = Molecule(Chem.RWMol(lig_mol))
-        if not error:
-            error = stderr
+    try: # get top-ranked pose of each mol according to gnina
+        gnina_mols = read_rd_mols_from_sdf_file(out_file, sanitize=False)
+    except (OSError, EOFError):
+        gnina_mols = []
+
+    for idx, gnina_mol in enumerate(gnina_mols):
+        i = int(gnina_mol.GetProp('_Name').rpartition('_')[2])
+        if out_mols[i] is not None: # only keep top-ranked pose
+            continue
+        if lig_mols[i].HasProp('_Name'):
+            gnina_mol.SetProp('_Name', lig_mols[i].GetProp('_Name'))
+        else:
+            gnina_mol.ClearProp('_Name')
+        out_mols[i] = Molecule(
+            gnina_mol,
+            src_file=out_file,
+            src_idx=idx,
+            **gnina_mol.GetPropsAsDict()
+        )
+
+    for i in lig_idxs:
+        if out_mols[i] is None:
+            out_mols[i] = Molecule(Chem.RWMol(lig_mols[i]))
+            if not errors[i]:
+                errors[i] = stderr or 'No output pose'
+        out_mols[i].info['error'] = errors[i]
 
-    out_mol.info['error'] = error
-    return out_mol
+    return out_mols
@@ -124,10 +124,10 @@ class GenerativeSolver(nn.Module):
         self.init_loss_fn(device=device, **loss_fn_kws)
 
         print('Initializing atom fitter and bond adder')
-        self.atom_fitter = atom_fitting.AtomFitter(
+        self.atom_fitter = atom_fitting.get_atom_fitter(
             device=device, **atom_fitting_kws
         )
-        self.bond_adder = bond_adding.BondAdder(
+        self.bond_adder = bond_adding.get_bond_adder(
             debug=debug, **bond_adding_kws
         )
 
@@ -1149,27 +1149,28 @@ class GenerativeSolver(nn.Module):
         last_test = None
         divides = lambda d, n: (n % d == 0)
 
-        while self.gen_iter <= max_iter:
-            i = self.gen_iter
+        with self.bond_adder: # shut down its workers when done
+            while self.gen_iter <= max_iter:
+                i = self.gen_iter
  
-            # save model and optimizer states
-            if last_save != i and divides(save_interval, i):
-                self.save_state()
-                last_save = i
-
-            # test models on test data
-            if last_test != i and divides(test_interval, i):
-                fit_atoms = (fit_interval > 0 and divides(fit_interval, i))
-                self.test_models(n_batches=n_test_batches, fit_atoms=fit_atoms)
-                last_test = i
-
-            # train models on training data
-            update = (i < max_iter)
-            compute_norm = (norm_interval > 0 and divides(norm_interval, i))
-            self.train_models(update=update, compute_norm=compute_norm)
-
-            if i == max_iter:
-                break
+                # save model and optimizer states
+                if last_save != i and divides(save_interval, i):
+                    self.save_state()
+                    last_save = i
+
+                # test models on test data
+                if last_test != i and divides(test_interval, i):
+                    fit_atoms = (fit_interval > 0 and divides(fit_interval, i))
+                    self.test_models(n_batches=n_test_batches, fit_atoms=fit_atoms)
+                    last_test = i
+
+                # train models on training data
+                update = (i < max_iter)
+                compute_norm = (norm_interval > 0 and divides(norm_interval, i))
+                self.train_models(update=update, compute_norm=compute_norm)
+
+                if i == max_iter:
+                    break
 
         self.save_state_and_metrics()
 
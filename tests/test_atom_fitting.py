@@ -1,4 +1,5 @@
-import sys, os, pytest
+import sys, os, json, pytest
+import numpy as np
 from numpy import isclose, allclose, inf
 import torch
 
@@ -8,7 +9,10 @@ from liGAN import molecules as mols
 from liGAN.atom_types import Atom, AtomTyper
 from liGAN.atom_grids import AtomGrid, size_to_dimension, round_dimension
 from liGAN.atom_structs import AtomStruct
-from liGAN.atom_fitting import AtomFitter
+from liGAN.atom_fitting import (
+    AtomFitter, DkoesAtomFitter, get_atom_fitter, get_struct_key,
+    MAX_KERNEL_FFTS,
+)
 from liGAN.metrics import compute_struct_rmsd
 
 
@@ -242,6 +246,56 @@ class TestAtomFitter(object):
         assert (conv_norm2 >= grid_norm2).all(), 'channel norm decreased'
         assert (conv_values > 0.5).any(), 'failed to detect atoms'
 
+    def test_fft_convolve(self, fitter, grid):
+        fitter.fft_conv = False
+        conv_values = fitter.convolve(
+            grid.elem_values, grid.resolution, grid.typer
+        )
+        fitter.fft_conv = True
+        fft_values = fitter.convolve(
+            grid.elem_values, grid.resolution, grid.typer
+        )
+        assert fft_values.shape == conv_values.shape, 'different shapes'
+        assert allclose(
+            fft_values.cpu(), conv_values.cpu(), atol=1e-4
+        ), 'different values'
+
+    def test_kernel_fft_cache(self, fitter, grid):
+        res, typer = grid.resolution, grid.typer
+        fitter.kernel_ffts.clear()
+        n = grid.values.shape[-1]
+        kernel_fft = fitter.get_kernel_fft((n, n, n), res, typer)
+        for m in range(n - 8, n + 8):
+            if (
+                fitter.get_fft_shape((m, m, m), res, typer)
+                == fitter.get_fft_shape((n, n, n), res, typer)
+            ):
+                assert fitter.get_kernel_fft((m, m, m), res, typer) \
+                    is kernel_fft, 'spectrum not shared'
+        for m in range(n, n + 4*MAX_KERNEL_FFTS):
+            fitter.get_kernel_fft((m, m, m), res, typer)
+            assert len(fitter.kernel_ffts) <= MAX_KERNEL_FFTS, 'cache too large'
+        last_fft = fitter.get_kernel_fft((m, m, m), res, typer)
+        assert fitter.get_kernel_fft((m, m, m), res, typer) is last_fft
+
+    def test_convolve_at(self, fitter, grid):
+        fitter.fft_conv = False
+        conv_values = fitter.convolve(
+            grid.elem_values, grid.resolution, grid.typer
+        )
+        values, idx_xyz, idx_c = fitter.sort_grid_points(grid.elem_values, k=20)
+        idx_xyz[-1] = 0 # include a point on the grid edge
+        idx_x, idx_y, idx_z = idx_xyz.T
+        point_values = fitter.convolve_at(
+            grid.elem_values, idx_xyz, idx_c, grid.resolution, grid.typer
+        )
+        assert point_values.shape == (len(idx_xyz), grid.n_elem_channels)
+        assert allclose(
+            point_values[torch.arange(len(idx_c)), idx_c].cpu(),
+            conv_values[idx_c, idx_x, idx_y, idx_z].cpu(),
+            atol=1e-5
+        ), 'different values'
+
     def test_apply_peak_value(self, fitter, grid):
         peak_values = fitter.apply_peak_value(grid.elem_values)
         assert (peak_values <= fitter.peak_value).all(), 'values above peak'
@@ -258,6 +312,36 @@ class TestAtomFitter(object):
         values, idx_xyz, idx_c = fitter.apply_threshold(values, idx_xyz, idx_c)
         assert (values > fitter.threshold).all(), 'values below threshold'
 
+    def test_apply_type_constraint(self, fitter, grid):
+        values, idx_xyz, idx_c = fitter.sort_grid_points(grid.elem_values)
+        values, idx_xyz, idx_c = fitter.apply_threshold(values, idx_xyz, idx_c)
+        type_counts = torch.arange(
+            grid.n_elem_channels, device=idx_c.device
+        ) % 3
+        coords = grid.get_coords(idx_xyz)
+        coords_c, idx_xyz_c, idx_c_c = fitter.apply_type_constraint(
+            coords, idx_xyz, idx_c, type_counts
+        )
+        for c in range(grid.n_elem_channels):
+            n_c = min(int(type_counts[c]), int((idx_c == c).sum()))
+            assert (idx_c_c == c).sum() == n_c, 'different type count'
+            assert (
+                idx_xyz_c[idx_c_c == c] == idx_xyz[idx_c == c][:n_c]
+            ).all(), 'not the highest values'
+
+    def test_find_peaks(self, fitter, grid):
+        values, idx_xyz, idx_c = fitter.find_peaks(
+            grid.elem_values, grid.resolution, grid.typer, k=10
+        )
+        idx_x, idx_y, idx_z = idx_xyz[:,0], idx_xyz[:,1], idx_xyz[:,2]
+        assert len(values) <= 10, 'too many peaks'
+        assert (values[:-1] >= values[1:]).all(), 'values not sorted'
+        assert (values > fitter.threshold).all(), 'values below threshold'
+        assert (grid.elem_values[idx_c, idx_x, idx_y, idx_z] == values).all(), \
+            'values not unsorted'
+        if len(values) > 0:
+            assert values[0] == grid.elem_values.max(), 'missed global max'
+
     def test_suppress_non_max(self, fitter, grid):
         values, idx_xyz, idx_c = fitter.sort_grid_points(grid.elem_values)
         values, idx_xyz, idx_c = fitter.apply_threshold(values, idx_xyz, idx_c)
@@ -277,6 +361,34 @@ class TestAtomFitter(object):
         assert (coords_mat == coords_for).all()
         assert (idx_c_mat == idx_c_for).all()
 
+    def test_suppress_non_max_hash(self, fitter, grid):
+        fitter.min_dist = 0.5
+        values, idx_xyz, idx_c = fitter.sort_grid_points(grid.elem_values)
+        values, idx_xyz, idx_c = fitter.apply_threshold(values, idx_xyz, idx_c)
+        coords = grid.get_coords(idx_xyz)
+        coords_all, idx_xyz_all, idx_c_all = fitter.suppress_non_max(
+            values, coords, idx_xyz, idx_c, grid.typer,
+            matrix=False, chunk_size=len(coords)
+        )
+        coords_chk, idx_xyz_chk, idx_c_chk = fitter.suppress_non_max(
+            values, coords, idx_xyz, idx_c, grid.typer,
+            matrix=False, chunk_size=16
+        )
+        assert (coords_all == coords_chk).all(), 'chunks changed result'
+        assert (idx_c_all == idx_c_chk).all(), 'chunks changed result'
+
+        r = grid.typer.elem_radii[idx_c_chk]
+        same_type = (idx_c_chk.unsqueeze(1) == idx_c_chk.unsqueeze(0))
+        dist = (coords_chk.unsqueeze(1) - coords_chk.unsqueeze(0)).norm(dim=2)
+        too_close = same_type & (dist < fitter.min_dist * 2 * r.unsqueeze(1))
+        assert not torch.tril(too_close, diagonal=-1).any(), 'too close'
+
+        coords_max, idx_xyz_max, idx_c_max = fitter.suppress_non_max(
+            values, coords, idx_xyz, idx_c, grid.typer,
+            matrix=False, chunk_size=16, max_count=3
+        )
+        assert (coords_max == coords_chk[:3]).all(), 'max_count changed result'
+
     def test_detect_atoms(self, fitter, grid):
         fitter.n_atoms_detect = None
         coords, types = fitter.detect_atoms(grid)
@@ -326,3 +438,333 @@ class TestAtomFitter(object):
 
         assert prop_diff == 0, \
             'different property counts ({})'.format(prop_diff)
+
+    def test_fit_many(self, fitter, grid):
+        fit_struct, fit_grid, _ = fitter.fit_struct(grid)
+        fits = fitter.fit_many([grid, grid, grid], n_workers=2)
+        assert len(fits) == 3, 'different num fits'
+        for fit_struct_i, fit_grid_i, visited_structs_i, fit_time_i in fits:
+            assert fit_struct_i.n_atoms == fit_struct.n_atoms, \
+                'different num atoms'
+            assert allclose(
+                fit_struct_i.coords.cpu(), fit_struct.coords.cpu(), atol=1e-5
+            ), 'different coords'
+            assert fit_struct_i == visited_structs_i[-1], \
+                'final struct is not last visited'
+            assert fit_time_i > 0, 'no fit time'
+
+        # peak memory is measured once around concurrent fits
+        peak_memory = fits[0][0].info['fit_stats']['peak_memory']
+        assert peak_memory > 0
+        for fit_struct_i, _, _, _ in fits:
+            assert fit_struct_i.info['fit_stats']['peak_memory'] == peak_memory
+        assert fitter.track_memory, 'memory tracking not restored'
+
+    def test_fit_stats(self, fitter, grid, tmp_path):
+        fitter.trace_file = str(tmp_path / 'trace.jsonl')
+        fitter.record_visited = True
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        fit_stats = fit_struct.info['fit_stats']
+        assert fit_stats['n_visited'] == len(visited_structs)
+        assert fit_stats['n_atoms'] == fit_struct.n_atoms
+        assert fit_stats['n_steps'] == len(fit_stats['beam_sizes'])
+        assert all(0 < b <= fitter.beam_size for b in fit_stats['beam_sizes'])
+        assert fit_stats['n_gd_iters'] >= fitter.final_gd_iters
+        assert fit_stats['peak_memory'] > 0
+        assert fit_stats['fit_time'] >= (
+            fit_stats['detect_time'] + fit_stats['expand_time']
+            + fit_stats['gd_time']
+        ), 'phase times exceed total time'
+
+        with open(fitter.trace_file) as f:
+            lines = f.readlines()
+        assert len(lines) == 2, 'different num trace lines'
+        assert json.loads(lines[-1]) == fit_stats, 'different trace stats'
+
+    def test_record_visited(self, fitter, grid):
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        assert len(visited_structs) == 1, 'visited structs were recorded'
+        assert visited_structs[-1] == fit_struct
+
+        fitter.record_visited = True
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        n_visited = fit_struct.info['fit_stats']['n_visited']
+        assert len(visited_structs) == n_visited, 'different num visited'
+        assert visited_structs[-1] == fit_struct
+        assert visited_structs[0].n_atoms == 0, 'initial struct not empty'
+        for struct in visited_structs:
+            assert struct.n_atoms <= fit_struct.n_atoms + 1
+            assert struct.types.shape == (struct.n_atoms, grid.n_channels)
+
+    def test_warm_start(self, fitter, grid):
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+
+        # perturb coords and replace first atom with a spurious atom
+        coords = fit_struct.coords + 0.2 * torch.randn_like(fit_struct.coords)
+        coords[:1] = grid.center + grid.dimension / 2
+        init_struct = AtomStruct(coords, fit_struct.types, grid.typer)
+
+        warm_struct, warm_grid, visited_structs = fitter.fit_struct(
+            grid, init_struct=init_struct
+        )
+        fit_stats = warm_struct.info['fit_stats']
+        assert fit_stats['n_init_atoms'] == init_struct.n_atoms
+        if fit_struct.n_atoms > 0:
+            assert fit_stats['n_init_removed'] >= 1, 'spurious atom not removed'
+        assert warm_struct.n_atoms == fit_struct.n_atoms, 'different num atoms'
+        elem_diff = (warm_struct.elem_counts - fit_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+
+    def test_warm_start_duplicate(self, fitter, grid):
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        if fit_struct.n_atoms == 0:
+            return
+
+        # add a second atom on top of the first one
+        coords = torch.cat([fit_struct.coords[:1], fit_struct.coords])
+        types = torch.cat([fit_struct.types[:1], fit_struct.types])
+        init_struct = AtomStruct(coords, types, grid.typer)
+
+        warm_struct, warm_grid, visited_structs = fitter.fit_struct(
+            grid, init_struct=init_struct
+        )
+        fit_stats = warm_struct.info['fit_stats']
+        assert fit_stats['n_init_removed'] >= 1, 'duplicate atom not removed'
+        assert warm_struct.n_atoms == fit_struct.n_atoms, 'different num atoms'
+
+    def test_dkoes_fit(self, grid):
+        # atom starts are randomly sampled
+        fitter = get_atom_fitter('dkoes', seed=0, device='cuda')
+        assert isinstance(fitter, DkoesAtomFitter)
+
+        struct = grid.info['src_struct']
+        fits = fitter.fit_many([grid, grid])
+        assert len(fits) == 2, 'different num fits'
+        for fit_struct, fit_grid, visited_structs, fit_time in fits:
+            assert fit_struct == visited_structs[-1], \
+                'final struct is not last visited'
+            elem_diff = (struct.elem_counts - fit_struct.elem_counts)
+            assert elem_diff.abs().sum() == 0, 'different element counts'
+            prop_diff = (struct.prop_counts - fit_struct.prop_counts)
+            assert prop_diff.abs().sum() == 0, 'different property counts'
+            rmsd = compute_struct_rmsd(struct, fit_struct, catch_exc=False)
+            assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_dkoes_fit_seed(self, grid):
+        fits = [
+            get_atom_fitter('dkoes', seed=1, device='cuda').fit_many([grid])
+                for i in range(2)
+        ]
+        struct1, struct2 = fits[0][0][0], fits[1][0][0]
+        assert struct1.n_atoms == struct2.n_atoms, 'different num atoms'
+        assert (struct1.coords == struct2.coords).all(), 'different coords'
+
+    def test_one_shot(self, fitter, grid):
+        fitter.one_shot = True
+        struct = grid.info['src_struct']
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        fit_stats = fit_struct.info['fit_stats']
+        assert fit_stats['n_steps'] == 0, 'beam search was performed'
+
+        elem_diff = (struct.elem_counts - fit_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        prop_diff = (struct.prop_counts - fit_struct.prop_counts)
+        assert prop_diff.abs().sum() == 0, 'different property counts'
+        rmsd = compute_struct_rmsd(struct, fit_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_refine_atoms(self, fitter, grid):
+        struct = grid.info['src_struct']
+        coords = struct.coords.clone()
+        coords[0] = grid.center + grid.dimension / 2 # misplace first atom
+        coords, values_fit, values_diff, loss = fitter.gd(
+            grid, coords, struct.types, 0
+        )
+        coords, values_diff, new_loss, n_moved = fitter.refine_atoms(
+            grid, coords, struct.types, values_diff, loss
+        )
+        assert n_moved >= 1, 'misplaced atom not moved'
+        assert new_loss < loss, 'loss did not decrease'
+        assert (coords[0] - struct.coords[0]).norm() < 0.5, \
+            'atom not moved to missing density'
+
+    def test_constrain_types(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.constrain_types = True
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(
+            grid, struct.type_counts
+        )
+        assert fit_struct.info['type_diff'] == 0, 'type counts not satisfied'
+        elem_diff = (struct.elem_counts - fit_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        assert fit_struct.info['fit_stats']['n_steps'] <= struct.n_atoms, \
+            'search did not stop when type counts were satisfied'
+
+    def test_crop_grid(self, fitter, grid):
+        struct = grid.info['src_struct']
+
+        # pad the grid with empty space, keeping the same center
+        big_grid = grid.new_like(
+            values=torch.nn.functional.pad(grid.values, (8,)*6)
+        )
+        fitter.crop_threshold = 0.01
+        crop_grid = fitter.crop_grid(big_grid)
+        assert crop_grid.size <= grid.size + 2*fitter.kernel.shape[-1]//2
+
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(big_grid)
+        assert fit_grid.shape == big_grid.shape, 'fit grid not full size'
+        assert fit_struct.info['fit_stats']['grid_size'] == crop_grid.size
+        elem_diff = (struct.elem_counts - fit_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        rmsd = compute_struct_rmsd(struct, fit_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_coarse_fit(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.coarse_factor = 2
+        fit_struct, fit_grid, visited_structs = fitter.fit_struct(grid)
+        assert fit_grid.shape == grid.shape, 'fit grid not full resolution'
+        fit_stats = fit_struct.info['fit_stats']
+        assert 0 < fit_stats['coarse_time'] <= fit_stats['fit_time']
+        elem_diff = (struct.elem_counts - fit_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        prop_diff = (struct.prop_counts - fit_struct.prop_counts)
+        assert prop_diff.abs().sum() == 0, 'different property counts'
+        rmsd = compute_struct_rmsd(struct, fit_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_get_loss_decrease_bounds(self, fitter, grid):
+        struct = grid.info['src_struct']
+        coords = grid.get_coords(grid.get_index(struct.coords))
+        bounds = fitter.get_loss_decrease_bounds(grid, coords, struct.types)
+        assert bounds.shape == (struct.n_atoms,)
+
+        # the bound holds for adding each atom at a fixed position
+        _, _, _, loss0 = fitter.gd(grid, coords[:0], struct.types[:0], 0)
+        for i in range(struct.n_atoms):
+            _, _, _, loss = fitter.gd(
+                grid, coords[i:i+1], struct.types[i:i+1], 0
+            )
+            assert loss0 - loss <= bounds[i] + 1e-3, 'loss decrease above bound'
+
+    def test_prune_bound(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.beam_size = 2
+        fitter.n_atoms_detect = 2
+        fitter.min_dist = 0.5
+        fit_struct, _, _ = fitter.fit_struct(grid)
+        fitter.prune_bound = True
+        prune_struct, _, _ = fitter.fit_struct(grid)
+
+        fit_stats = fit_struct.info['fit_stats']
+        prune_stats = prune_struct.info['fit_stats']
+        assert prune_stats['n_gd_iters'] <= fit_stats['n_gd_iters']
+        elem_diff = (struct.elem_counts - prune_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        rmsd = compute_struct_rmsd(struct, prune_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_get_struct_key(self, grid):
+        struct = grid.info['src_struct']
+        coords = torch.round(struct.coords / 0.25) * 0.25
+        types = struct.types
+        key = get_struct_key(coords, types, 0.25)
+        perm = torch.randperm(struct.n_atoms, device=coords.device)
+        assert get_struct_key(coords[perm], types[perm], 0.25) == key, \
+            'different key for same atoms'
+        assert get_struct_key(coords + 0.01, types, 0.25) == key, \
+            'different key for nearby atoms'
+        assert get_struct_key(coords[1:], types[1:], 0.25) != key, \
+            'same key for different atoms'
+
+    def test_dedupe(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.beam_size = 4
+        fitter.n_atoms_detect = 2
+        fitter.min_dist = 0.5
+        fit_struct, _, _ = fitter.fit_struct(grid)
+        fitter.dedupe_resolution = 0.5
+        dedupe_struct, _, _ = fitter.fit_struct(grid)
+
+        fit_stats = fit_struct.info['fit_stats']
+        dedupe_stats = dedupe_struct.info['fit_stats']
+        assert fit_stats['n_duplicates'] == 0
+        assert dedupe_stats['n_duplicates'] < dedupe_stats['n_visited']
+        elem_diff = (struct.elem_counts - dedupe_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        rmsd = compute_struct_rmsd(struct, dedupe_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
+
+    def test_peak_index(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.apply_conv = True
+        fitter.peak_block_size = 4
+        fitter.peak_update_tol = 0.0
+        peak_index = fitter.get_peak_index(grid)
+        values, _, _ = fitter.sort_grid_points(fitter.get_detect_values(grid))
+        top_values, _, _, bound = peak_index.top_points(4)
+        assert (top_values > bound).all(), 'values not above bound'
+        assert (top_values == values[:len(top_values)]).all(), \
+            'different top values'
+
+        # update index after adding the last atom and moving the first
+        coords, types = struct.coords.clone(), struct.types
+        coords[0] += 0.5
+        _, _, values_old, _ = fitter.gd(grid, coords[:-1], types[:-1], 0)
+        _, _, values_new, _ = fitter.gd(grid, struct.coords, types, 0)
+        old_index = fitter.get_peak_index(grid.new_like(values=values_old))
+        new_index = fitter.get_peak_index(grid.new_like(values=values_new))
+        upd_index = fitter.update_peak_index(
+            old_index, grid.new_like(values=values_new),
+            coords[:-1], struct.coords, types
+        )
+        assert allclose(
+            upd_index.values.cpu(), new_index.values.cpu(), atol=1e-4
+        ), 'different values'
+        assert allclose(
+            upd_index.block_max.cpu(), new_index.block_max.cpu(), atol=1e-4
+        ), 'different block maxima'
+
+    def test_peak_index_drift(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.apply_conv = True
+        fitter.peak_block_size = 4
+        fitter.peak_update_tol = 0.3
+
+        # move the first atom by less than the tolerance twice
+        coords, types = struct.coords, struct.types
+        peak_index = fitter.get_peak_index(
+            grid.new_like(values=fitter.gd(grid, coords, types, 0)[2])
+        )
+        for i in range(2):
+            new_coords = coords.clone()
+            new_coords[0] += 0.2 / np.sqrt(3)
+            _, _, values_new, _ = fitter.gd(grid, new_coords, types, 0)
+            peak_index = fitter.update_peak_index(
+                peak_index, grid.new_like(values=values_new),
+                coords, new_coords, types
+            )
+            coords = new_coords
+
+        new_index = fitter.get_peak_index(grid.new_like(values=values_new))
+        assert allclose(
+            peak_index.values.cpu(), new_index.values.cpu(), atol=1e-4
+        ), 'atom moved beyond tolerance was not updated'
+
+    def test_peak_block_size(self, fitter, grid):
+        struct = grid.info['src_struct']
+        fitter.beam_size = 2
+        fitter.n_atoms_detect = 2
+        fitter.min_dist = 0.5
+        fit_struct, _, _ = fitter.fit_struct(grid)
+        fitter.peak_block_size = 4
+        peak_struct, _, _ = fitter.fit_struct(grid)
+
+        fit_stats = fit_struct.info['fit_stats']
+        peak_stats = peak_struct.info['fit_stats']
+        assert peak_stats['n_visited'] == fit_stats['n_visited']
+        elem_diff = (struct.elem_counts - peak_struct.elem_counts)
+        assert elem_diff.abs().sum() == 0, 'different element counts'
+        rmsd = compute_struct_rmsd(struct, peak_struct, catch_exc=False)
+        assert rmsd < 0.5, 'RMSD too high ({:.2f})'.format(rmsd)
@@ -69,6 +69,44 @@ class TestAtomGrid(object):
         assert idx_xyz.shape[1] == 3
         coords = grid.get_coords(idx_xyz)
 
+    def test_get_index(self, grid):
+        idx = torch.arange(grid.size**3)
+        idx_xyz = unravel_index(idx, grid.shape[1:])
+        coords = grid.get_coords(idx_xyz)
+        noise = 0.4 * grid.resolution * (2*torch.rand_like(coords) - 1)
+        assert (grid.get_index(coords + noise) == idx_xyz).all(), \
+            'different index'
+        assert (grid.get_index(coords * 10) >= 0).all(), 'index below grid'
+        assert (grid.get_index(coords * 10) < grid.size).all(), \
+            'index above grid'
+
+    def test_crop(self, grid):
+        grid.values[...] = 0
+        grid.values[0,3,1,2] = grid.values[0,4,1,1] = 1
+        crop_grid = grid.crop(threshold=0.5)
+        assert crop_grid.size == 2, 'different size'
+        assert crop_grid.values.sum() == 2, 'values not in crop'
+        idx = torch.tensor([[0,0,0],[1,1,1]])
+        assert allclose(
+            crop_grid.get_coords(idx),
+            grid.get_coords(idx + torch.tensor([3,0,1]))
+        ), 'different coords'
+        assert grid.crop(threshold=0.5, padding=2).size == grid.size
+        assert grid.crop(threshold=1.0) is grid, 'cropped empty grid'
+
+    def test_downsample(self, grid):
+        coarse_grid = grid.downsample(2)
+        assert coarse_grid.size == 3, 'different size'
+        assert coarse_grid.resolution == 2 * grid.resolution
+        idx = unravel_index(torch.arange(27), coarse_grid.shape[1:])
+        assert allclose(
+            coarse_grid.get_coords(idx), grid.get_coords(2*idx)
+        ), 'different coords'
+        assert (
+            coarse_grid.values[:, idx[:,0], idx[:,1], idx[:,2]] ==
+            grid.values[:, 2*idx[:,0], 2*idx[:,1], 2*idx[:,2]]
+        ).all(), 'different values'
+
     def test_prop_values(self, grid):
         out_values = torch.cat(
             [grid.elem_values] + list(grid.prop_values), dim=0
@@ -6,7 +6,11 @@ sys.path.insert(0, '.')
 import liGAN.molecules as mols
 from liGAN.molecules import ob, Molecule
 from liGAN.atom_types import Atom, AtomTyper
-from liGAN.bond_adding import BondAdder, get_max_valences, reachable, compare_bonds
+from liGAN.bond_adding import (
+    BondAdder, RDKitBondAdder, get_bond_adder, get_max_valences,
+    reachable, compare_bonds, get_pairs_within_distance, find_bridges,
+    BondTable
+)
 
 
 test_sdf_files = [
@@ -251,6 +255,16 @@ def test_highly_fused_rings():
     mols.Molecule.from_ob_mol(ob_mol)
 
 
+def test_get_pairs_within_distance():
+    coords = np.random.normal(0, 5, (200, 3))
+    coords[1] = coords[0] # include a pair at zero distance
+    pairs = get_pairs_within_distance(coords, 0.01, 4.0)
+    dists = np.linalg.norm(coords[:,None] - coords[None,:], axis=2)
+    i, j = np.nonzero(np.triu((0.01 < dists) & (dists < 4.0), k=1))
+    assert (pairs == np.stack([i, j], axis=1)).all(), 'different pairs'
+    assert len(get_pairs_within_distance(coords[:1], 0.01, 4.0)) == 0
+
+
 def test_reachable_basic():
     '''
     D--E
@@ -333,6 +347,55 @@ def test_reachable_recursion(dense):
     assert reachable(atom_a, atom_b), 'not reachable'
 
 
+def test_find_bridges():
+    '''
+    0   3--4   7
+    |\  | /
+    | \ |/
+    1--2   5--6
+    '''
+    bonds = [(0,1), (1,2), (2,0), (2,3), (3,4), (4,5), (5,3), (5,6)]
+    is_bridge = find_bridges(8, bonds)
+    assert is_bridge.tolist() == [0, 0, 0, 1, 0, 0, 0, 1]
+    assert len(find_bridges(3, [])) == 0
+
+
+def test_bond_table(dense):
+    table = BondTable.from_ob_mol(dense, min_bond_angle=45)
+    for bond, ob_bond in zip(table.bonds(), ob.OBMolBondIter(dense)):
+        atom_a, atom_b = ob_bond.GetBeginAtom(), ob_bond.GetEndAtom()
+        assert isclose(table.lengths[bond], ob_bond.GetLength())
+        assert table.orders[bond] == ob_bond.GetBondOrder()
+        assert table.is_bridge(bond) != reachable(atom_a, atom_b)
+        assert table.forms_small_angle(bond) == (any(
+            atom_b.GetAngle(atom_a, nbr) < 45
+                for nbr in ob.OBAtomAtomIter(atom_a) if nbr != atom_b
+        ) or any(
+            atom_a.GetAngle(atom_b, nbr) < 45
+                for nbr in ob.OBAtomAtomIter(atom_b) if nbr != atom_a
+        ))
+    for atom in ob.OBMolAtomIter(dense):
+        assert table.degrees[atom.GetIdx()-1] == atom.GetExplicitDegree()
+        assert table.valences[atom.GetIdx()-1] == atom.GetExplicitValence()
+
+
+def test_bond_table_update(dense):
+    table = BondTable.from_ob_mol(dense)
+    table.forms_small_angle(0)
+    table.set_bond_order(0, 2)
+    table.delete_bond(1)
+    assert dense.NumBonds() == len(table.bonds())
+
+    new_table = BondTable.from_ob_mol(dense)
+    assert (new_table.degrees == table.degrees).all()
+    assert (new_table.valences == table.valences).all()
+    for bond, new_bond in zip(table.bonds(), new_table.bonds()):
+        assert new_table.orders[new_bond] == table.orders[bond]
+        assert new_table.forms_small_angle(new_bond) == \
+            table.forms_small_angle(bond)
+        assert new_table.is_bridge(new_bond) == table.is_bridge(bond)
+
+
 class TestBondAdding(object):
 
     @pytest.fixture(params=test_typer_fns)
@@ -477,6 +540,34 @@ class TestBondAdding(object):
         assert out_smi == in_smi, \
             'different SMILES strings ({:.3f})'.format(ob_sim)
 
+    def test_make_batch(self, adder, typer):
+        structs = []
+        for sdf_file in test_sdf_files:
+            in_mol = mols.read_ob_mols_from_file(sdf_file, 'sdf')[0]
+            in_mol.AddHydrogens()
+            structs.append(typer.make_struct(in_mol))
+
+        out_mols1, add_structs1 = adder.make_batch(structs, n_workers=1)
+        assert adder.pool is None, 'pool started for one worker'
+        with adder:
+            out_mols2, add_structs2 = adder.make_batch(structs, n_workers=2)
+            pool = adder.pool
+            adder.make_batch(structs[:2], n_workers=2)
+            assert adder.pool is pool, 'pool was not reused'
+        assert adder.pool is None, 'pool was not closed'
+        assert len(out_mols2) == len(add_structs2) == len(structs)
+
+        for out_mol1, out_mol2 in zip(out_mols1, out_mols2):
+            assert out_mol2.to_smi() == out_mol1.to_smi(), 'different mols'
+            heavy = [a.GetAtomicNum() != 1 for a in out_mol1.atoms]
+            assert isclose(
+                out_mol2.coords[heavy], out_mol1.coords[heavy], atol=1e-4
+            ).all(), 'different coords'
+
+        for add_struct1, add_struct2 in zip(add_structs1, add_structs2):
+            assert (add_struct2.types == add_struct1.types).all()
+            assert add_struct2.typer is add_struct1.typer
+
     def test_make_mol(self, adder, typer, in_mol):
         struct = typer.make_struct(in_mol)
         out_mol, add_struct, visited_mols = adder.make_mol(struct)
@@ -517,6 +608,28 @@ class TestBondAdding(object):
         rmsd = out_mol.aligned_rmsd(in_mol)
         assert rmsd < 1.0, 'RMSD too high ({})'.format(rmsd)
 
+    def test_rdkit_make_mol(self, typer, in_mol):
+        adder = RDKitBondAdder(debug=True)
+        struct = typer.make_struct(in_mol)
+        out_mol, add_struct, visited_mols = adder.make_mol(struct)
+        in_mol = Molecule.from_ob_mol(in_mol)
+        write_rd_pymol(visited_mols, in_mol)
+
+        n_atoms_diff = (in_mol.n_atoms - out_mol.n_atoms)
+        elem_diff = (struct.elem_counts - add_struct.elem_counts).abs().sum()
+        assert n_atoms_diff == 0, \
+            'different num atoms ({})'.format(n_atoms_diff)
+        assert elem_diff == 0, \
+            'different element counts ({})'.format(elem_diff)
+
+        out_valid, out_reason = out_mol.validate()
+        assert out_valid, 'out_mol ' + out_reason
+
+        heavy = [a.GetAtomicNum() != 1 for a in out_mol.atoms]
+        assert isclose(
+            out_mol.coords[heavy], struct.coords.cpu().numpy(), atol=1e-4
+        ).all(), 'different coords'
+
     def test_uff_minimize(self, adder, typer, in_mol):
         struct = typer.make_struct(in_mol)
         out_mol, add_struct, visited_mols = adder.make_mol(struct)
@@ -526,3 +639,11 @@ class TestBondAdding(object):
         in_mol.validate()
         in_mol_min = in_mol.uff_minimize()
         write_rd_pymol(visited_mols + [out_mol_min, in_mol_min], in_mol)
+
+
+def test_get_bond_adder():
+    assert type(get_bond_adder()) == BondAdder
+    assert type(get_bond_adder('ob')) == BondAdder
+    assert type(get_bond_adder('rdkit', min_bond_len=0.1)) == RDKitBondAdder
+    with pytest.raises(ValueError):
+        get_bond_adder('pybel')
@@ -1,9 +1,11 @@
-import sys, os, pytest
+import sys, os, pytest, itertools
+import numpy as np
+import scipy as sp
 from numpy import isclose
 
 sys.path.insert(0, '.')
 from liGAN import molecules as mols
-from liGAN.molecules import ob
+from liGAN.molecules import ob, Chem, AllChem
 
 
 class TestOBMol(object):
@@ -112,3 +114,265 @@ class TestOBMol(object):
     def test_benzene_to_smi(self, benzene):
         smi = mols.ob_mol_to_smi(benzene, 'cnh').rstrip()
         assert smi == '[H]c1c([H])c([H])c(c(c1[H])[H])[H]'
+
+
+class TestReceptorContext(object):
+
+    @pytest.fixture
+    def rec_mol(self):
+        return mols.Molecule.from_pdb(
+            'data/crossdock2020/1A02_HUMAN_25_199_pep_0/1eez_A_rec.pdb'
+        )
+
+    @pytest.fixture
+    def lig_mol(self):
+        return mols.Molecule.from_sdf(
+            'data/crossdock2020/1A02_HUMAN_25_199_pep_0/'
+            '1eez_A_rec_2gj6_3ib_lig_tt_min_0.sdf.gz'
+        )
+
+    def test_init(self, rec_mol):
+        rec_ctx = mols.ReceptorContext(rec_mol)
+        assert rec_ctx.rec_mol is rec_mol
+        assert len(rec_ctx.atom_res_idxs) == rec_mol.n_atoms
+        assert rec_ctx.n_residues == len(set(
+            mols.get_rd_atom_res_id(a) for a in rec_mol.atoms
+        ))
+
+    def test_get_pocket(self, rec_mol, lig_mol):
+        rec_ctx = mols.ReceptorContext(rec_mol)
+        pkt_mol = rec_ctx.get_pocket(lig_mol, max_dist=8)
+
+        # pocket has every atom of every residue near the ligand
+        dist = sp.spatial.distance.cdist(lig_mol.coords, rec_mol.coords)
+        pkt_res_ids = set(
+            mols.get_rd_atom_res_id(rec_mol.GetAtomWithIdx(int(i)))
+                for i in np.nonzero(dist < 8)[1]
+        )
+        is_pocket = [
+            mols.get_rd_atom_res_id(a) in pkt_res_ids for a in rec_mol.atoms
+        ]
+        assert 0 < pkt_mol.n_atoms < rec_mol.n_atoms
+        assert pkt_mol.n_atoms == sum(is_pocket)
+        assert isclose(pkt_mol.coords, rec_mol.coords[is_pocket]).all()
+        assert set(
+            mols.get_rd_atom_res_id(a) for a in pkt_mol.atoms
+        ) == pkt_res_ids
+
+    def test_get_pocket_shared(self, rec_mol, lig_mol):
+        rec_ctx = mols.ReceptorContext(rec_mol)
+        pkt_mol1 = rec_ctx.get_pocket(lig_mol)
+        pkt_mol2 = rec_ctx.get_pocket(lig_mol)
+        assert rec_ctx.rec_mol.n_atoms == rec_mol.n_atoms
+        assert pkt_mol1.n_atoms == pkt_mol2.n_atoms
+        assert isclose(pkt_mol1.coords, pkt_mol2.coords).all()
+
+
+@pytest.fixture
+def lig_mol():
+    lig_mol = mols.read_ob_mols_from_file(
+        'data/crossdock2020/1A02_HUMAN_25_199_pep_0/'
+        '1eez_A_rec_2gj6_3ib_lig_tt_min_0.sdf.gz', 'sdf'
+    )[0]
+    lig_mol.AddHydrogens()
+    return mols.Molecule.from_ob_mol(lig_mol)
+
+
+@pytest.fixture
+def pkt_mol(lig_mol):
+    rec_mol = mols.Molecule.from_pdb(
+        'data/crossdock2020/1A02_HUMAN_25_199_pep_0/1eez_A_rec.pdb'
+    )
+    return rec_mol.get_pocket(lig_mol)
+
+
+class TestUFFMinimizer(object):
+
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_submit(self, lig_mol, pkt_mol, n_workers):
+        uff_minimizer = mols.UFFMinimizer(n_workers, n_iters=10, n_tries=1)
+        futures = [
+            uff_minimizer.submit(lig_mol, pkt_mol),
+            uff_minimizer.submit(lig_mol),
+        ]
+        uff_mols = [f.result() for f in futures]
+        uff_minimizer.close()
+
+        for uff_mol, rec_mol in zip(uff_mols, [pkt_mol, None]):
+            ref_mol = lig_mol.uff_minimize(rec_mol, n_iters=10, n_tries=1)
+            assert isinstance(uff_mol, mols.Molecule)
+            assert uff_mol.n_atoms == ref_mol.n_atoms
+            for key in ['E_init', 'E_min', 'min_rmsd', 'min_error']:
+                assert uff_mol.info[key] == pytest.approx(
+                    ref_mol.info[key], nan_ok=True
+                ), 'different ' + key
+            assert isclose(uff_mol.coords, ref_mol.coords, atol=1e-4).all()
+
+    def test_context(self, lig_mol):
+        with pytest.raises(ZeroDivisionError):
+            with mols.UFFMinimizer(2) as uff_minimizer:
+                uff_minimizer.submit(lig_mol).result()
+                1 / 0
+        assert uff_minimizer.pool is None, 'pool was not closed'
+
+
+class TestUFFGrid(object):
+
+    @pytest.fixture
+    def uff_grid(self, lig_mol, pkt_mol):
+        return mols.UFFGrid(pkt_mol, lig_mol.center, cutoff=np.inf)
+
+    @pytest.fixture
+    def uff_lig_mol(self, lig_mol):
+        uff_lig_mol = Chem.Mol(lig_mol)
+        Chem.SanitizeMol(uff_lig_mol)
+        return uff_lig_mol
+
+    def get_uff_energy(self, rd_mol):
+        rd_mol = Chem.Mol(rd_mol)
+        Chem.SanitizeMol(rd_mol)
+        return AllChem.UFFGetMoleculeForceField(
+            rd_mol, ignoreInterfragInteractions=False
+        ).CalcEnergy()
+
+    def test_init(self, uff_grid):
+        assert uff_grid.values.shape == (2, 48, 48, 48)
+        assert np.isfinite(uff_grid.values).all()
+        assert (uff_grid.values > 0).all()
+
+    def test_get_energy(self, uff_grid, uff_lig_mol, pkt_mol):
+        # interaction energy of the complex, from the full force field
+        E_int = (
+            self.get_uff_energy(Chem.CombineMols(pkt_mol, uff_lig_mol))
+            - self.get_uff_energy(pkt_mol)
+            - self.get_uff_energy(uff_lig_mol)
+        )
+        E_grid, grad = uff_grid.get_energy(
+            uff_lig_mol.GetConformer().GetPositions(),
+            *mols.get_uff_vdw_params(uff_lig_mol)
+        )
+        assert E_grid == pytest.approx(E_int, abs=0.5)
+
+    def test_get_energy_grad(self, uff_grid, uff_lig_mol):
+        coords = uff_lig_mol.GetConformer().GetPositions()
+        vdw_params = mols.get_uff_vdw_params(uff_lig_mol)
+        E, grad = uff_grid.get_energy(coords, *vdw_params)
+
+        eps = 1e-5
+        for i, j in itertools.product(range(len(coords)), range(3)):
+            delta = np.zeros_like(coords)
+            delta[i,j] = eps
+            E_pos, _ = uff_grid.get_energy(coords + delta, *vdw_params)
+            E_neg, _ = uff_grid.get_energy(coords - delta, *vdw_params)
+            assert grad[i,j] == pytest.approx(
+                (E_pos - E_neg) / (2*eps), rel=1e-3, abs=1e-3
+            )
+
+    def test_uff_minimize(self, uff_grid, lig_mol, pkt_mol):
+        uff_mol = lig_mol.uff_minimize(rec_mol=uff_grid)
+        ref_mol = lig_mol.uff_minimize(rec_mol=pkt_mol)
+        assert uff_mol.n_atoms == ref_mol.n_atoms
+        assert uff_mol.info['E_min'] < uff_mol.info['E_init']
+        rmsd = np.sqrt(((uff_mol.coords - lig_mol.coords)**2).sum(axis=1).mean())
+        assert rmsd < 2.0
+        assert uff_mol.info['min_error'] in {None, 'Not converged'}
+
+    def test_interpolate_not_finite(self, uff_grid, uff_lig_mol):
+        coords = uff_lig_mol.GetConformer().GetPositions()
+        coords[0] = np.nan
+        values, grads = uff_grid.interpolate(coords)
+        assert np.isnan(values[0]).all() and np.isnan(grads[0]).all()
+        assert np.isfinite(values[1:]).all() and np.isfinite(grads[1:]).all()
+
+    def test_empty(self, lig_mol, pkt_mol):
+        uff_grid = mols.UFFGrid(pkt_mol, lig_mol.center + 100)
+        assert uff_grid.empty
+        E, grad = uff_grid.get_energy(lig_mol.coords, *mols.get_uff_vdw_params(
+            Chem.RWMol(lig_mol)
+        ))
+        assert E == 0 and (grad == 0).all()
+
+        uff_mol = lig_mol.uff_minimize(rec_mol=uff_grid)
+        ref_mol = lig_mol.uff_minimize()
+        assert np.isfinite(uff_mol.info['E_min'])
+        assert uff_mol.info['E_init'] == pytest.approx(ref_mol.info['E_init'])
+        assert uff_mol.info['min_error'] in {None, 'Not converged'}
+
+    def test_uff_minimizer(self, uff_grid, lig_mol):
+        uff_minimizer = mols.UFFMinimizer(n_workers=2)
+        uff_mol = uff_minimizer.submit(lig_mol, uff_grid).result()
+        uff_minimizer.close()
+        ref_mol = lig_mol.uff_minimize(rec_mol=uff_grid)
+        assert uff_mol.info['E_min'] == pytest.approx(ref_mol.info['E_min'])
+
+
+# a stand-in for gnina that logs each run, then "minimizes"
+#   each ligand by copying it with its index as the affinity,
+#   except for ligands with a skip property, which it warns about
+GNINA_STAND_IN = \
+'''import sys, gzip
+from rdkit import Chem
+args = sys.argv[1:]
+lig_file = args[args.index('-l') + 1]
+out_file = args[args.index('-o') + 1]
+with open(sys.argv[0] + '.log', 'a') as f:
+    f.write(' '.join(args) + '\\n')
+with gzip.open(lig_file) as f:
+    lig_mols = list(Chem.ForwardSDMolSupplier(f, sanitize=False))
+with gzip.open(out_file, 'wt') as f:
+    writer = Chem.SDWriter(f)
+    for i, lig_mol in enumerate(lig_mols):
+        if lig_mol.HasProp('skip'):
+            print('WARNING: skipping ligand', flush=True)
+            continue
+        print(f'Affinity: {-i:.5f} (kcal/mol)', flush=True)
+        lig_mol.SetDoubleProp('minimizedAffinity', -i)
+        writer.write(lig_mol)
+    writer.close()
+'''
+
+
+class TestGninaMinimize(object):
+
+    @pytest.fixture
+    def gnina_log(self, tmp_path, monkeypatch):
+        gnina_file = tmp_path / 'gnina.py'
+        gnina_file.write_text(GNINA_STAND_IN)
+        monkeypatch.setattr(
+            mols, 'GNINA_CMD', f'{sys.executable} {gnina_file}'
+        )
+        return tmp_path / 'gnina.py.log'
+
+    def test_minimize_one(self, gnina_log, lig_mol, pkt_mol):
+        gni_mol = lig_mol.gnina_minimize(rec_mol=pkt_mol)
+        assert gni_mol.n_atoms == lig_mol.n_atoms
+        assert gni_mol.info['minimizedAffinity'] == 0
+        assert gni_mol.info['error'] is None
+        assert len(gnina_log.read_text().splitlines()) == 1
+
+    def test_minimize_batch(self, gnina_log, lig_mol, pkt_mol):
+        lig_mols = [mols.Molecule(Chem.RWMol())] + [
+            mols.Molecule(Chem.Mol(lig_mol)) for i in range(4)
+        ]
+        lig_mols[1].SetProp('_Name', 'real')
+        lig_mols[2].SetProp('skip', '1')
+
+        gni_mols = mols.gnina_minimize_rd_mols(lig_mols, pkt_mol)
+        assert len(gnina_log.read_text().splitlines()) == 1
+        assert len(gni_mols) == len(lig_mols)
+        assert gni_mols[0].info['error'] == 'No atoms'
+        assert gni_mols[2].info['error'].startswith('WARNING')
+        for i in [1, 3, 4]:
+            assert gni_mols[i].info['error'] is None
+            assert gni_mols[i].n_atoms == lig_mol.n_atoms
+        assert gni_mols[1].GetProp('_Name') == 'real'
+        assert gni_mols[1].info['minimizedAffinity'] == 0
+        assert gni_mols[4].info['minimizedAffinity'] == -3
+        assert not lig_mols[3].HasProp('_Name')
+
+    def test_minimize_no_atoms(self, gnina_log):
+        gni_mols = mols.gnina_minimize_rd_mols(
+            [mols.Molecule(Chem.RWMol())], rec_mol=None
+        )
+        assert gni_mols[0].info['error'] == 'No atoms'
+        assert not gnina_log.exists()